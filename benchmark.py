@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+benchmark.py
+
+Time each stage of the geometry pipeline, for every shape in SHAPES_3D and
+SHAPES_4D, at several frame counts.
+
+quality.sh measures pbrt.  This measures our own Python code, one stage at a
+time, so a change that speeds up one stage can be shown not to slow down
+another.
+
+The results are a TSV like _quality/times_small.tsv: status, elapsed_secs,
+then the shape, number of frames and stage.  Compare against a saved run with
+--baseline.
+
+--startup instead checks that the bounds and pbrt actions, which run on render
+machines without a display, import quickly and don't import matplotlib.
+
+Usage:
+  ./benchmark.py [options]
+
+Examples:
+  ./benchmark.py --out _quality/geometry_base.tsv
+  ./benchmark.py --baseline _quality/geometry_base.tsv
+  ./benchmark.py --shapes 5-3-3,4-3 --num-frames 90,1000
+  ./benchmark.py --startup
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import polytope
+import polytope_cache
+import scene_template
+import slicer
+from render import generate_ply
+from schlafli import schlafli_interpreter
+
+
+HEADER = ['status', 'elapsed_secs', 'shape', 'num_frames', 'stage']
+
+# Import time budgets in seconds, for all the imports of a polytope.py run,
+# including the ones functions do when they're first called.  When they were
+# set, bounds took 0.25 seconds and pbrt 0.7, most of it scipy for the hulls.
+# Before matplotlib was imported lazily, both took over a second.
+STARTUP_CHECKS = [
+    # action, polytope.py args, budget, packages it must not import
+    ('bounds', ['bounds'], 0.5, ['matplotlib', 'mpl_toolkits', 'scipy']),
+    ('pbrt', ['--num-frames', '2', 'pbrt', '5', '3', '3'], 1.0,
+     ['matplotlib', 'mpl_toolkits']),
+]
+
+
+def ShapeName(schlafli):
+  return '-'.join(str(n) for n in schlafli)
+
+
+def _Time(repeat, func, *args):
+  """Run func repeat times.  Returns the best time, and its last result."""
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+
+def _TimeCache(repeat, schlafli):
+  """Time loading a polytope from the cache.
+
+  The cache is a scratch directory, so the user's isn't filled or evicted.
+  """
+  cache_dir = tempfile.mkdtemp(prefix='polytope-cache-')
+  old_dir = os.environ.get('POLYTOPE_CACHE_DIR')
+  os.environ['POLYTOPE_CACHE_DIR'] = cache_dir
+  try:
+    polytope_cache.RegularPolytope(schlafli)  # Fill the cache
+    return _Time(repeat, polytope_cache.RegularPolytope, schlafli)
+  finally:
+    if old_dir is None:
+      del os.environ['POLYTOPE_CACHE_DIR']
+    else:
+      os.environ['POLYTOPE_CACHE_DIR'] = old_dir
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _HullMeshes(frames):
+  """hull_mesh() of each frame.  Returns meshes and number of failures.
+
+  The slices at the ends of a sweep can be flat, which qhull rejects.  Those
+  frames get an empty mesh.
+  """
+  meshes = []
+  num_failed = 0
+  for points in frames:
+    try:
+      meshes.append(generate_ply.hull_mesh(points))
+    except (RuntimeError, ValueError):
+      meshes.append((np.zeros((0, 3)), np.zeros((0, 3), dtype=int)))
+      num_failed += 1
+  return meshes, num_failed
+
+
+def _ModelMeshes(model, offsets, merged=False):
+  meshes = []
+  num_failed = 0
+  for offset in offsets:
+    try:
+      if merged:
+        vertices, polygons = model.MergedHullMesh(offset)
+        meshes.append((vertices, slicer.SplitPolygons(polygons)))
+      else:
+        meshes.append(model.HullMesh(offset))
+    except (RuntimeError, ValueError):
+      meshes.append((np.zeros((0, 3)), np.zeros((0, 3), dtype=int)))
+      num_failed += 1
+  return meshes, num_failed
+
+
+def _PlyBytes(opts, meshes):
+  return [polytope.PlyBytes(opts, vertices, faces)
+          for vertices, faces in meshes]
+
+
+def _ExpandTemplates(opts, pbrt_template, num_frames):
+  template = scene_template.FrameTemplate(pbrt_template)
+  eye_points = polytope.CameraPath(opts.camera, num_frames)['eye']
+  ply_angles = polytope.PlyAngles(num_frames)
+  return [
+      template.Expand(polytope.FrameFields(
+          opts, 'frame%03d.png' % i, 'frame%03d.ply' % i, eye_points[i],
+          ply_angles[i]))
+      for i in range(num_frames)]
+
+
+def BenchShape(schlafli, num_frames, opts, pbrt_template):
+  """Time every stage for one shape.  Yields (stage, status, elapsed).
+
+  The stages, in pipeline order:
+    regular_polytope: schlafli_interpreter, without the cache
+    polytope_cache: loading it from a scratch cache
+    tilt: Tilt3D/Tilt4D, once, like GenPbrt
+    intersect: slicer.SliceAll() for all frames
+    convex_hull: generate_ply.hull_mesh() for each frame
+    slice_model: slicer.SliceModel.HullMesh() for each frame (4D only)
+    merge_faces: slicer.SliceModel.MergedHullMesh() for each frame (4D only)
+    ply_ascii, ply_binary: PLY bytes for each frame's hull
+    template: the .pbrt text for each frame
+
+  status is 1 if some frames couldn't be meshed, e.g. a slice through a
+  single vertex.
+  """
+  repeat = opts.repeat
+  ascii_opts = polytope.CreateOptionsParser().parse_args(
+      ['--ply-format', 'ascii'])[0]
+  binary_opts = polytope.CreateOptionsParser().parse_args(
+      ['--ply-format', 'binary'])[0]
+
+  elapsed, (vertices, edges_etc) = _Time(
+      repeat, schlafli_interpreter.regular_polytope_arrays, list(schlafli))
+  yield 'regular_polytope', 0, elapsed
+
+  elapsed, _ = _TimeCache(repeat, list(schlafli))
+  yield 'polytope_cache', 0, elapsed
+
+  vertex_list = [np.array(v) for v in vertices]
+  axis = len(schlafli)  # the last coordinate
+  coords = vertices[:, axis]
+  offsets = np.linspace(-coords.max(), -coords.min(), num=num_frames)
+
+  if len(schlafli) == 2:
+    tilt, translate = polytope.Tilt3D, polytope.Translate3D
+  else:
+    tilt, translate = polytope.Tilt4D, polytope.Translate4D
+  elapsed, _ = _Time(repeat, tilt, vertex_list)
+  yield 'tilt', 0, elapsed
+
+  # The rest follows GenPbrt, which doesn't tilt 4D polytopes.
+  elapsed, slices = _Time(
+      repeat, slicer.SliceAll, vertices, edges_etc[0], offsets, axis)
+  yield 'intersect', 0, elapsed
+
+  if len(schlafli) == 2:
+    # A 3D shape has one mesh, the solid, which is what GenPbrt writes for
+    # it.  Hull it once per frame, so the numbers scale like the 4D ones.
+    frames = [translate(vertex_list, offset) for offset in offsets]
+  else:
+    frames = [slices.Frame(i) for i in range(num_frames)]
+  elapsed, (meshes, num_failed) = _Time(repeat, _HullMeshes, frames)
+  yield 'convex_hull', int(num_failed > 0), elapsed
+
+  if len(schlafli) == 3:
+    def SliceModelMeshes():
+      lattice = slicer.FaceLattice(edges_etc, len(vertices))
+      model = slicer.SliceModel(lattice, vertices, axis=axis)
+      return _ModelMeshes(model, offsets)
+    elapsed, (_, num_failed) = _Time(repeat, SliceModelMeshes)
+    yield 'slice_model', int(num_failed > 0), elapsed
+
+    def MergedMeshes():
+      lattice = slicer.FaceLattice(edges_etc, len(vertices))
+      model = slicer.SliceModel(lattice, vertices, axis=axis)
+      return _ModelMeshes(model, offsets, merged=True)
+    elapsed, (_, num_failed) = _Time(repeat, MergedMeshes)
+    yield 'merge_faces', int(num_failed > 0), elapsed
+
+  elapsed, _ = _Time(repeat, _PlyBytes, ascii_opts, meshes)
+  yield 'ply_ascii', 0, elapsed
+
+  elapsed, _ = _Time(repeat, _PlyBytes, binary_opts, meshes)
+  yield 'ply_binary', 0, elapsed
+
+  elapsed, _ = _Time(repeat, _ExpandTemplates, ascii_opts, pbrt_template,
+                     num_frames)
+  yield 'template', 0, elapsed
+
+
+def ImportTimes(args):
+  """Run polytope.py with python -X importtime, in a temp dir.
+
+  Returns:
+    secs: the total time spent importing
+    packages: set of the top-level packages imported
+  """
+  out_dir = tempfile.mkdtemp(prefix='polytope-startup-')
+  argv = [sys.executable, '-X', 'importtime', 'polytope.py',
+          '--out-dir', out_dir] + args
+  try:
+    proc = subprocess.Popen(argv, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = proc.communicate()
+  finally:
+    shutil.rmtree(out_dir, ignore_errors=True)
+  if proc.returncode != 0:
+    raise RuntimeError('polytope.py %s failed:\n%s' % (' '.join(args), stderr))
+
+  total = 0
+  packages = set()
+  for line in stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    try:
+      cumulative = int(cumulative)
+    except ValueError:
+      continue  # the header
+    packages.add(name.strip().split('.')[0])
+    if not name.startswith('  '):  # not imported by another module
+      total += cumulative
+  return total / 1e6, packages
+
+
+def CheckStartup():
+  """Run the STARTUP_CHECKS.  Returns a list of problems."""
+  problems = []
+  for action, args, budget, forbidden in STARTUP_CHECKS:
+    secs, packages = ImportTimes(args)
+    imported = sorted(set(forbidden) & packages)
+    line = '%-8s %8.3f seconds importing (budget %.3f)' % (action, secs,
+                                                           budget)
+    if secs > budget:
+      line += '  OVER BUDGET'
+      problems.append('%s imports took %.3f seconds, over the budget of '
+                      '%.3f' % (action, secs, budget))
+    if imported:
+      line += '  imports %s' % ', '.join(imported)
+      problems.append('%s imports %s' % (action, ', '.join(imported)))
+    print(line)
+    sys.stdout.flush()
+  return problems
+
+
+def ParseShapes(s):
+  """'all', '3d', '4d', or e.g. '5-3-3,4-3'."""
+  if s == 'all':
+    return polytope.SHAPES_3D + polytope.SHAPES_4D
+  if s == '3d':
+    return list(polytope.SHAPES_3D)
+  if s == '4d':
+    return list(polytope.SHAPES_4D)
+  shapes = []
+  for name in s.split(','):
+    try:
+      shapes.append(tuple(int(n) for n in name.split('-')))
+    except ValueError:
+      raise RuntimeError('Invalid shape %r, expected e.g. 5-3-3' % name)
+    if len(shapes[-1]) not in (2, 3):
+      raise RuntimeError('Invalid shape %r, expected e.g. 5-3-3' % name)
+  return shapes
+
+
+def ReadTimes(path):
+  """Returns {(shape, num_frames, stage): elapsed_secs} from a TSV.
+
+  Rows with a nonzero status are included, since those stages still ran.
+  """
+  times = {}
+  with open(path) as f:
+    header = f.readline().rstrip('\n').split('\t')
+    if header != HEADER:
+      raise RuntimeError('%s: expected columns %s' % (path, ' '.join(HEADER)))
+    for line in f:
+      _, elapsed, shape, num_frames, stage = line.rstrip('\n').split('\t')
+      times[shape, num_frames, stage] = float(elapsed)
+  return times
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage='%prog [options]',
+      description='Time each stage of the geometry pipeline.')
+  parser.add_option(
+      '--shapes', type=str, default='all',
+      help="'all', '3d', '4d', or a comma-separated list like 5-3-3,4-3")
+  parser.add_option(
+      '--num-frames', type=str, default='10,90',
+      help='Comma-separated frame counts to run each shape at')
+  parser.add_option(
+      '--repeat', type=int, default=5,
+      help='Run each stage this many times, and keep the fastest')
+  parser.add_option(
+      '--frame-template', type=str, default='polytope-frame.template',
+      help='PBRT template to expand in the template stage')
+  parser.add_option(
+      '--out', type=str, default='_quality/geometry_times.tsv',
+      help='TSV file to write')
+  parser.add_option(
+      '--baseline', type=str,
+      help='TSV from an earlier run to compare against')
+  parser.add_option(
+      '--threshold', type=float, default=0.2,
+      help='Flag stages that are this fraction slower than the baseline')
+  parser.add_option(
+      '--min-secs', type=float, default=0.01,
+      help="Don't flag stages that take less than this, which are mostly "
+           "noise")
+  parser.add_option(
+      '--startup', action='store_true',
+      help='Only check the import time of the bounds and pbrt actions')
+
+  opts, args = parser.parse_args(argv[1:])
+  if args:
+    raise RuntimeError('Unexpected arguments %s' % ' '.join(args))
+
+  if opts.startup:
+    problems = CheckStartup()
+    if problems:
+      raise RuntimeError('Slow startup: %s' % '; '.join(problems))
+    return
+
+  shapes = ParseShapes(opts.shapes)
+  try:
+    frame_counts = [int(n) for n in opts.num_frames.split(',')]
+  except ValueError:
+    raise RuntimeError('Invalid --num-frames %r' % opts.num_frames)
+  baseline = ReadTimes(opts.baseline) if opts.baseline else None
+
+  with open(opts.frame_template) as f:
+    pbrt_template = f.read()
+
+  regressions = []
+  with open(opts.out, 'w') as out:
+    out.write('\t'.join(HEADER) + '\n')
+    for schlafli in shapes:
+      shape = ShapeName(schlafli)
+      for num_frames in frame_counts:
+        for stage, status, elapsed in BenchShape(schlafli, num_frames, opts,
+                                                 pbrt_template):
+          row = [str(status), '%.6f' % elapsed, shape, str(num_frames),
+                 stage]
+          out.write('\t'.join(row) + '\n')
+
+          line = '%-8s %6d %-16s %10.4f' % (shape, num_frames, stage, elapsed)
+          if status != 0:
+            line += '  (some frames failed)'
+          if baseline is not None:
+            base = baseline.get((shape, str(num_frames), stage))
+            if base is None:
+              line += '  (not in baseline)'
+            else:
+              ratio = elapsed / base if base > 0 else float('inf')
+              line += '  %5.2fx' % ratio
+              if (ratio > 1 + opts.threshold and
+                  max(base, elapsed) >= opts.min_secs):
+                line += '  REGRESSION'
+                regressions.append((shape, num_frames, stage, base, elapsed))
+          print(line)
+          sys.stdout.flush()
+
+  print('Wrote %s' % opts.out)
+  if regressions:
+    for shape, num_frames, stage, base, elapsed in regressions:
+      print('  %s %d frames %s: %.4f -> %.4f seconds' % (
+            shape, num_frames, stage, base, elapsed))
+    raise RuntimeError('%d stages are more than %d%% slower than %s' % (
+                       len(regressions), opts.threshold * 100, opts.baseline))
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)
@@ -9,7 +9,7 @@ set -o errexit
 
 code() {
   echo 'OUR PYTHON CODE'
-  wc -l polytope.py rotate.py render/generate_ply.py
+  wc -l polytope.py geometry_archive.py pipeline.py render_executor.py shard_planner.py video_assembler.py benchmark.py profiling.py scene_template.py polytope_cache.py rotate.py slicer.py render/*.py
   echo
 
   echo 'OTHER'
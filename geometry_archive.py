@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+geometry_archive.py
+
+All the slice meshes of a run in one file, instead of a .ply file per frame.
+
+polytope.py --geometry-archive writes it.  After a header come three flat
+buffers: the vertices of every frame, the number of corners of every face,
+and the vertex indices of every face.  A table at the end says where each
+frame starts in each buffer.  The buffers are read with np.memmap, so reading
+one frame doesn't read the others.
+
+The 'export' action writes the .ply files of some frames from the archive,
+e.g. right before rendering them.  render_executor.py does this for the frames
+of its --shard.
+
+Usage:
+  ./geometry_archive.py [options] export DIR
+
+Examples:
+  ./geometry_archive.py export _out/4d/5-3-3
+  ./geometry_archive.py --frames 0-9 export _out/4d/5-3-3
+  ./geometry_archive.py --shard 1/3 export _out/4d/5-3-3
+"""
+
+import filecmp
+import io
+import optparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+import pipeline
+from render import generate_ply
+
+
+MAGIC = b'PVGEOM1\n'
+
+# magic, num_frames, num_vertices, num_faces, num_indices
+HEADER = struct.Struct('<8s4Q')
+HEADER_SIZE = 64  # room to grow, and aligns the buffers
+
+VERTEX_DTYPE = np.dtype('<f8')  # lossless, so PLYs are the same as before
+SIZE_DTYPE = np.dtype('u1')  # like the PLY list count
+INDEX_DTYPE = np.dtype('<i4')  # like the PLY vertex indices
+TABLE_DTYPE = np.dtype('<i8')
+
+
+def _Padded(n):
+  """Round a byte count up to a multiple of 8."""
+  return (n + 7) // 8 * 8
+
+
+def _Map(path, dtype, offset, shape):
+  # np.memmap can't map zero bytes.
+  if np.prod(shape) == 0:
+    return np.zeros(shape, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def FlattenFaces(faces):
+  """Returns the corner count of each face, and all their vertex indices.
+
+  faces is an (m, k) array or a list of index lists of any lengths, like
+  generate_ply.pack_faces() takes.
+  """
+  if isinstance(faces, np.ndarray) and faces.ndim == 2:
+    sizes = np.full(len(faces), faces.shape[1], dtype=SIZE_DTYPE)
+    return sizes, faces.reshape(-1).astype(INDEX_DTYPE)
+  sizes = np.array([len(face) for face in faces], dtype=SIZE_DTYPE)
+  if len(sizes) == 0:
+    return sizes, np.zeros(0, dtype=INDEX_DTYPE)
+  flat = np.concatenate([np.asarray(face) for face in faces])
+  return sizes, flat.astype(INDEX_DTYPE)
+
+
+class ArchiveWriter(object):
+  """Appends the mesh of each frame, in order, to a new archive.
+
+  The vertices go straight to the file.  The faces are spooled to temp files
+  and copied after them in Close(), when their offsets are known.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.tmp_path = path + '.tmp'
+    self.f = open(self.tmp_path, 'wb')
+    self.f.write(b'\0' * HEADER_SIZE)
+    self.sizes_file = tempfile.TemporaryFile()
+    self.indices_file = tempfile.TemporaryFile()
+    # Where each frame starts: vertex, face, index
+    self.table = [(0, 0, 0)]
+
+  def Append(self, vertices, faces):
+    vertices = np.ascontiguousarray(vertices, dtype=VERTEX_DTYPE)
+    vertices = vertices.reshape(-1, 3)
+    sizes, indices = FlattenFaces(faces)
+    self.f.write(vertices.tobytes())
+    self.sizes_file.write(sizes.tobytes())
+    self.indices_file.write(indices.tobytes())
+    v, s, i = self.table[-1]
+    self.table.append((v + len(vertices), s + len(sizes), i + len(indices)))
+
+  def Close(self):
+    """Finish the file.  Returns whether it differs from the old archive.
+
+    An archive that comes out the same as last time is left alone, so its
+    mtime doesn't change, like pipeline.WriteIfChanged().
+    """
+    num_vertices, num_faces, num_indices = self.table[-1]
+    for spool in (self.sizes_file, self.indices_file):
+      self.f.write(b'\0' * (_Padded(self.f.tell()) - self.f.tell()))
+      spool.seek(0)
+      shutil.copyfileobj(spool, self.f)
+      spool.close()
+    self.f.write(b'\0' * (_Padded(self.f.tell()) - self.f.tell()))
+    self.f.write(np.array(self.table, dtype=TABLE_DTYPE).tobytes())
+
+    self.f.seek(0)
+    self.f.write(HEADER.pack(MAGIC, len(self.table) - 1, num_vertices,
+                             num_faces, num_indices))
+    self.f.close()
+
+    if os.path.exists(self.path) and filecmp.cmp(self.tmp_path, self.path,
+                                                 shallow=False):
+      os.remove(self.tmp_path)
+      return False
+    os.rename(self.tmp_path, self.path)
+    return True
+
+  def Abort(self):
+    self.f.close()
+    self.sizes_file.close()
+    self.indices_file.close()
+    os.remove(self.tmp_path)
+
+
+class GeometryArchive(object):
+  """Reads the meshes in an archive, one frame at a time."""
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    except IOError as e:
+      raise RuntimeError("Can't read geometry archive: %s" % e)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+      raise RuntimeError('%s is not a geometry archive' % path)
+    (_, self.num_frames, num_vertices, num_faces,
+     num_indices) = HEADER.unpack(header)
+
+    offset = HEADER_SIZE
+    self.vertices = _Map(path, VERTEX_DTYPE, offset, (num_vertices, 3))
+    offset = _Padded(offset + self.vertices.nbytes)
+    self.face_sizes = _Map(path, SIZE_DTYPE, offset, (num_faces,))
+    offset = _Padded(offset + self.face_sizes.nbytes)
+    self.indices = _Map(path, INDEX_DTYPE, offset, (num_indices,))
+    offset = _Padded(offset + self.indices.nbytes)
+    self.table = np.array(
+        _Map(path, TABLE_DTYPE, offset, (self.num_frames + 1, 3)))
+
+  def Frame(self, i):
+    """Returns the vertices and faces of frame i.
+
+    The faces are an (m, k) array if they all have k corners, like a hull's
+    triangles, or else a list of index arrays.
+    """
+    if not 0 <= i < self.num_frames:
+      raise IndexError('Frame %d not in archive of %d frames' % (
+                       i, self.num_frames))
+    (v0, f0, i0), (v1, f1, i1) = self.table[i], self.table[i + 1]
+    vertices = np.array(self.vertices[v0:v1])
+    sizes = np.array(self.face_sizes[f0:f1])
+    indices = np.array(self.indices[i0:i1])
+    if len(sizes) == 0:
+      return vertices, np.zeros((0, 3), dtype=INDEX_DTYPE)
+    if (sizes == sizes[0]).all():
+      return vertices, indices.reshape(-1, sizes[0])
+    return vertices, np.split(indices, np.cumsum(sizes)[:-1])
+
+  def Bounds(self):
+    """Returns the min and max corners of every frame's vertices."""
+    if len(self.vertices) == 0:
+      return np.zeros(3), np.zeros(3)
+    return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+
+def PlyBytes(vertices, faces, ply_format='ascii', ply_precision='float32',
+             ply_normals=False):
+  """A frame's mesh as a .ply file, like polytope.py --ply-format."""
+  if ply_format == 'binary':
+    if ply_normals:
+      normals = generate_ply.vertex_normals(vertices, faces)
+    else:
+      normals = None
+    f = io.BytesIO()
+    generate_ply.write_binary_ply(f, vertices, faces, normals=normals,
+                                  dtype=ply_precision)
+    return f.getvalue()
+  else:
+    f = io.StringIO()
+    generate_ply.write_ply(f, vertices, faces,
+                           template_path='render/ply-header.template')
+    return f.getvalue().encode('utf-8')
+
+
+def ExportPlys(out_dir, indices=None):
+  """Write the .ply files of frames from the archive in out_dir.
+
+  The archive and PLY options come from the manifest polytope.py wrote.  PLYs
+  that are already up to date are left alone.
+
+  Args:
+    out_dir: directory generated with --geometry-archive
+    indices: frame indices to export, or None for all of them
+
+  Returns:
+    The number of .ply files written, or None if out_dir has no archive.
+  """
+  manifest = pipeline.ReadManifest(out_dir)
+  if manifest is None or not manifest['options'].get('geometry_archive'):
+    return None
+  options = manifest['options']
+  archive = GeometryArchive(
+      os.path.join(out_dir, options['geometry_archive']))
+
+  if indices is not None:
+    indices = set(indices)
+  num_written = 0
+  for frame in manifest['frames']:
+    if indices is not None and frame['index'] not in indices:
+      continue
+    pbrt_name = os.path.basename(frame['pbrt'])
+    ply_path = os.path.join(out_dir, os.path.splitext(pbrt_name)[0] + '.ply')
+    vertices, faces = archive.Frame(frame['index'])
+    data = PlyBytes(vertices, faces, ply_format=options['ply_format'],
+                    ply_precision=options['ply_precision'],
+                    ply_normals=options['ply_normals'])
+    if pipeline.WriteIfChanged(ply_path, data):
+      num_written += 1
+  return num_written
+
+
+def ParseFrames(s):
+  """'0-9,20' -> set of frame indices"""
+  indices = set()
+  for part in s.split(','):
+    try:
+      if '-' in part:
+        start, end = [int(n) for n in part.split('-')]
+        indices.update(range(start, end + 1))
+      else:
+        indices.add(int(part))
+    except ValueError:
+      raise RuntimeError('Invalid --frames %r, expected e.g. 0-9,20' % s)
+  return indices
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage='%prog [options] export DIR',
+      description='Write .ply files from the geometry archive of a directory '
+                  'generated with polytope.py --geometry-archive.')
+  parser.add_option(
+      '--frames', type=str,
+      help='Only export these frames, e.g. 0-9,20')
+  parser.add_option(
+      '--shard', type=str,
+      help='Only export frames whose number is I mod N, given as I/N, like '
+           'render_executor.py --shard')
+
+  opts, args = parser.parse_args(argv[1:])
+  if len(args) != 2 or args[0] != 'export':
+    raise RuntimeError('Usage: %s' % parser.get_usage().strip())
+  out_dir = args[1]
+
+  manifest = pipeline.ReadManifest(out_dir)
+  if manifest is None:
+    raise RuntimeError('No %s in %s' % (pipeline.MANIFEST, out_dir))
+  indices = set(frame['index'] for frame in manifest['frames'])
+  if opts.frames:
+    indices &= ParseFrames(opts.frames)
+  if opts.shard:
+    import render_executor  # which imports this module
+    worker_id, num_workers = render_executor.ParseShard(opts.shard)
+    indices = set(i for i in indices if i % num_workers == worker_id)
+
+  num_written = ExportPlys(out_dir, indices)
+  if num_written is None:
+    raise RuntimeError('%s was not generated with --geometry-archive' %
+                       out_dir)
+  print('Wrote %d of %d .ply files in %s' % (num_written, len(indices),
+                                              out_dir))
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,462 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+pipeline.py
+
+Render frames while later frames are still being generated.
+
+GenPbrt puts a FrameJob on a bounded queue as soon as a frame's .ply and .pbrt
+files are written, and RenderStage threads run the renderer on them.  When
+the queue is full, the generator blocks, so it can't get far ahead of the
+renderer and fill the disk.
+
+Each frame also has a key: a hash of its .ply bytes and .pbrt text.  An
+ImageCache maps the key and the renderer to a rendered image, so a frame that
+comes out the same as in an earlier run is never rendered again.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import polytope_cache
+
+
+# key: FrameKey() of the frame's files, or None to not use the ImageCache.
+# params: dict of the parameters behind the frame, saved with cached images.
+FrameJob = collections.namedtuple(
+    'FrameJob', 'index pbrt_path image_path key params')
+FrameJob.__new__.__defaults__ = (None, None)
+
+# Written to the output dir.  One line per rendered frame: index and image.
+FINISHED_LOG = 'finished-frames.txt'
+
+# Written to the output dir by GenPbrt.  The key and parameters of each frame.
+MANIFEST = 'manifest.json'
+
+PNG_END = b'IEND\xaeB`\x82'  # the IEND chunk and its CRC
+EXR_MAGIC = b'\x76\x2f\x31\x01'
+
+
+def FrameKey(ply_bytes, pbrt_text):
+  h = hashlib.sha1()
+  h.update(ply_bytes)
+  h.update(b'\0')
+  h.update(pbrt_text.encode('utf-8'))
+  return h.hexdigest()
+
+
+def WriteIfChanged(path, data):
+  """Write bytes to a file, unless it already has them.
+
+  Unchanged files keep their mtime, so their images are still up to date.
+  Returns whether the file was written.
+  """
+  try:
+    if os.path.getsize(path) == len(data):
+      with open(path, 'rb') as f:
+        if f.read() == data:
+          return False
+  except (IOError, OSError):
+    pass
+  with open(path, 'wb') as f:
+    f.write(data)
+  return True
+
+
+def IsComplete(image_path):
+  """Whether an image was completely written, e.g. not cut off by a crash."""
+  try:
+    size = os.path.getsize(image_path)
+  except OSError:
+    return False
+  if size == 0:
+    return False
+
+  with open(image_path, 'rb') as f:
+    if image_path.endswith('.png'):
+      f.seek(max(0, size - len(PNG_END)))
+      return f.read() == PNG_END
+    if image_path.endswith('.exr'):
+      return f.read(len(EXR_MAGIC)) == EXR_MAGIC
+  return True
+
+
+def RendererIdentity(render_argv):
+  """The render command, and the size and mtime of its executable.
+
+  A rebuilt pbrt may render differently, so it gets new cache entries.
+  """
+  identity = {'argv': render_argv}
+  path = shutil.which(render_argv[0])
+  if path:
+    st = os.stat(path)
+    identity.update(path=os.path.realpath(path), size=st.st_size,
+                    mtime=int(st.st_mtime))
+  return identity
+
+
+def ReadManifest(out_dir):
+  """Returns the manifest GenPbrt wrote to a directory, or None."""
+  try:
+    with open(os.path.join(out_dir, MANIFEST)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return None
+
+
+def ManifestFrames(manifest):
+  """Returns {.pbrt basename: frame entry}.
+
+  Keyed by basename, so it works however the directory is named.
+  """
+  if manifest is None:
+    return {}
+  return dict((os.path.basename(frame['pbrt']), frame)
+              for frame in manifest['frames'])
+
+
+class ImageCache(object):
+  """Rendered images, keyed by frame key and renderer.
+
+  Each entry is a directory holding the image and params.json, which records
+  the parameters and renderer behind it.  Entries are stored and evicted like
+  polytope_cache entries, so concurrent renders are safe.  If the cache
+  directory can't be written, storing stops, with one warning.
+  """
+
+  # Images are big, so allow more space than polytope_cache.
+  MAX_BYTES = 4 << 30
+
+  def __init__(self, render_argv, cache_dir=None):
+    self.cache_dir = cache_dir or os.environ.get(
+        'FRAME_CACHE_DIR', os.path.join(
+            os.path.expanduser('~'), '.cache', 'pbrt-video', 'images'))
+    self.renderer = RendererIdentity(render_argv)
+    self.renderer_hash = hashlib.sha1(
+        json.dumps(self.renderer, sort_keys=True).encode('utf-8')).hexdigest()
+    self.storing = True
+    self.lock = threading.Lock()  # Store() runs in several workers
+
+  def _EntryDir(self, job):
+    h = hashlib.sha1((job.key + self.renderer_hash).encode('ascii'))
+    return os.path.join(self.cache_dir, h.hexdigest())
+
+  def _CachedImage(self, job):
+    ext = os.path.splitext(job.image_path)[1]
+    return os.path.join(self._EntryDir(job), 'image' + ext)
+
+  def Fetch(self, job):
+    """Copy a cached image to job.image_path.  Returns whether it was there."""
+    cached = self._CachedImage(job)
+    if not IsComplete(cached):
+      return False
+    try:
+      tmp = job.image_path + '.tmp'
+      shutil.copyfile(cached, tmp)
+      os.rename(tmp, job.image_path)
+      os.utime(self._EntryDir(job), None)  # for LRU eviction
+    except (IOError, OSError):
+      return False  # Evicted while we were copying it
+    return True
+
+  def Store(self, job):
+    """Save a newly rendered image."""
+    if not self.storing:
+      return
+    entry_dir = self._EntryDir(job)
+    if os.path.exists(entry_dir):
+      return
+    try:
+      self._Store(job, entry_dir)
+      polytope_cache.Evict(self.cache_dir, max_bytes=self.MAX_BYTES)
+    except (IOError, OSError) as e:
+      with self.lock:
+        if self.storing:
+          print('Not caching images in %s: %s' % (self.cache_dir, e),
+                file=sys.stderr)
+          self.storing = False
+
+  def _Store(self, job, entry_dir):
+    try:
+      os.makedirs(self.cache_dir)
+    except OSError:
+      pass  # Already exists, or mkdtemp() says why not
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+    try:
+      shutil.copyfile(job.image_path, os.path.join(
+          tmp_dir, os.path.basename(self._CachedImage(job))))
+      with open(os.path.join(tmp_dir, 'params.json'), 'w') as f:
+        json.dump({'key': job.key, 'params': job.params,
+                   'renderer': self.renderer}, f, indent=2, sort_keys=True)
+    except (IOError, OSError):
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      raise
+    try:
+      os.rename(tmp_dir, entry_dir)
+    except OSError:
+      shutil.rmtree(tmp_dir, ignore_errors=True)  # Stored by another worker
+
+
+class RenderStage(object):
+  """Runs a render command on each FrameJob, in worker threads."""
+
+  def __init__(self, render_argv, num_workers=1, queue_size=None,
+               finished_path=None, image_cache=None, on_done=None):
+    """
+    Args:
+      render_argv: command to run, e.g. ['pbrt', '--quick'].  The .pbrt path
+        is appended.
+      num_workers: number of renders to run at once
+      queue_size: max number of generated frames waiting to be rendered
+      finished_path: file to append finished frames to
+      image_cache: ImageCache to reuse and save images in, or None
+      on_done: called with each FrameJob and whether it succeeded, when it's
+        finished or has failed, in the worker thread
+    """
+    self.render_argv = render_argv
+    self.queue = queue.Queue(maxsize=queue_size or 2 * num_workers)
+    self.finished_path = finished_path
+    self.image_cache = image_cache
+    self.on_done = on_done
+
+    self.lock = threading.Lock()
+    self.running = {}  # worker index -> Popen
+    self.finished = []  # FrameJob
+    self.num_reused = 0  # finished frames that came from the image cache
+    self.failed = []  # (FrameJob, exit code)
+    self.stopping = False
+
+    self.threads = [
+        threading.Thread(target=self._Worker, args=(i,))
+        for i in range(num_workers)]
+    for t in self.threads:
+      t.daemon = True
+      t.start()
+
+  def Put(self, job):
+    """Queue a frame to render.  Blocks while the queue is full."""
+    self.queue.put(job)
+
+  def Finish(self):
+    """Wait for every queued frame to be rendered."""
+    for _ in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+
+  def Abort(self):
+    """Stop rendering, e.g. on Ctrl-C.  Kills renders in progress."""
+    with self.lock:
+      self.stopping = True
+      procs = list(self.running.values())
+    for proc in procs:
+      proc.terminate()
+
+    # Drop waiting frames, and wake up the workers.
+    while True:
+      try:
+        self.queue.get_nowait()
+      except queue.Empty:
+        break
+    for _ in self.threads:
+      try:
+        self.queue.put_nowait(None)
+      except queue.Full:
+        break
+    for t in self.threads:
+      t.join()
+
+  def _Worker(self, worker_index):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        return
+
+      use_cache = self.image_cache is not None and job.key is not None
+      if use_cache and self.image_cache.Fetch(job):
+        with self.lock:
+          self.finished.append(job)
+          self.num_reused += 1
+          self._RecordFinished(job)
+          print('Reused cached image for frame %d: %s' % (
+                job.index, job.image_path))
+        if self.on_done:
+          self.on_done(job, True)
+        continue
+
+      with self.lock:
+        if self.stopping:
+          return
+        try:
+          proc = subprocess.Popen(self.render_argv + [job.pbrt_path])
+        except OSError as e:
+          # e.g. a missing render binary.  Keep going, so the caller isn't
+          # left waiting on this worker.
+          proc = None
+          self.failed.append((job, 127))  # like the shell's "not found"
+          print("Couldn't render frame %d: %s" % (job.index, e))
+        else:
+          self.running[worker_index] = proc
+
+      if proc is None:
+        if self.on_done:
+          self.on_done(job, False)
+        continue
+
+      start_time = time.time()
+      status = proc.wait()
+      elapsed = time.time() - start_time
+      # A renderer can exit 0 without writing the image, e.g. a typo in the
+      # Film filename.
+      ok = status == 0 and os.path.exists(job.image_path)
+
+      # Copying the image and evicting old ones is slow, so other workers
+      # don't wait for it.
+      if ok and use_cache and not self.stopping:
+        self.image_cache.Store(job)
+
+      with self.lock:
+        del self.running[worker_index]
+        if self.stopping:
+          return
+        if ok:
+          self.finished.append(job)
+          self._RecordFinished(job)
+          print('Rendered frame %d in %.1f seconds: %s' % (
+                job.index, elapsed, job.image_path))
+        elif status == 0:
+          self.failed.append((job, status))
+          print('Render of frame %d exited 0 without writing %s' % (
+                job.index, job.image_path))
+        else:
+          self.failed.append((job, status))
+          print('Render of frame %d failed with status %d' % (
+                job.index, status))
+      if self.on_done:
+        self.on_done(job, ok)
+
+  def _RecordFinished(self, job):
+    if not self.finished_path:
+      return
+    with open(self.finished_path, 'a') as f:
+      f.write('%d %s\n' % (job.index, job.image_path))
+
+  def Summary(self):
+    indices = sorted(job.index for job in self.finished)
+    return '%d frames rendered (%d from cache), %d failed.  Finished: %s' % (
+        len(indices), self.num_reused, len(self.failed),
+        _FormatRanges(indices) or 'none')
+
+
+def _FormatRanges(indices):
+  """[0, 1, 2, 5] -> '0-2 5'"""
+  ranges = []
+  for i in indices:
+    if ranges and ranges[-1][1] == i - 1:
+      ranges[-1][1] = i
+    else:
+      ranges.append([i, i])
+  return ' '.join('%d' % a if a == b else '%d-%d' % (a, b)
+                  for a, b in ranges)
+
+
+def FinishedPath(out_dir):
+  return os.path.join(out_dir, FINISHED_LOG)
+
+
+def BisectionLevels(n):
+  """Split range(n) into levels of temporal bisection.
+
+  The first level is the first and last frame, the next is the midpoint,
+  then the quarter points, and so on.  After each level, the frames so far
+  are spread evenly over the whole animation.
+
+  Returns:
+    list of lists of frame positions
+  """
+  if n == 0:
+    return []
+  levels = [sorted(set([0, n - 1]))]
+  gaps = [(0, n - 1)]
+  while gaps:
+    level = []
+    next_gaps = []
+    for lo, hi in gaps:
+      if hi - lo < 2:
+        continue
+      mid = (lo + hi) // 2
+      level.append(mid)
+      next_gaps.extend([(lo, mid), (mid, hi)])
+    if level:
+      levels.append(level)
+    gaps = next_gaps
+  return levels
+
+
+def NearestFrames(have):
+  """For each frame, the nearest frame that has an image.
+
+  Args:
+    have: list of bools, one per frame
+
+  Returns:
+    list of frame positions, or None if no frame has an image.  Ties go to
+    the earlier frame.
+  """
+  done = [i for i, h in enumerate(have) if h]
+  if not done:
+    return None
+  nearest = []
+  k = 0  # done[k] is the first done frame at or after i
+  for i in range(len(have)):
+    while k < len(done) and done[k] < i:
+      k += 1
+    candidates = done[max(0, k - 1):k + 1]
+    nearest.append(min(candidates, key=lambda j: abs(j - i)))
+  return nearest
+
+
+def WritePreviewVideo(image_paths, out_path, fps=30):
+  """Encode the frames that have images as an .mp4, with each missing frame
+  shown as its nearest rendered neighbor.
+
+  The images aren't copied.  ffmpeg's concat demuxer reads a list of them,
+  with repeats.  Returns how many frames have images.
+  """
+  have = [IsComplete(path) for path in image_paths]
+  nearest = NearestFrames(have)
+  if nearest is None:
+    return 0
+
+  list_path = out_path + '.frames.txt'
+  with open(list_path, 'w') as f:
+    f.write('ffconcat version 1.0\n')
+    # The last file is repeated, since its duration is otherwise ignored.
+    for i in nearest + nearest[-1:]:
+      path = os.path.abspath(image_paths[i]).replace("'", "'\\''")
+      f.write("file '%s'\nduration %f\n" % (path, 1.0 / fps))
+
+  tmp_path = out_path + '.tmp'
+  argv = [
+      'ffmpeg', '-y', '-loglevel', 'error',
+      '-f', 'concat', '-safe', '0', '-i', list_path,
+      '-vf', 'fps=%d' % fps, '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+      '-f', 'mp4', tmp_path]
+  try:
+    status = subprocess.call(argv)
+  except OSError as e:
+    raise RuntimeError("Couldn't run ffmpeg: %s" % e)
+  if status != 0:
+    raise RuntimeError('ffmpeg failed with status %d' % status)
+  os.rename(tmp_path, out_path)  # Players never see a partial video
+  os.remove(list_path)
+  return sum(have)
@@ -6,19 +6,33 @@ polytope.py
 
 import optparse
 import os
+import collections
+import cProfile
+import json
 import math
 from math import sin, cos  # shortcuts
+import multiprocessing
+import shlex
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from mpl_toolkits.mplot3d import Axes3D
-from scipy import spatial
-
+# matplotlib is imported by the functions of the plot and anim actions, and
+# scipy by slicer.py and generate_ply.py when a hull is needed.  So the bounds
+# and pbrt actions start quickly on render machines, which have no display.
+
+import geometry_archive
+import pipeline
+import polytope_cache
+import profiling
 import rotate
-from schlafli import schlafli_interpreter
+import scene_template
+import slicer
 from render import generate_ply
+from render import raster
 
 
 def Intersect(edges, plane_normal, p0):
@@ -29,41 +43,15 @@ def Intersect(edges, plane_normal, p0):
   This is the "parametric form" from
 
   https://en.wikipedia.org/wiki/Line%E2%80%93plane_intersection
-  """
-  intersections = []
-  for la, lb in edges:
-    numerator = np.dot(plane_normal, la - p0)
-    #print('n=%f' % numerator)
-
-    lab = lb - la
-    denominator = np.dot(-lab, plane_normal)
-    #print('d=%f' % denominator)
-    if denominator == 0.0:
-      continue
-
-    t = numerator / denominator
-    #print('t=%f' % t)
-    #print()
-
-    inter = la + lab*t
-    if 0.0 <= t <= 1.0:  # It intersected the line segment!
-      intersections.append(inter)
-    else:
-      #print('does not intersect')
-      pass
-
-  if 0:
-    print('Intersections:')
-    for p in intersections:
-      print('  %s' % p)
 
-    # We know we made the Z axis zero
-    print('2D:')
-    for p in intersections:
-      p2 = np.array(p[0:2])
-      print('  %s' % p2)
-
-  return intersections
+  NOTE: This is a wrapper around slicer.IntersectEdges() for the matplotlib
+  code.  Use slicer.SliceAll() to compute many frames at once.
+  """
+  if not edges:
+    return []
+  la = np.array([e[0] for e in edges])
+  lb = np.array([e[1] for e in edges])
+  return list(slicer.IntersectEdges(la, lb, plane_normal, p0))
 
 
 def Draw(ax, edges, plane, intersections):
@@ -102,33 +90,59 @@ def Draw(ax, edges, plane, intersections):
   return mpl_lines, mpl_points
 
 
-def Draw4dSlice(ax, intersections, draw_hull=True):
+def HullTriangles(intersections, model=None, w_offset=None):
+  """Returns the hull of a slice as an array of triangles, shape (n, 3, 3).
+
+  Args:
+    intersections: a list of 3D points
+    model: optional slicer.SliceModel that intersections came from, at
+      w_offset.  Its hull triangles are reused between frames.
   """
+  try:
+    if model is not None:
+      hull_points, simplices = model.HullMesh(w_offset)
+    else:
+      from scipy import spatial
+      inter = np.array(intersections)
+      hull_points, simplices = inter, spatial.ConvexHull(inter).simplices
+  except (RuntimeError, ValueError) as e:
+    # This happens at the ends of the sweep, where the slice is a point or
+    # flat, and with the tetrahedron.  Input is less than 3 dimensional.
+    print('QHull error: %s' % e)
+    return np.zeros((0, 3, 3))
+  return np.asarray(hull_points)[np.asarray(simplices)]
+
+
+def Draw4dSlice(ax, intersections, draw_hull=True, model=None,
+                w_offset=None):
+  """Returns matplotlib objects that can be mutated for animation.
+
   Args:
-    intersections: a list of 4D points
+    intersections: a list of 3D points
+    model: optional slicer.SliceModel that intersections came from, at
+      w_offset.  Its hull triangles are reused between frames.
+
+  Returns:
+    mpl_points: a single Path3DCollection
+    mpl_hull: a single Poly3DCollection with the hull's triangles, drawn as
+      wireframe
   """
-  inter  = np.array(intersections)
-  x = inter[:, 0]  # all rows, first column
-  y = inter[:, 1]
-  z = inter[:, 2]
-  mpl_points = ax.scatter(x, y, z, c='r')
+  from mpl_toolkits.mplot3d import art3d
 
-  if draw_hull:
-    try:
-      hull = spatial.ConvexHull(inter)
-    except RuntimeError as e:
-      # This only seems to happen with the tetrahedron.   Input is less than 3
-      # dimensional.
-      print('QHull error: %s' % e)
-    else:
-      # Plot each triangle
-      for simplex in hull.simplices:
-        # Make it a closed loop!
-        to_plot = np.append(simplex, simplex[0])
-        ax.plot(inter[to_plot, 0], inter[to_plot, 1], inter[to_plot, 2],
-                c='b')
+  inter = np.array(intersections).reshape(-1, 3)
+  mpl_points = ax.scatter(inter[:, 0], inter[:, 1], inter[:, 2], c='r')
 
-  return mpl_points
+  if draw_hull and len(inter):
+    triangles = HullTriangles(intersections, model=model, w_offset=w_offset)
+  else:
+    triangles = np.zeros((0, 3, 3))
+  # One collection for all the triangles.  An ax.plot() call per triangle is
+  # very slow for the 600-cell.
+  mpl_hull = art3d.Poly3DCollection(triangles, facecolors='none',
+                                    edgecolors='b')
+  ax.add_collection3d(mpl_hull)
+
+  return mpl_points, mpl_hull
 
 
 SHAPES_3D = [
@@ -158,7 +172,7 @@ DIM_NAME = ['x', 'y', 'z', 'w']
 
 def ShowBounds():
   for schlafli in SHAPES_3D + SHAPES_4D:
-    vertices, edges_etc = schlafli_interpreter.regular_polytope(schlafli)
+    vertices, edges_etc = polytope_cache.RegularPolytope(schlafli)
     # Transpose.  TODO: Should schlafli return np.array, and then we do this
     # with numpy?
     dimensions = list(zip(*vertices))
@@ -235,8 +249,8 @@ def Tilt4D(vertices):
       [0, 0, sin(theta_zw),  cos(theta_zw) ],
   ])
 
-  # TODO: Do 2 more axes?  There are 6 ways to rotate!  And we should rotate
-  # all of them except 1?
+  # There are 6 ways to rotate!  --rotate-4d animates all of them; see
+  # RotationMatrices4D().
   # http://hollasch.github.io/ray4/Four-Space_Visualization_of_4D_Objects.html#s2.2
 
   # Matrix multiply is @ !
@@ -245,6 +259,92 @@ def Tilt4D(vertices):
   return [np.matmul(rotation, v) for v in vertices]
 
 
+def TiltND(vertices):
+  """
+  Tilt a polytope of any dimension, like Tilt4D.  Rotates in every plane of
+  two axes, so no facet stays parallel to an axis.
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  dim = vertices.shape[1]
+
+  # divide by a prime number to make sure it's not aligned.  The angles stay
+  # below pi, and never reach pi/2.
+  divisor = 23.0
+
+  rotation = np.eye(dim)
+  planes = [(i, j) for i in range(dim) for j in range(i + 1, dim)]
+  for k, (i, j) in enumerate(planes):
+    theta = (k % 22 + 1) * math.pi / divisor
+    plane = np.eye(dim)
+    plane[i, i] = plane[j, j] = cos(theta)
+    plane[i, j] = sin(theta)
+    plane[j, i] = -sin(theta)
+    rotation = plane @ rotation
+  return vertices @ rotation.T
+
+
+# The 6 planes of rotation in 4D, in the order of the columns of the angles
+# passed to RotationMatrices4D().
+ROTATION_PLANES = ['xy', 'xz', 'xw', 'yz', 'yw', 'zw']
+
+
+def ParseRotation(spec, num_frames):
+  """Parse --rotate-4d into the angles of each frame.
+
+  Args:
+    spec: e.g. 'xw=360,yz=0:90'.  Each plane turns from START to END degrees
+      over the run, or from 0 if only END is given.
+    num_frames: number of frames
+
+  Returns:
+    (num_frames, 6) array of radians, one column per plane in ROTATION_PLANES
+  """
+  angles = np.zeros((num_frames, len(ROTATION_PLANES)))
+  for part in spec.split(','):
+    plane, _, schedule = part.strip().partition('=')
+    if plane not in ROTATION_PLANES:
+      raise RuntimeError(
+          'Invalid plane %r in --rotate-4d, expected one of %s' % (
+          plane, ' '.join(ROTATION_PLANES)))
+    try:
+      degrees = [float(d) for d in schedule.split(':')]
+    except ValueError:
+      raise RuntimeError('Invalid angles %r in --rotate-4d' % schedule)
+    if len(degrees) == 1:
+      degrees = [0.0] + degrees
+    if len(degrees) != 2:
+      raise RuntimeError('Invalid angles %r in --rotate-4d' % schedule)
+    angles[:, ROTATION_PLANES.index(plane)] = np.radians(
+        np.linspace(degrees[0], degrees[1], num=num_frames))
+  return angles
+
+
+def RotationMatrices4D(angles):
+  """The rotation matrix of every frame, built in one batch.
+
+  Args:
+    angles: (num_frames, 6) array of radians, as from ParseRotation()
+
+  Returns:
+    (num_frames, 4, 4) array.  Each is the product of the rotations in the 6
+    planes, in the order of ROTATION_PLANES.
+  """
+  angles = np.asarray(angles, dtype=float)
+  num_frames = len(angles)
+  rotations = np.broadcast_to(np.eye(4), (num_frames, 4, 4)).copy()
+  for k, plane in enumerate(ROTATION_PLANES):
+    i, j = 'xyzw'.index(plane[0]), 'xyzw'.index(plane[1])
+    c = np.cos(angles[:, k])
+    s = np.sin(angles[:, k])
+    r = np.broadcast_to(np.eye(4), (num_frames, 4, 4)).copy()
+    r[:, i, i] = c
+    r[:, j, j] = c
+    r[:, i, j] = -s
+    r[:, j, i] = s
+    rotations = r @ rotations
+  return rotations
+
+
 def Translate3D(vertices, z_delta):
   offset = np.array([0, 0, z_delta])
   return [v + offset for v in vertices]
@@ -257,15 +357,17 @@ def Translate4D(vertices, w_delta):
 
 def PrintBounds(vertices):
   """For debugging."""
-  x = [v[0] for v in vertices]
-  y = [v[1] for v in vertices]
-  z = [v[2] for v in vertices]
-  w = [v[3] for v in vertices]
-  print('x: %f - %f' % (min(x), max(x)))
-  print('y: %f - %f' % (min(y), max(y)))
-  print('z: %f - %f' % (min(z), max(z)))
-  print('w: %f - %f' % (min(w), max(w)))
-  #print('w: %s' % sorted(w))
+  vertices = np.asarray(vertices)
+  for d in range(vertices.shape[1]):
+    name = 'xyzw'[d] if d < 4 else 'x%d' % d
+    print('%s: %f - %f' % (name, vertices[:, d].min(), vertices[:, d].max()))
+
+
+def ReadArchive(opts):
+  """The --read-archive, or None."""
+  if not opts.read_archive:
+    return None
+  return geometry_archive.GeometryArchive(opts.read_archive)
 
 
 def Plot(schlafli, opts):
@@ -273,6 +375,8 @@ def Plot(schlafli, opts):
   Plot a polytope with matplotlib.  Inconsistency: This plots in 3D, but
   animates in 4D!
   """
+  import matplotlib.pyplot as plt
+
   #p0 = np.array([0.5, 0.5, 0.5])  # center of the cube
 
   p0 = np.array([0, 0, 0])
@@ -296,7 +400,7 @@ def Plot(schlafli, opts):
   # I think this is because the base case in 1D is (0,), and then it gets
   # extended to (0,0), then (0,0,0), etc.
 
-  vertices, edges_etc = schlafli_interpreter.regular_polytope(schlafli)
+  vertices, edges_etc = polytope_cache.RegularPolytope(schlafli)
 
   vertices = [np.array(v) for v in vertices]
   if 0:
@@ -345,74 +449,16 @@ def Plot(schlafli, opts):
 
   elif len(schlafli) == 3:
     if 1:
-      PrintBounds(vertices)
-
-    # Calculate W range AFTER ROTATION.
-    w = [v[3] for v in vertices]
-    w_offsets = np.linspace(-max(w), -min(w), num=opts.num_frames)
-
-    print('w_offsets:')
-    print(w_offsets)
-
-    #p0 = np.array([0.5, 0.5, 0.5, 0.5])
-    #plane_normal = np.array([1, 2, 2, 1])
-
-    # Set W axis
-    p0 = np.array([0, 0, 0, 0])
-    plane_normal = np.array([0, 0, 0, 1])
-
-    fig = plt.figure()
-    ax = fig.gca(projection='3d')
-
-    # Set axes so they don't move between frames
-    x = [v[0] for v in vertices]
-    y = [v[1] for v in vertices]
-    z = [v[2] for v in vertices]
-
-    x_min, x_max = min(x), max(x)
-    y_min, y_max = min(y), max(y)
-    z_min, z_max = min(z), max(z)
-
-    ax.set_xlim(x_min, x_max)
-    ax.set_ylim(y_min, y_max)
-    ax.set_zlim(z_min, z_max)
-
-    mpl_points = None
-    if 1:
-      print('NEW w_offsets %s' % w_offsets)
-      for i, w_offset in enumerate(w_offsets):
-        print('--- OFFSET %d = %f' % (i, w_offset))
-
-        translated = Translate4D(vertices, w_offset)
-        PrintBounds(translated)
-
-        edges = []
-        for a, b in edge_numbers:
-          edges.append((translated[a], translated[b]))
-
-        intersections = Intersect(edges, plane_normal, p0)
-        print('%d intersections' % len(intersections))
-
-        # Remove w-axis to project onto hyperplane (not strictly necessary)
-        intersections = [np.array(v[:3]) for v in intersections]
-
-        Draw4dSlice(ax, intersections, draw_hull=True)
-
-        if opts.mpl_png_out_template:
-          plt.savefig(opts.mpl_png_out_template % i)
-        else:
-          plt.pause(0.001)
-
-        # Hm this is the only way I can figure out to draw a new Convex hull
-        # on each frame.  There is a ax.collections.remove() hack for the
-        # scatter plot that doesn't seem to work for the triangles
-        ax.cla()  # clear
-        ax.set_xlim(x_min, x_max)
-        ax.set_ylim(y_min, y_max)
-        ax.set_zlim(z_min, z_max)
+      Animate4D(schlafli, opts.num_frames, opts.fps,
+                mp4_out_template=opts.mpl_mp4_out_template,
+                png_out_template=opts.mpl_png_out_template,
+                archive=ReadArchive(opts))
 
     else:
-     # A single plot
+      # A single plot
+      p0 = np.array([0, 0, 0, 0])
+      plane_normal = np.array([0, 0, 0, 1])
+
       vertices = Translate4D(vertices, -0.1)
       edges = []
       for a, b in edge_numbers:
@@ -424,6 +470,8 @@ def Plot(schlafli, opts):
       # Remove w-axis to project onto hyperplane (not strictly necessary)
       intersections = [np.array(v[:3]) for v in intersections]
 
+      fig = plt.figure()
+      ax = fig.add_subplot(111, projection='3d')
       Draw4dSlice(ax, intersections)
       plt.show()
 
@@ -431,128 +479,925 @@ def Plot(schlafli, opts):
     raise AssertionError
 
 
+def AnimationTables3D(vertices, edge_numbers, z_offsets):
+  """Compute every frame of a 3D animation up front.
+
+  Args:
+    vertices: (num_vertices, 3) array
+    edge_numbers: (num_edges, 2) array of vertex indices
+    z_offsets: 1-D array, one per frame
+
+  Returns:
+    segments: (num_frames, num_edges, 2, 3) array of edge endpoints, after
+      Translate3D() by each z offset
+    slices: slicer.Slices of the intersections with the plane z = 0, as 3D
+      points
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  edge_numbers = np.asarray(edge_numbers, dtype=np.intp).reshape(-1, 2)
+  z_offsets = np.asarray(z_offsets, dtype=float)
+
+  segments = np.repeat(vertices[edge_numbers][np.newaxis], len(z_offsets),
+                       axis=0)
+  segments[:, :, :, 2] += z_offsets[:, np.newaxis, np.newaxis]
+
+  slices = slicer.SliceAll(vertices, edge_numbers, z_offsets, axis=2)
+  points = np.zeros((len(slices.points), 3))
+  points[:, :2] = slices.points  # z is 0
+  slices = slicer.Slices(points, slices.offsets, slices.edge_ids)
+  return segments, slices
+
+
 class Animation3D(object):
-  """Callback for matplotlib."""
-
-  def __init__(self, vertices, edge_numbers, z_offsets, mpl_lines,
-               mpl_points):
-    self.vertices = vertices  # list of nparray
-    self.edge_numbers = edge_numbers
-    self.z_offsets = z_offsets  # nparray of z offsets
-    self.mpl_lines = mpl_lines  # drawn edges to mutate
+  """Callback for matplotlib.
+
+  Every frame is computed up front by AnimationTables3D(), so this only
+  assigns data to the artists.
+  """
+
+  def __init__(self, segments, slices, mpl_edges, mpl_points):
+    self.segments = segments  # edge endpoints of each frame
+    self.slices = slices  # intersections of each frame
+    self.mpl_edges = mpl_edges  # drawn edges to mutate: a Line3DCollection
     self.mpl_points = mpl_points  # drawn intersection points to mutate
 
   def __call__(self, frame_index):
-    """Mutate line objects to create a new frame.
+    """Mutate the artists to create a new frame.
 
-    Args:
-      num: from 0 to len(data)
+    Returns the artists, which FuncAnimation needs for blitting.
     """
-    z_offset = self.z_offsets[frame_index]
-    vertices = Translate3D(self.vertices, z_offset)
+    self.mpl_edges.set_segments(self.segments[frame_index])
+
+    # This is horrible!  You have to mutate a private variable
+    # https://stackoverflow.com/questions/41602588/matplotlib-3d-scatter-animations
+    points = self.slices.Frame(frame_index)
+    self.mpl_points._offsets3d = (points[:, 0], points[:, 1], points[:, 2])
 
-    edges = []
-    for a, b in self.edge_numbers:
-      edges.append((vertices[a], vertices[b]))
+    # See Animation4D.
+    if self.mpl_edges.axes.M is not None:
+      self.mpl_edges.do_3d_projection()
+      self.mpl_points.do_3d_projection()
 
-    p0 = np.array([0, 0, 0])
-    plane_normal = np.array([0, 0, 1])
-    intersections = Intersect(edges, plane_normal, p0)
-    print('FRAME %d' % frame_index)
-    print('# intersections: %d' % len(intersections))
+    return self.mpl_edges, self.mpl_points
 
-    for edge, mpl_line in zip(edges, self.mpl_lines):
-      # NOTE: Weird API.  there is no .set_data() for 3 dim data...
-      a, b = edge
-      xy = np.array([
-        [a[0], b[0]],
-        [a[1], b[1]]
-      ])
-      z = np.array([a[2], b[2]])
 
-      mpl_line.set_data(xy)
-      mpl_line.set_3d_properties(z)
+def DrawAnimation3D(fig, segments, slices):
+  """Draw the artists of a 3D animation.  Returns its Animation3D."""
+  from mpl_toolkits.mplot3d import art3d
 
-    # This is horrible!  You have to mutate a private variable
-    # https://stackoverflow.com/questions/41602588/matplotlib-3d-scatter-animations
-    # Maybe I should use ax.plot(marker='o') instead of ax.scatter ?
-    x = [i[0] for i in intersections]
-    y = [i[1] for i in intersections]
-    z = [i[2] for i in intersections]
-    self.mpl_points._offsets3d = (x, y, z)
+  ax = fig.add_subplot(111, projection='3d')
+
+  # Set axes so they don't move between frames
+  ends = segments.reshape(-1, 3)
+  ax.set_xlim(ends[:, 0].min(), ends[:, 0].max())
+  ax.set_ylim(ends[:, 1].min(), ends[:, 1].max())
+  ax.set_zlim(ends[:, 2].min(), ends[:, 2].max())
+
+  mpl_edges = art3d.Line3DCollection(segments[0], colors='b')
+  ax.add_collection3d(mpl_edges)
+  mpl_points = ax.scatter([], [], [], c='r')
+
+  anim_func = Animation3D(segments, slices, mpl_edges, mpl_points)
+  anim_func(0)
+  return anim_func
+
+
+class PngExporter3D(object):
+  """Save frames of a 3D animation as PNGs, without a display.
+
+  Each --jobs worker gets a copy, and draws its own figure with Agg.  Like
+  blitting, the axes are drawn once, and each frame only redraws the edges
+  and points over them.
+  """
+
+  def __init__(self, segments, slices, png_out_template):
+    self.segments = segments
+    self.slices = slices
+    self.png_out_template = png_out_template
+
+    # Set on the first Export() call
+    self.canvas = None
+    self.background = None
+    self.anim_func = None
+
+  def _Draw(self):
+    from matplotlib import figure
+    from matplotlib.backends import backend_agg
+
+    fig = figure.Figure()
+    self.canvas = backend_agg.FigureCanvasAgg(fig)
+    self.anim_func = DrawAnimation3D(fig, self.segments, self.slices)
+
+    artists = (self.anim_func.mpl_edges, self.anim_func.mpl_points)
+    for artist in artists:
+      artist.set_animated(True)  # left out of the background
+    self.canvas.draw()
+    self.background = self.canvas.copy_from_bbox(fig.bbox)
+
+  def Export(self, start, stop):
+    """Save frames [start, stop).  Returns the paths written."""
+    from matplotlib import image
+
+    if self.canvas is None:
+      self._Draw()
 
-    # TODO: plot edges and intersections
+    paths = []
+    for i in range(start, stop):
+      self.canvas.restore_region(self.background)
+      for artist in self.anim_func(i):
+        artist.axes.draw_artist(artist)
+
+      out_path = self.png_out_template % i
+      # Fast compression.  These are usually encoded as video right away.
+      image.imsave(out_path, np.asarray(self.canvas.buffer_rgba()),
+                   pil_kwargs={'compress_level': 1})
+      paths.append(out_path)
+    return paths
+
+
+# The PngExporter3D of a pool worker process
+_png_exporter = None
+
+
+def _InitPngWorker(exporter):
+  global _png_exporter
+  _png_exporter = exporter
+
+
+def _ExportPngBlockInWorker(block):
+  start, stop = block
+  return _png_exporter.Export(start, stop)
+
+
+def ExportPngs3D(exporter, num_frames, jobs):
+  """Save every frame, splitting the frames across jobs processes."""
+  # A few blocks per worker, like GenFrameJobs
+  block_size = max(1, num_frames // (4 * jobs))
+  blocks = [(start, min(start + block_size, num_frames))
+            for start in range(0, num_frames, block_size)]
+
+  if jobs <= 1:
+    for start, stop in blocks:
+      for path in exporter.Export(start, stop):
+        print('Wrote %s' % path)
     return
-    # TODO:
-    # - Do translation here!
-    # - Do intersection here!
-    # Set mpl_lines
-    for data, line in zip(self.data, self.lines):
-      # NOTE: Weird API.  there is no .set_data() for 3 dim data...
-      xy = data[0:2, num:num+2]
-      z = data[2, num:num+2]
 
-      line.set_data(xy)
-      line.set_3d_properties(z)
+  pool = multiprocessing.Pool(jobs, initializer=_InitPngWorker,
+                              initargs=(exporter,))
+  try:
+    for paths in pool.imap(_ExportPngBlockInWorker, blocks):
+      for path in paths:
+        print('Wrote %s' % path)
+  except BaseException:
+    pool.terminate()
+    raise
+  else:
+    pool.close()
+  finally:
+    pool.join()
+
+
+def EncodeMp4(png_out_template, fps, out_path):
+  """Encode numbered PNGs as an .mp4 with ffmpeg, like video-bathroom-ffmpeg
+  in run.sh."""
+  argv = [
+      'ffmpeg', '-y', '-loglevel', 'error',
+      '-framerate', str(fps),
+      '-i', png_out_template,  # ffmpeg understands %03d too
+      '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+      out_path,
+  ]
+  try:
+    status = subprocess.call(argv)
+  except OSError as e:
+    raise RuntimeError("Couldn't run ffmpeg: %s" % e)
+  if status != 0:
+    raise RuntimeError('ffmpeg failed with status %d' % status)
 
 
-def Animate3D(schlafli, num_frames, fps, mp4_out_template=None):
-  vertices, edges_etc = schlafli_interpreter.regular_polytope(schlafli)
+def Animate3D(schlafli, num_frames, fps, mp4_out_template=None,
+              png_out_template=None, jobs=1):
+  """Animate a 3D polytope moving through the plane z = 0.
+
+  With mp4_out_template or png_out_template, the frames are saved as PNGs by
+  jobs processes, without a display, and the PNGs are encoded with ffmpeg.
+  Otherwise the animation is shown.
+  """
+  vertices, edges_etc = polytope_cache.RegularPolytope(schlafli)
   vertices = [np.array(v) for v in vertices]
 
   # Tilt everything a bit
-  vertices = Tilt3D(vertices)
+  vertices = np.array(Tilt3D(vertices))
 
   # Calculate Z range AFTER ROTATION.
-  z = [v[2] for v in vertices]
-  z_offsets = np.linspace(-max(z), -min(z), num=num_frames)
+  z = vertices[:, 2]
+  z_offsets = np.linspace(-z.max(), -z.min(), num=num_frames)
   print('z_offsets:')
   print(z_offsets)
 
-  edge_numbers = edges_etc[0]
-  edges = []
-  for a, b in edge_numbers:
-    edges.append((vertices[a], vertices[b]))
+  segments, slices = AnimationTables3D(vertices, edges_etc[0], z_offsets)
 
-  # TODO: Do we need initial intersections?  We could just make
-  # dummy Line3D instances?  Just create a fake data set.
-  p0 = np.array([0, 0, 0])
-  plane_normal = np.array([0, 0, 1])
-  intersections = Intersect(edges, plane_normal, p0)
+  if mp4_out_template or png_out_template:
+    tmp_dir = None
+    if not png_out_template:
+      tmp_dir = tempfile.mkdtemp(prefix='polytope-anim-')
+      png_out_template = os.path.join(tmp_dir, 'frame%05d.png')
+    try:
+      exporter = PngExporter3D(segments, slices, png_out_template)
+      ExportPngs3D(exporter, num_frames, jobs)
+      if mp4_out_template:
+        # https://jakevdp.github.io/blog/2013/02/16/animating-the-lorentz-system-in-3d
+        out_path = mp4_out_template % tuple(schlafli)
+        EncodeMp4(png_out_template, fps, out_path)
+        print('Wrote %s' % out_path)
+    finally:
+      if tmp_dir:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return
+
+  import matplotlib.animation as animation
+  import matplotlib.pyplot as plt
 
   fig = plt.figure()
-  ax = fig.gca(projection='3d')  # create 3d axes?
+  anim_func = DrawAnimation3D(fig, segments, slices)
+
+  # Just creating this object seems to mutate global state.
+  anim = animation.FuncAnimation(fig, anim_func, num_frames,
+                                 interval=1000.0 / fps,
+                                 blit=fig.canvas.supports_blit)
+  plt.show()
 
-  # Draw the initial frame -- calls ax.plot()
-  plane = None
-  mpl_lines, mpl_points = Draw(ax, edges, plane, intersections)
 
-  # Now mutate these objects to animate.
-  anim_func = Animation3D(vertices, edge_numbers, z_offsets, mpl_lines,
-                          mpl_points)
+class Animation4D(object):
+  """Callback for matplotlib.
+
+  Unlike Animation3D, the number of intersections changes between frames, so
+  the scatter points and hull triangles are replaced wholesale.  They're
+  still the same two artists, so nothing else on the axes is redrawn.
+  """
+
+  def __init__(self, model, w_offsets, mpl_points, mpl_hull):
+    self.model = model  # slicer.SliceModel
+    self.w_offsets = w_offsets  # nparray of w offsets
+    self.mpl_points = mpl_points  # drawn intersection points to mutate
+    self.mpl_hull = mpl_hull  # drawn hull triangles to mutate
+
+    # frame index -> (points, triangles).  The animation loops, and after the
+    # first loop every frame comes from here.
+    self.frames = {}
+
+  def Frame(self, frame_index):
+    """Returns the intersections and hull triangles of a frame."""
+    if frame_index not in self.frames:
+      w_offset = self.w_offsets[frame_index]
+      intersections = self.model.Intersections(w_offset)
+      print('FRAME %d: %d intersections' % (frame_index, len(intersections)))
+
+      points = np.array(intersections).reshape(-1, 3)
+      if len(points):
+        triangles = HullTriangles(intersections, model=self.model,
+                                  w_offset=w_offset)
+      else:
+        triangles = np.zeros((0, 3, 3))
+      self.frames[frame_index] = points, triangles
+    return self.frames[frame_index]
+
+  def __call__(self, frame_index):
+    """Mutate the artists to create a new frame.
+
+    Returns the artists, which FuncAnimation needs for blitting.
+    """
+    points, triangles = self.Frame(frame_index)
+
+    # Mutating a private variable, like Animation3D.
+    self.mpl_points._offsets3d = (points[:, 0], points[:, 1], points[:, 2])
+    self.mpl_hull.set_verts(triangles)
+
+    # When blitting, only these artists are drawn, and Axes3D.draw() isn't
+    # there to project them.  (Before the first draw, there's no projection
+    # yet, and Axes3D.draw() will do it.)
+    if self.mpl_hull.axes.M is not None:
+      self.mpl_points.do_3d_projection()
+      self.mpl_hull.do_3d_projection()
+
+    return self.mpl_points, self.mpl_hull
 
-  # Just creating this object seems to mutate global state.
-  anim = animation.FuncAnimation(fig, anim_func, num_frames, interval=300)
+
+class ArchiveAnimation4D(Animation4D):
+  """Animation4D of the meshes in a geometry_archive.GeometryArchive.
+
+  The faces are drawn as they are, e.g. the polygons of --mesh lattice.
+  """
+
+  def __init__(self, archive, mpl_points, mpl_hull):
+    Animation4D.__init__(self, None, None, mpl_points, mpl_hull)
+    self.archive = archive
+
+  def Frame(self, frame_index):
+    if frame_index not in self.frames:
+      vertices, faces = self.archive.Frame(frame_index)
+      if isinstance(faces, np.ndarray):
+        polygons = vertices[faces]
+      else:
+        polygons = [vertices[face] for face in faces]
+      self.frames[frame_index] = vertices, polygons
+    return self.frames[frame_index]
+
+
+def Animate4D(schlafli, num_frames, fps, mp4_out_template=None,
+              png_out_template=None, archive=None):
+  """Animate slices of a 4D polytope, or the meshes in an archive."""
+  if archive:
+    num_frames = archive.num_frames
+    lo, hi = archive.Bounds()
+  else:
+    vertices, edges_etc = polytope_cache.RegularPolytope(schlafli)
+    vertices = np.array(Tilt4D([np.array(v) for v in vertices]))
+    PrintBounds(vertices)
+
+    # Calculate W range AFTER ROTATION.
+    w = vertices[:, 3]
+    w_offsets = np.linspace(-w.max(), -w.min(), num=num_frames)
+    print('w_offsets:')
+    print(w_offsets)
+
+    lattice = slicer.FaceLattice(edges_etc, len(vertices))
+    model = slicer.SliceModel(lattice, vertices, axis=3)
+    lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+
+  import matplotlib.animation as animation
+  import matplotlib.pyplot as plt
+
+  fig = plt.figure()
+  ax = fig.add_subplot(111, projection='3d')
+
+  # Set axes so they don't move between frames
+  ax.set_xlim(lo[0], hi[0])
+  ax.set_ylim(lo[1], hi[1])
+  ax.set_zlim(lo[2], hi[2])
+
+  # Draw empty artists once, then mutate them to animate.
+  mpl_points, mpl_hull = Draw4dSlice(ax, [])
+  if archive:
+    anim_func = ArchiveAnimation4D(archive, mpl_points, mpl_hull)
+  else:
+    anim_func = Animation4D(model, w_offsets, mpl_points, mpl_hull)
+
+  if png_out_template:
+    for i in range(num_frames):
+      anim_func(i)
+      out_path = png_out_template % i
+      fig.savefig(out_path)
+      print('Wrote %s' % out_path)
 
   if mp4_out_template:
-  # https://jakevdp.github.io/blog/2013/02/16/animating-the-lorentz-system-in-3d
+    anim = animation.FuncAnimation(fig, anim_func, num_frames,
+                                   interval=1000.0 / fps)
     out_path = mp4_out_template % tuple(schlafli)
-    # 4 FPS shows it better
     anim.save(out_path, fps=fps, extra_args=['-vcodec', 'libx264'])
     print('Wrote %s' % out_path)
-  else:
+
+  if not png_out_template and not mp4_out_template:
+    # Blitting redraws only the two artists, not the axes, panes and ticks.
+    anim = animation.FuncAnimation(fig, anim_func, num_frames,
+                                   interval=1000.0 / fps,
+                                   blit=fig.canvas.supports_blit)
     plt.show()
 
 
+def CameraPath(camera, num_frames):
+  """The --camera path of each frame.
+
+  Returns:
+    dict with an (num_frames, 3) array of eye positions, and of look-at
+    points and up vectors if the path moves them.  See rotate.py.
+  """
+  return rotate.camera_path(rotate.load_camera(camera), num_frames)
+
+
+# Template fields for a camera path's look-at point and up vector.
+CAMERA_FIELDS = {
+    'look_at': ('look_x', 'look_y', 'look_z'),
+    'up': ('up_x', 'up_y', 'up_z'),
+}
+
+
+def CheckCameraFields(camera, path, field_names, template_name):
+  """Make sure the template uses the parts of the camera path that move, and
+  that the path has the parts the template uses."""
+  for name, fields in CAMERA_FIELDS.items():
+    used = any(field in field_names for field in fields)
+    if used and name not in path:
+      raise RuntimeError('%s uses %%(%s)s, but --camera %s has no %s track' % (
+                         template_name, fields[0], camera, name))
+    moving = name in path and (path[name] != path[name][0]).any()
+    if moving and not used:
+      raise RuntimeError(
+          '--camera %s moves %s, but %s has a fixed LookAt.  Use %s in its '
+          'LookAt.' % (camera, name, template_name,
+                       ' '.join('%%(%s)f' % field for field in fields)))
+
+
+def PlyAngles(num_frames):
+  """Angles for --ply-rotation, one per frame."""
+  # Very small angle because the dodecahedron isn't centered
+  #ply_angles = np.linspace(0, 10, num_frames)
+  return np.linspace(-10, 0, num_frames)
+
+
+# How each frame template places the camera and the polytope mesh, so that
+# previews are framed like the pbrt render.  The camera eye comes from
+# CameraPath(), and so do the look-at point and up vector if it moves them.
+PREVIEW_VIEWS = {
+    'polytope-frame.template': {
+        'look_at': (0.5, 0.5, 0),
+        'up': (0, 0, 1),
+        'fov': 45,
+        'mirror_x': False,
+        'translate': (0, 0, 0),
+        'scale': 0.5,
+    },
+    '4d-contemporary-bathroom.template': {
+        'look_at': (-0.8, 1.1, -0.9),
+        'up': (0, 1, 0),
+        'fov': 70,
+        'mirror_x': True,  # Scale -1 1 1 before LookAt
+        'translate': (-1.6, 1.2, -1.8),
+        'scale': 0.14,
+    },
+}
+
+
+def RotateY(vertices, degrees):
+  """Like pbrt's 'Rotate <degrees> 0 1 0'."""
+  theta = math.radians(degrees)
+  rotation = np.array([
+      [ cos(theta), 0, sin(theta)],
+      [          0, 1,          0],
+      [-sin(theta), 0, cos(theta)],
+  ])
+  return vertices @ rotation.T
+
+
+def SweepPolytope(schlafli, num_frames):
+  """The 4D polytope that the 'pbrt' and 'preview' actions slice.
+
+  A 5D or higher polytope is first tilted, and cut down to 4D by a
+  hyperplane through its center for each extra axis.
+
+  Returns:
+    vertices: (num_vertices, 4) array
+    edges_etc: [edges, faces, cells], or just [edges] for a 5D or higher
+      polytope
+    w_offsets: one per frame
+  """
+  vertices, edges_etc = polytope_cache.RegularPolytope(schlafli)
+  vertices = np.array(vertices)
+
+  if len(schlafli) == 3:
+    # Calculate W range AFTER ROTATION.
+    w = vertices[:, 3]
+    w_offsets = np.linspace(-max(w), -min(w), num=num_frames)
+    return vertices, edges_etc, w_offsets
+
+  # Slices of the simplex, hypercube and orthoplex along their axes are all
+  # the same shape.
+  vertices = TiltND(vertices)
+  extra_axes = list(range(4, vertices.shape[1]))
+  vertices, edges = slicer.Section(vertices, edges_etc, extra_axes,
+                                   -vertices[:, 4:].mean(axis=0))
+
+  # The ends of the sweep only touch a vertex, which has no hull.
+  w = vertices[:, 3]
+  w_offsets = np.linspace(-w.max(), -w.min(), num=num_frames + 2)[1:-1]
+  return vertices, [edges], w_offsets
+
+
+def MakeModel(opts, vertices, edges_etc, w_offsets):
+  """The slicer.SliceModel of a run, or a RotatingModel with --rotate-4d.
+
+  A SliceModel's methods take the w offset, and a RotatingModel's take the
+  frame index.
+  """
+  lattice = slicer.FaceLattice(edges_etc, len(vertices))
+  if opts.rotate_4d:
+    rotations = RotationMatrices4D(
+        ParseRotation(opts.rotate_4d, len(w_offsets)))
+    return slicer.RotatingModel(lattice, vertices, rotations, w_offsets,
+                                axis=3)
+  return slicer.SliceModel(lattice, vertices, axis=3)
+
+
+def Preview(opts, argv):
+  """Rasterize each frame's slice to a PNG, without pbrt or matplotlib.
+
+  Uses the same camera as the 'pbrt' action, to check the motion and framing
+  of a run before rendering it.  With --read-archive, it shows the meshes
+  that were generated, without the polytope.
+  """
+  template_name = os.path.basename(opts.frame_template)
+  try:
+    view = PREVIEW_VIEWS[template_name]
+  except KeyError:
+    raise RuntimeError("Don't know how to preview %r" % template_name)
+
+  archive = ReadArchive(opts)
+  if archive:
+    num_frames = archive.num_frames
+  else:
+    schlafli = [int(a) for a in argv[1:]]  # e.g. 5 3 3 for 120-cell
+    if len(schlafli) < 3:
+      raise RuntimeError(
+          '3 or more args required (e.g. "5 3 3" for 120-cell, "4 3 3 3" '
+          'for 5-cube)')
+    if len(schlafli) > 3 and opts.mesh == 'lattice':
+      raise RuntimeError('--mesh lattice only works for 4D polytopes')
+
+    num_frames = opts.num_frames
+    vertices, edges_etc, w_offsets = SweepPolytope(schlafli, num_frames)
+    model = MakeModel(opts, vertices, edges_etc, w_offsets)
+    rotating = isinstance(model, slicer.RotatingModel)
+
+  camera = CameraPath(opts.camera, num_frames)
+  ply_angles = PlyAngles(num_frames)
+
+  start_time = time.time()
+  for i in range(num_frames):
+    if archive:
+      mesh_vertices, polygons = archive.Frame(i)
+      faces = slicer.Triangulate(polygons)
+    else:
+      at = i if rotating else w_offsets[i]
+      if opts.mesh == 'lattice':
+        mesh_vertices, polygons = model.CrossSection(at)
+        faces = slicer.Triangulate(polygons)
+      elif opts.merge_faces:
+        mesh_vertices, polygons = model.MergedHullMesh(at)
+        faces = slicer.Triangulate(polygons)
+      else:
+        try:
+          mesh_vertices, faces = model.HullMesh(at)
+        except (RuntimeError, ValueError) as e:
+          print('QHull error in frame %d: %s' % (i, e))
+          mesh_vertices = np.zeros((0, 3))
+          faces = np.zeros((0, 3), dtype=int)
+
+    mesh_vertices = (np.array(view['translate']) +
+                     view['scale'] * mesh_vertices)
+    if opts.ply_rotation:
+      mesh_vertices = RotateY(mesh_vertices, ply_angles[i])
+
+    look_at = camera['look_at'][i] if 'look_at' in camera else view['look_at']
+    up = camera['up'][i] if 'up' in camera else view['up']
+    image = raster.rasterize(
+        mesh_vertices, faces, camera['eye'][i], look_at, up, view['fov'],
+        opts.width, opts.height, mirror_x=view['mirror_x'])
+
+    out_path = os.path.join(
+        opts.out_dir, opts.out_template % i + '.preview.png')
+    with open(out_path, 'wb') as f:
+      raster.write_png(f, image)
+    print('Wrote %s' % out_path)
+
+  elapsed = time.time() - start_time
+  print('%d frames in %.2f seconds (%.1f fps)' % (
+        num_frames, elapsed, num_frames / elapsed))
+
+
+# Frames are generated this many at a time by each --jobs worker.
+FRAME_BLOCK_SIZE = 16
+
+
+class FrameGenerator(object):
+  """Writes the .ply and .pbrt files for the frames of GenPbrt.
+
+  It holds everything that's the same for every frame, so that a process pool
+  gets it once per worker rather than once per frame.
+  """
+
+  def __init__(self, opts, vertices, edges_etc, w_offsets, template):
+    self.opts = opts
+    self.vertices = np.array(vertices)
+    self.w_offsets = w_offsets
+    self.template = template  # scene_template.FrameTemplate
+
+    self.camera = CameraPath(opts.camera, opts.num_frames)
+    CheckCameraFields(opts.camera, self.camera, template.field_names,
+                      os.path.basename(opts.frame_template))
+    self.ply_angles = PlyAngles(opts.num_frames)
+    self.model = MakeModel(opts, self.vertices, edges_etc, w_offsets)
+    self.rotating = isinstance(self.model, slicer.RotatingModel)
+
+  def GenBlock(self, start, stop):
+    """Generate frames [start, stop).
+
+    Returns:
+      log: text to print
+      jobs: list of pipeline.FrameJob
+      records: list of --profile records, one per frame
+      meshes: list of (vertices, faces) for the --geometry-archive, one per
+        frame, or empty
+    """
+    log = []
+    records = []
+    meshes = []
+    jobs = []
+    for i in range(start, stop):
+      if i == self.opts.profile_frame:
+        # Dump the frame's Python profile, e.g. for snakeviz or pstats.
+        prof = cProfile.Profile()
+        jobs.append(prof.runcall(self.GenFrame, i, log, records, meshes))
+        prof.dump_stats(CProfilePath(self.opts, i))
+      else:
+        jobs.append(self.GenFrame(i, log, records, meshes))
+    return ''.join(log), jobs, records, meshes
+
+  def GenFrame(self, i, log, records, meshes):
+    opts = self.opts
+    w_offset = self.w_offsets[i]
+    if opts.profile:
+      timer = profiling.FrameTimer(i, w_offset=float(w_offset))
+    else:
+      timer = profiling.NULL_TIMER
+
+    log.append('--- OFFSET %d = %f\n' % (i, w_offset))
+    at = i if self.rotating else w_offset  # See MakeModel()
+    # The w-axis is removed, which projects the points onto the hyperplane.
+    intersections = self.model.Intersections(at)
+    log.append('%d intersections\n' % len(intersections))
+    timer.Lap('intersect')
+    if opts.profile:
+      if self.rotating or self.model.IntervalIndex(w_offset) == -1:
+        edges_tested = len(self.model.lattice.edges)
+      else:
+        edges_tested = len(intersections)  # Only the cut edges
+      timer.Count('edges_tested', edges_tested)
+      timer.Count('intersections', len(intersections))
+
+    ply_filename = opts.out_template % i + '.ply'
+
+    ply_out_path = os.path.join(opts.out_dir, ply_filename)
+    pbrt_out_path = os.path.join(
+        opts.out_dir, opts.out_template % i + '.pbrt')
+
+    if opts.exr:
+      out_filename = os.path.join(
+          opts.out_dir, opts.out_template % i + '.exr')
+    else:
+      out_filename = os.path.join(
+          opts.out_dir, opts.out_template % i + '.png')
+
+    if opts.mesh == 'lattice':
+      # Polygons from the face lattice, without a ConvexHull.  pbrt only
+      # reads triangles and quads.
+      mesh_vertices, faces = self.model.CrossSection(at)
+      faces = slicer.SplitPolygons(faces)
+    elif opts.merge_faces:
+      # Each face of the hull as one polygon, instead of qhull's triangles.
+      mesh_vertices, faces = self.model.MergedHullMesh(at)
+      faces = slicer.SplitPolygons(faces)
+    else:
+      # The ConvexHull, reused between frames where the slice has the same
+      # shape.
+      mesh_vertices, faces = self.model.HullMesh(at)
+    timer.Lap('mesh')
+    timer.Count('mesh_vertices', len(mesh_vertices))
+    timer.Count('mesh_faces', len(faces))
+
+    ply_bytes = PlyBytes(opts, mesh_vertices, faces)
+    timer.Lap('ply')
+
+    ply_angle = self.ply_angles[i]
+    eye = self.camera['eye'][i]
+    look_at = self.camera['look_at'][i] if 'look_at' in self.camera else None
+    up = self.camera['up'][i] if 'up' in self.camera else None
+    fields = FrameFields(opts, out_filename, ply_filename, eye, ply_angle,
+                         look_at=look_at, up=up)
+    pbrt_text = self.template.Expand(fields)
+    timer.Lap('template')
+
+    # The key covers the shared world too, so it's the same with and without
+    # --shared-world.
+    if self.template.shared_files:
+      key = pipeline.FrameKey(ply_bytes, self.template.ExpandAll(fields))
+    else:
+      key = pipeline.FrameKey(ply_bytes, pbrt_text)
+    timer.Lap('key')
+
+    # Files that come out the same as last time are left alone, so their
+    # images are still up to date.
+    outputs = [(pbrt_out_path, pbrt_text.encode('utf-8'))]
+    if opts.geometry_archive:
+      # The .ply is exported from the archive before rendering.  Its key is
+      # still the same.
+      meshes.append((mesh_vertices, faces))
+    else:
+      outputs.insert(0, (ply_out_path, ply_bytes))
+    for path, data in outputs:
+      if pipeline.WriteIfChanged(path, data):
+        log.append('Wrote %s\n' % path)
+        timer.Count('bytes_written', len(data))
+      else:
+        log.append('Unchanged %s\n' % path)
+        timer.Count('bytes_unchanged', len(data))
+    timer.Lap('write')
+
+    if opts.profile:
+      records.append(timer.Record())
+
+    params = {
+        'w_offset': float(w_offset),
+        'eye': [float(x) for x in eye],
+        'ply_angle': float(ply_angle),
+    }
+    if look_at is not None:
+      params['look_at'] = [float(x) for x in look_at]
+    if up is not None:
+      params['up'] = [float(x) for x in up]
+    return pipeline.FrameJob(i, pbrt_out_path, out_filename, key, params)
+
+
+def RunFields(opts):
+  """Template fields that are the same for every frame."""
+  return {
+      'width': opts.width,
+      'height': opts.height,
+      'pixel_samples': opts.pixel_samples,
+      'integrator_depth': opts.integrator_depth,
+  }
+
+
+def FrameFields(opts, out_filename, ply_filename, eye, ply_angle,
+                look_at=None, up=None):
+  """Returns all the template fields of a frame.
+
+  look_at and up are only given if the --camera path moves them.
+  """
+  if opts.ply_rotation:
+    # Rotate about Y axis, which is pointing up.
+    ply_rotation = 'Rotate %f 0 1 0' % ply_angle
+  else:
+    ply_rotation = ''
+
+  d = {
+      'out_filename': out_filename,
+      'ply_filename': ply_filename,
+      'eye_x': eye[0],
+      'eye_y': eye[1],
+      'eye_z': eye[2],
+      'ply_rotation': ply_rotation,
+  }
+  for name, point in (('look_at', look_at), ('up', up)):
+    if point is not None:
+      d.update(zip(CAMERA_FIELDS[name], point))
+  d.update(RunFields(opts))
+  return d
+
+
+# The FrameGenerator of a pool worker process
+_frame_generator = None
+
+
+def _InitFrameWorker(gen):
+  global _frame_generator
+  _frame_generator = gen
+
+
+def CProfilePath(opts, i):
+  """Where --profile-frame dumps the Python profile of frame i."""
+  return '%s.frame%d.prof' % (opts.profile, i)
+
+
+def _GenFrameBlockInWorker(block):
+  start, stop = block
+  return _frame_generator.GenBlock(start, stop)
+
+
+def _FinishBlock(result, profile_log, archive):
+  """Print a block's log, record its profile, and append its meshes to the
+  archive.  Returns its FrameJobs."""
+  log, jobs, records, meshes = result
+  sys.stdout.write(log)
+  if profile_log:
+    for record in records:
+      profile_log.Frame(record)
+  if archive:
+    for vertices, faces in meshes:
+      archive.Append(vertices, faces)
+  return jobs
+
+
+def GenFrameJobs(gen, opts, profile_log=None, archive=None):
+  """Generate every frame, yielding a FrameJob as soon as each is written.
+
+  The log and --profile records are written in frame order.  With --jobs, a
+  few blocks per worker are generated ahead of the consumer, but no more, so
+  a slow consumer (e.g. a RenderStage) holds back generation.
+  """
+  # A few blocks per worker, so they finish at about the same time.
+  block_size = max(1, min(FRAME_BLOCK_SIZE,
+                          opts.num_frames // (4 * opts.jobs)))
+  blocks = [(start, min(start + block_size, opts.num_frames))
+            for start in range(0, opts.num_frames, block_size)]
+
+  if opts.jobs <= 1:
+    for start, stop in blocks:
+      for job in _FinishBlock(gen.GenBlock(start, stop), profile_log,
+                                archive):
+        yield job
+    return
+
+  # Each worker gets the generator once.
+  pool = multiprocessing.Pool(opts.jobs, initializer=_InitFrameWorker,
+                              initargs=(gen,))
+  pending = collections.deque()
+  try:
+    for block in blocks:
+      pending.append(pool.apply_async(_GenFrameBlockInWorker, (block,)))
+      if len(pending) < 2 * opts.jobs:
+        continue
+      for job in _FinishBlock(pending.popleft().get(), profile_log,
+                                archive):
+        yield job
+    while pending:
+      for job in _FinishBlock(pending.popleft().get(), profile_log,
+                                archive):
+        yield job
+  except BaseException:
+    pool.terminate()
+    raise
+  else:
+    pool.close()
+  finally:
+    pool.join()
+
+
+def PlyBytes(opts, vertices, faces):
+  """A frame's mesh in the --ply-format."""
+  return geometry_archive.PlyBytes(
+      vertices, faces, ply_format=opts.ply_format,
+      ply_precision=opts.ply_precision, ply_normals=opts.ply_normals)
+
+
+# Options that affect the generated files.  Recorded in the manifest.
+MANIFEST_OPTIONS = [
+    'width', 'height', 'pixel_samples', 'integrator_depth', 'num_frames',
+    'frame_template', 'out_template', 'camera', 'ply_rotation', 'exr',
+    'mesh', 'ply_format', 'ply_precision', 'ply_normals', 'shared_world',
+    'rotate_4d', 'geometry_archive', 'merge_faces',
+]
+
+
+def WriteManifest(opts, schlafli, jobs):
+  """Record the key and parameters of every frame.
+
+  Frames of the last run with the same --out-template that this run didn't
+  generate (e.g. with fewer --num-frames) are removed.
+  """
+  old_manifest = pipeline.ReadManifest(opts.out_dir)
+
+  manifest = {
+      'schlafli': schlafli,
+      'options': dict((name, getattr(opts, name)) for name in MANIFEST_OPTIONS),
+      'frames': [
+          {'index': job.index, 'pbrt': job.pbrt_path, 'image': job.image_path,
+           'key': job.key, 'params': job.params}
+          for job in jobs],
+  }
+  data = json.dumps(manifest, indent=2, sort_keys=True) + '\n'
+  pipeline.WriteIfChanged(os.path.join(opts.out_dir, pipeline.MANIFEST),
+                          data.encode('utf-8'))
+
+  if (old_manifest is None or
+      old_manifest['options']['out_template'] != opts.out_template):
+    return
+  new_frames = pipeline.ManifestFrames(manifest)
+  for name, frame in pipeline.ManifestFrames(old_manifest).items():
+    if name in new_frames:
+      continue
+    pbrt_path = os.path.join(opts.out_dir, name)
+    ply_path = os.path.splitext(pbrt_path)[0] + '.ply'
+    for path in (pbrt_path, ply_path, frame['image']):
+      if os.path.exists(path):
+        os.remove(path)
+        print('Removed stale %s' % path)
+
+
 def GenPbrt(opts, argv):
   """Generate a series of PBRT files."""
 
   schlafli = [int(a) for a in argv[1:]]  # e.g. 4 3 3 for hypercube
-  if len(schlafli) not in (2, 3):
-    raise RuntimeError('2 or 3 args required (e.g. "4 3" for cube)')
-
-  vertices, edges_etc = schlafli_interpreter.regular_polytope(schlafli)
-  vertices = [np.array(v) for v in vertices]
+  if len(schlafli) < 2:
+    raise RuntimeError(
+        '2 or more args required (e.g. "4 3" for cube, "4 3 3 3" for 5-cube)')
+  if len(schlafli) > 3 and opts.mesh == 'lattice':
+    raise RuntimeError('--mesh lattice only works for 4D polytopes')
+  if opts.geometry_archive and opts.render_cmd:
+    raise RuntimeError(
+        "--geometry-archive doesn't write the .ply files that --render-cmd "
+        "needs.  Render with render_executor.py, which exports them.")
+
+  profile_log = profiling.ProfileLog(opts.profile) if opts.profile else None
 
   if len(schlafli) == 2:  # Just plot a polygon
     # Example: ./polytope.py pbrt foo.ply 4 3
@@ -560,7 +1405,7 @@ def GenPbrt(opts, argv):
     if len(schlafli) not in (2, 3):
       raise RuntimeError('2 or 3 args required (e.g. "4 3" for cube)')
 
-    vertices, edges_etc = schlafli_interpreter.regular_polytope(schlafli)
+    vertices, edges_etc = polytope_cache.RegularPolytope(schlafli)
     vertices = [np.array(v) for v in vertices]
 
     vertices = Tilt3D(vertices)
@@ -573,18 +1418,15 @@ def GenPbrt(opts, argv):
 
     print('Wrote %s' % out_path)
 
-  elif len(schlafli) == 3:  # Animate the 4D case
-    # Calculate W range AFTER ROTATION.
-    w = [v[3] for v in vertices]
-    w_offsets = np.linspace(-max(w), -min(w), num=opts.num_frames)
+  else:  # Animate the 4D case, or 5D and up cut down to 4D
+    start_time = time.time()
+    vertices, edges_etc, w_offsets = SweepPolytope(schlafli, opts.num_frames)
+    if profile_log:
+      profile_log.Setup('regular_polytope', time.time() - start_time)
 
     print('w_offsets:')
     print(w_offsets)
 
-    # Set W axis
-    p0 = np.array([0, 0, 0, 0])
-    plane_normal = np.array([0, 0, 0, 1])
-
     # Set axes so they don't move between frames
     x = [v[0] for v in vertices]
     y = [v[1] for v in vertices]
@@ -595,113 +1437,79 @@ def GenPbrt(opts, argv):
     z_min, z_max = min(z), max(z)
 
     with open(opts.frame_template) as f:
-      pbrt_template = f.read()
-
-    if opts.camera == 'fixed':
-      orig_eye = np.array([-0.5, 1.1, -0.5])
-      eye_points = np.array([orig_eye for _ in range(opts.num_frames)])
-
-    elif opts.camera == '120cell':
-      # These two values from the original convex-render.pbrt file
-      orig_eye = np.array([3, 3, 2])
-      look_at = np.array([0.5, 0.5, 0])
-      radius = rotate.distance(look_at, orig_eye)
-
-      # Rotate a quarter turn
-      eye_points = rotate.circle(look_at, radius, opts.num_frames,
-                                 max_angle=math.pi/2)
-
-    elif opts.camera == 'bathroom':
-      # These two values from 4d-*.template file
-      # LookAt -.5 1.1 -.5  # 0 1.25 -.5  # eye position
-      # -.8 1.1 -.9 # -.5 1.25 -.9 is towards mirror (lookat point)
-
-      orig_eye = np.array([-0.5, 1.1, -0.5])
-      look_at = np.array([-0.8, 1.1, -0.9])
-      radius = rotate.distance(look_at, orig_eye)
-
-      #min_angle = math.pi/8
-      #max_angle = 2 * math.pi/8
-
-      min_angle = 3 * math.pi/16
-      max_angle = 6 * math.pi/16
-
-      # Rotate in XZ plane, since "up" vector is Y.
-      eye_points = rotate.arc_xz(look_at, radius, opts.num_frames,
-                                 min_angle, max_angle)
-      #print('DONE')
-      #return
-    else:
-      raise RuntimeError('Invalid camera %r' % opts.camera)
+      template = scene_template.FrameTemplate(
+          f.read(), os.path.splitext(os.path.basename(opts.frame_template))[0],
+          run_fields=RunFields(opts), shared_world=opts.shared_world)
+    for filename, text in template.shared_files:
+      path = os.path.join(opts.out_dir, filename)
+      if pipeline.WriteIfChanged(path, text.encode('utf-8')):
+        print('Wrote %s' % path)
+      else:
+        print('Unchanged %s' % path)
 
-    # Very small angle because the dodecahedron isn't centered
-    #ply_angles = np.linspace(0, 10, opts.num_frames)
-    ply_angles = np.linspace(-10, 0, opts.num_frames)
+    start_time = time.time()
+    gen = FrameGenerator(opts, vertices, edges_etc, w_offsets, template)
+    if profile_log:
+      profile_log.Setup('slice_model', time.time() - start_time)
 
     print('NEW w_offsets %s' % w_offsets)
-    for i, w_offset in enumerate(w_offsets):
-      print('--- OFFSET %d = %f' % (i, w_offset))
-
-      translated = Translate4D(vertices, w_offset)
-      #PrintBounds(translated)
-
-      edge_numbers = edges_etc[0]
-      edges = []
-      for a, b in edge_numbers:
-        edges.append((translated[a], translated[b]))
-
-      intersections = Intersect(edges, plane_normal, p0)
-      print('%d intersections' % len(intersections))
-
-      # Remove w-axis to project onto hyperplane (not strictly necessary)
-      intersections = [np.array(v[:3]) for v in intersections]
-
-      ply_filename = opts.out_template % i + '.ply'
-
-      ply_out_path = os.path.join(opts.out_dir, ply_filename)
-      pbrt_out_path = os.path.join(
-          opts.out_dir, opts.out_template % i + '.pbrt')
-
-      if opts.exr:
-        out_filename = os.path.join(
-            opts.out_dir, opts.out_template % i + '.exr')
+    jobs = []
+    if not opts.render_cmd:
+      if opts.geometry_archive:
+        archive_path = os.path.join(opts.out_dir, opts.geometry_archive)
+        archive = geometry_archive.ArchiveWriter(archive_path)
       else:
-        out_filename = os.path.join(
-            opts.out_dir, opts.out_template % i + '.png')
-
-      with open(ply_out_path, 'w') as f:
-        # This does the ConvexHull!
-        generate_ply.generate_ply(f, intersections,
-                                  template_path='render/ply-header.template')
-      print('Wrote %s' % ply_out_path)
-
-      ply_angle = ply_angles[i]
-      if opts.ply_rotation:
-        # Rotate about Y axis, which is pointing up.
-        ply_rotation = 'Rotate %f 0 1 0' % ply_angle
-      else:
-        ply_rotation = ''
-
-      eye = eye_points[i]
-      d = {
-          'out_filename': out_filename,
-          'ply_filename': ply_filename,
-          'eye_x': eye[0],
-          'eye_y': eye[1],
-          'eye_z': eye[2],
-
-          'width': opts.width,
-          'height': opts.height,
-          'pixel_samples': opts.pixel_samples,
-          'integrator_depth': opts.integrator_depth,
-          'ply_rotation': ply_rotation,
-      }
-      with open(pbrt_out_path, 'w') as f:
-        f.write(pbrt_template % d)
-      print('Wrote %s' % pbrt_out_path)
-
-
-def main(argv):
+        archive = None
+      try:
+        for job in GenFrameJobs(gen, opts, profile_log, archive):
+          jobs.append(job)
+      except BaseException:
+        if archive:
+          archive.Abort()
+        raise
+      if archive:
+        if archive.Close():
+          print('Wrote %s' % archive_path)
+        else:
+          print('Unchanged %s' % archive_path)
+      WriteManifest(opts, schlafli, jobs)
+      if profile_log:
+        print(profile_log.Summary(schlafli=schlafli, jobs=opts.jobs))
+      return
+
+    # Render each frame as soon as it's written.
+    finished_path = pipeline.FinishedPath(opts.out_dir)
+    if os.path.exists(finished_path):
+      os.remove(finished_path)
+    render_argv = shlex.split(opts.render_cmd)
+    if opts.no_cache:
+      image_cache = None
+    else:
+      image_cache = pipeline.ImageCache(render_argv)
+    stage = pipeline.RenderStage(
+        render_argv, num_workers=opts.render_jobs,
+        queue_size=opts.render_queue_size, finished_path=finished_path,
+        image_cache=image_cache)
+    try:
+      for job in GenFrameJobs(gen, opts, profile_log):
+        jobs.append(job)
+        stage.Put(job)
+      WriteManifest(opts, schlafli, jobs)
+      if profile_log:
+        # Generation only.  Render times are in the log above.
+        print(profile_log.Summary(schlafli=schlafli, jobs=opts.jobs))
+      stage.Finish()
+    except KeyboardInterrupt:
+      stage.Abort()
+      raise RuntimeError('Interrupted.  %s (recorded in %s)' % (
+                         stage.Summary(), finished_path))
+
+    print(stage.Summary())
+    if stage.failed:
+      raise RuntimeError('%d frames failed to render' % len(stage.failed))
+
+
+def CreateOptionsParser():
   parser = optparse.OptionParser(
       description='Tweak quality settings for bathroom scene.')
   parser.add_option(
@@ -739,20 +1547,101 @@ def main(argv):
       help='Frames per second for matplotlib mp4')
   parser.add_option(
       '--camera', type=str, default='fixed',
-      help='Type of camera rotation for a particular scene')
+      help='Camera path: one of %s, or a JSON file of keyframed tracks '
+           '(see rotate.py)' % ', '.join(sorted(rotate.CAMERAS)))
   parser.add_option(
       '--ply-rotation', action='store_true',
       help='Rotate the ply mesh in every frame.')
+  parser.add_option(
+      '--rotate-4d', type=str,
+      help='Also rotate the polytope in 4D, e.g. "xw=360,yz=0:90".  Each of '
+           'the planes xy xz xw yz yw zw turns from START to END degrees '
+           'over the run.')
   parser.add_option(
       '--exr', action='store_true',
       help='Render EXR instead of PNG')
+  parser.add_option(
+      '--mesh', type='choice', choices=['hull', 'lattice'], default='hull',
+      help="How to mesh each 4D slice: 'hull' triangulates the convex hull "
+           "of the points, 'lattice' builds polygons from the polytope's "
+           "faces and cells, which also works for degenerate slices")
+  parser.add_option(
+      '--merge-faces', action='store_true',
+      help="With --mesh hull, weld duplicate points of each slice, and merge "
+           "the hull's coplanar triangles into polygons, so pbrt has fewer "
+           "faces to parse and intersect")
+  parser.add_option(
+      '--ply-format', type='choice', choices=['ascii', 'binary'],
+      default='ascii',
+      help="'binary' writes little-endian PLY files straight from NumPy "
+           "arrays, without rounding to 4 decimals")
+  parser.add_option(
+      '--ply-precision', type='choice', choices=['float32', 'float64'],
+      default='float32',
+      help='Vertex coordinate type for --ply-format binary')
+  parser.add_option(
+      '--ply-normals', action='store_true',
+      help='Write vertex normals, for --ply-format binary')
+  parser.add_option(
+      '--shared-world', action='store_true',
+      help='Write the parts of the scene that are the same in every frame '
+           'to a shared .pbrt file, which each frame Includes')
+  parser.add_option(
+      '--geometry-archive', type=str, metavar='NAME',
+      help='Write the meshes of every frame to NAME in --out-dir, instead of '
+           'a .ply file per frame.  render_executor.py and '
+           'geometry_archive.py export the .ply files before rendering.')
+  parser.add_option(
+      '--read-archive', type=str, metavar='PATH',
+      help='For preview, plot and anim of a 4D polytope, read the meshes '
+           'from a --geometry-archive instead of slicing the polytope')
+  parser.add_option(
+      '--jobs', type=int, default=1,
+      help='Number of processes to generate pbrt frames with, or to save '
+           'matplotlib frames of a 3D animation with')
+  parser.add_option(
+      '--render-cmd', type=str,
+      help='Render each frame with this command as soon as it is generated, '
+           'e.g. "pbrt --quick".  The .pbrt path is appended.')
+  parser.add_option(
+      '--render-jobs', type=int, default=1,
+      help='Number of frames to render at once with --render-cmd')
+  parser.add_option(
+      '--render-queue-size', type=int,
+      help='Max generated frames waiting to be rendered (default: twice '
+           '--render-jobs).  Generation pauses when the queue is full.')
+  parser.add_option(
+      '--no-cache', action='store_true',
+      help="Regenerate polytopes instead of using the cache in "
+           "$POLYTOPE_CACHE_DIR (default ~/.cache/pbrt-video/polytopes), "
+           "and render every frame instead of reusing images in "
+           "$FRAME_CACHE_DIR (default ~/.cache/pbrt-video/images)")
+  parser.add_option(
+      '--profile', type=str, metavar='PATH',
+      help='Append per-frame stage timings and counters to PATH as JSON '
+           'lines, and a summary at the end')
+  parser.add_option(
+      '--profile-frame', type=int, metavar='N',
+      help='With --profile, also dump the cProfile stats of frame N to '
+           'PATH.frameN.prof')
+  return parser
 
+
+def main(argv):
+  parser = CreateOptionsParser()
   opts, argv = parser.parse_args(argv[1:])
+  if opts.profile_frame is not None and not opts.profile:
+    raise RuntimeError('--profile-frame requires --profile')
+  if opts.jobs < 1:
+    raise RuntimeError('--jobs must be at least 1, got %d' % opts.jobs)
+
+  if opts.no_cache:
+    polytope_cache.enabled = False
 
   try:
     action = argv[0]
   except IndexError:
-    raise RuntimeError('Action required: bounds, plot, or pbrt')
+    raise RuntimeError('Action required: bounds, plot, anim, pbrt, or preview')
 
   if action == 'bounds':
     ShowBounds()
@@ -760,6 +1649,9 @@ def main(argv):
   elif action == 'pbrt':
     GenPbrt(opts, argv)
 
+  elif action == 'preview':
+    Preview(opts, argv)
+
   elif action == 'plot':
     schlafli = [int(a) for a in argv[1:]]  # e.g. 4 3 for cube
     if len(schlafli) not in (2, 3):
@@ -774,12 +1666,14 @@ def main(argv):
 
     if len(schlafli) == 2:
       Animate3D(schlafli, opts.num_frames, opts.fps,
-                mp4_out_template=opts.mpl_mp4_out_template)
+                mp4_out_template=opts.mpl_mp4_out_template,
+                png_out_template=opts.mpl_png_out_template, jobs=opts.jobs)
 
     elif len(schlafli) == 3:
-      # Inconsistency: In 4D, the Plot() functions animates 
-      # We used a different method to animate 4D than 3D.
-      Plot(schlafli, opts)
+      Animate4D(schlafli, opts.num_frames, opts.fps,
+                mp4_out_template=opts.mpl_mp4_out_template,
+                png_out_template=opts.mpl_png_out_template,
+                archive=ReadArchive(opts))
 
     else:
       raise AssertionError
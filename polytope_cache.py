@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+polytope_cache.py
+
+A persistent cache of regular polytopes from schlafli_interpreter.
+
+Each polytope is stored in its own directory of .npy files: verts.npy, and
+elts1.npy, elts2.npy, ... for the edges, faces, etc.  Later runs load them
+with memory mapping instead of regenerating them.
+
+An entry is keyed by the Schlafli symbol, the vertex limit, and a hash of the
+interpreter source, so changing the generator invalidates old entries.
+
+Several worker processes may start at once.  Each one writes its entry to a
+private temporary directory and renames it into place, so readers only ever
+see complete entries.  If two workers race, the loser throws its copy away.
+If the cache directory can't be written, the polytope is used uncached.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from schlafli import schlafli_interpreter
+
+
+# Set to False to always regenerate (polytope.py --no-cache).
+enabled = True
+
+DEFAULT_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'pbrt-video', 'polytopes')
+
+# Evict least recently used entries beyond this total size, and entries that
+# haven't been used for this long.
+MAX_BYTES = 256 << 20
+MAX_AGE_SECONDS = 30 * 24 * 3600
+
+_code_version = None
+_warned = False  # about an unwritable cache, once per process
+
+
+def CacheDir():
+  return os.environ.get('POLYTOPE_CACHE_DIR', DEFAULT_DIR)
+
+
+def CodeVersion():
+  """A hash of the interpreter source, computed once per process."""
+  global _code_version
+  if _code_version is None:
+    path = schlafli_interpreter.__file__
+    if path.endswith('.pyc'):
+      path = path[:-1]
+    with open(path, 'rb') as f:
+      _code_version = hashlib.sha1(f.read()).hexdigest()[:12]
+  return _code_version
+
+
+def EntryName(schlafli, vertexlimit):
+  """e.g. 5-3-3.all.<hash> or 7-2.5.v100.<hash>"""
+  symbol = '-'.join('%g' % s for s in schlafli)
+  if vertexlimit >= 1e100:
+    limit = 'all'
+  else:
+    limit = 'v%d' % vertexlimit
+  return '%s.%s.%s' % (symbol, limit, CodeVersion())
+
+
+def _Load(entry_dir, num_elts):
+  """Load an entry with num_elts element arrays: edges, faces, etc.
+
+  Raises ValueError if some are missing, e.g. because the entry was evicted
+  after verts.npy was loaded.
+  """
+  verts = np.load(os.path.join(entry_dir, 'verts.npy'), mmap_mode='r')
+  edges_etc = []
+  for i in range(num_elts):
+    path = os.path.join(entry_dir, 'elts%d.npy' % (i + 1))
+    if not os.path.exists(path):
+      raise ValueError('%s has %d of %d element arrays' % (
+                       entry_dir, i, num_elts))
+    edges_etc.append(np.load(path, mmap_mode='r'))
+  return verts, edges_etc
+
+
+def _Store(cache_dir, entry_dir, verts, edges_etc):
+  tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+  try:
+    np.save(os.path.join(tmp_dir, 'verts.npy'), verts)
+    for i, elts in enumerate(edges_etc):
+      np.save(os.path.join(tmp_dir, 'elts%d.npy' % (i + 1)), elts)
+  except (IOError, OSError):
+    shutil.rmtree(tmp_dir, ignore_errors=True)  # e.g. the disk is full
+    raise
+  try:
+    os.rename(tmp_dir, entry_dir)
+  except OSError:
+    # Another worker stored the same entry first.
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _Remove(cache_dir, entry_dir):
+  # Rename first, so that nobody loads a half-deleted entry.
+  trash = tempfile.mkdtemp(prefix='.trash-', dir=cache_dir)
+  try:
+    os.rename(entry_dir, os.path.join(trash, 'entry'))
+  except OSError:
+    pass  # Another worker removed it
+  shutil.rmtree(trash, ignore_errors=True)
+
+
+def _DirSize(path):
+  total = 0
+  for name in os.listdir(path):
+    try:
+      total += os.path.getsize(os.path.join(path, name))
+    except OSError:
+      pass
+  return total
+
+
+def Evict(cache_dir=None, max_bytes=MAX_BYTES,
+          max_age_seconds=MAX_AGE_SECONDS):
+  """Remove stale entries, then least recently used ones until under size."""
+  cache_dir = cache_dir or CacheDir()
+  now = time.time()
+
+  entries = []
+  for name in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, name)
+    try:
+      mtime = os.path.getmtime(path)
+      size = _DirSize(path)
+    except OSError:
+      continue  # Removed by another worker
+    if name.startswith('.'):
+      # Temporary directories left behind by a killed worker
+      if now - mtime > 3600:
+        shutil.rmtree(path, ignore_errors=True)
+      continue
+    entries.append((mtime, size, path))
+
+  entries.sort()  # oldest first
+  total = sum(size for _, size, _ in entries)
+  for mtime, size, path in entries:
+    if now - mtime <= max_age_seconds and total <= max_bytes:
+      break
+    _Remove(cache_dir, path)
+    total -= size
+
+
+def RegularPolytope(schlafli):
+  """Like schlafli_interpreter.regular_polytope(), but cached.
+
+  Returns:
+    verts: (num_verts, dim) float array
+    edges_etc: list of (num_elts, num_verts_per_elt) int arrays
+
+  The arrays may be read-only memory maps.
+  """
+  global _warned
+  if not enabled:
+    return schlafli_interpreter.regular_polytope_arrays(schlafli)
+
+  cache_dir = CacheDir()
+  entry_dir = os.path.join(
+      cache_dir, EntryName(schlafli, schlafli_interpreter.vertexlimit))
+
+  incomplete = False
+  try:
+    # A {p,q,...} has one array each of edges, faces, ... up to facets.
+    result = _Load(entry_dir, len(schlafli))
+  except ValueError:
+    incomplete = True  # Evicted while we were loading it, or damaged
+  except (IOError, OSError):
+    pass  # Missing, or evicted while we were loading it
+  else:
+    try:
+      os.utime(entry_dir, None)  # for LRU eviction
+    except OSError:
+      pass
+    return result
+
+  verts, edges_etc = schlafli_interpreter.regular_polytope_arrays(schlafli)
+
+  try:
+    try:
+      os.makedirs(cache_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    if incomplete and os.path.exists(entry_dir):
+      _Remove(cache_dir, entry_dir)  # so _Store() can replace it
+    _Store(cache_dir, entry_dir, verts, edges_etc)
+    Evict(cache_dir)
+  except (IOError, OSError) as e:
+    if not _warned:
+      print('Not caching polytopes in %s: %s' % (cache_dir, e),
+            file=sys.stderr)
+      _warned = True
+
+  return verts, edges_etc
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+profiling.py
+
+Opt-in timers and counters for polytope.py --profile.
+
+Each frame gets a FrameTimer, which times the stages of the frame (intersect,
+mesh, ply, template, key, write) and counts things like cut edges and bytes
+written.  Its record is appended to the --profile file as one JSON line, and
+ProfileLog adds a summary line at the end of the run.
+
+When --profile is off, frames get NULL_TIMER, whose methods do nothing.
+"""
+
+import collections
+import json
+import time
+
+
+class FrameTimer(object):
+  """Times the stages of one frame.
+
+  Lap(stage) charges the time since the last Lap() to the stage.
+  """
+
+  def __init__(self, index, **fields):
+    self.record = collections.OrderedDict(frame=index)
+    self.record.update(sorted(fields.items()))
+    self.secs = collections.OrderedDict()
+    self.counts = collections.OrderedDict()
+    self.start_time = self.last_time = time.time()
+
+  def Lap(self, stage):
+    now = time.time()
+    self.secs[stage] = self.secs.get(stage, 0.0) + now - self.last_time
+    self.last_time = now
+
+  def Count(self, name, n):
+    self.counts[name] = self.counts.get(name, 0) + n
+
+  def Record(self):
+    self.record['secs'] = self.secs
+    self.record['total_secs'] = self.last_time - self.start_time
+    self.record['counts'] = self.counts
+    return self.record
+
+
+class _NullTimer(object):
+
+  def Lap(self, stage):
+    pass
+
+  def Count(self, name, n):
+    pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class ProfileLog(object):
+  """Appends frame records to a JSON lines file, and totals them."""
+
+  def __init__(self, path):
+    self.path = path
+    self.start_time = time.time()
+    self.setup_secs = collections.OrderedDict()  # once-per-run stages
+    self.secs = collections.OrderedDict()
+    self.counts = collections.OrderedDict()
+    self.num_frames = 0
+
+  def Setup(self, stage, secs):
+    """Record a stage that runs once, e.g. regular_polytope."""
+    self.setup_secs[stage] = self.setup_secs.get(stage, 0.0) + secs
+
+  def Frame(self, record):
+    for stage, secs in record['secs'].items():
+      self.secs[stage] = self.secs.get(stage, 0.0) + secs
+    for name, n in record['counts'].items():
+      self.counts[name] = self.counts.get(name, 0) + n
+    self.num_frames += 1
+    self._Append(record)
+
+  def Summary(self, **fields):
+    """Append the totals.  Returns a line to print."""
+    record = collections.OrderedDict(summary=True)
+    record.update(sorted(fields.items()))
+    record['num_frames'] = self.num_frames
+    record['wall_secs'] = time.time() - self.start_time
+    record['setup_secs'] = self.setup_secs
+    record['secs'] = self.secs
+    record['counts'] = self.counts
+    self._Append(record)
+
+    stages = list(self.setup_secs.items()) + list(self.secs.items())
+    return 'Profile: %s (appended to %s)' % (
+        ', '.join('%s %.2fs' % (stage, secs) for stage, secs in stages),
+        self.path)
+
+  def _Append(self, record):
+    with open(self.path, 'a') as f:
+      f.write(json.dumps(record) + '\n')
@@ -51,6 +51,10 @@ do-task() {
   # Hack
   local input="$out_dir/quality-${dim}-${pixel_samples}-${depth}__frame000.pbrt"
 
+  # For shard_planner.py's cost model
+  local num_faces=$(grep --max-count 1 '^element face' ${input%.pbrt}.ply \
+                    | awk '{ print $3 }')
+
   # 22 hyperthreads out of 24, or 11 out of 12 cores.
   time-py \
     --tsv \
@@ -58,10 +62,11 @@ do-task() {
     --field "$dim" \
     --field "$pixel_samples" \
     --field "$depth" \
+    --field "$num_faces" \
     -- $PBRT_REMOTE --nthreads 22 $input
 }
 
-readonly HEADER=$'status\telapsed_secs\tdim\tpixel_samples\tdepth\t'
+readonly HEADER=$'status\telapsed_secs\tdim\tpixel_samples\tdepth\tnum_faces\t'
 readonly TIMES_OUT='_quality/times.tsv'
 
 readonly OUT_DIR=_quality/out
@@ -84,5 +89,19 @@ prepare() {
   prepare-bathroom $OUT_DIR
 }
 
+# Time our own geometry code, stage by stage, for every shape.  Save a
+# baseline before an optimization, and compare after:
+#
+#   ./quality.sh bench-geometry --out _quality/geometry_base.tsv
+#   ./quality.sh bench-geometry --baseline _quality/geometry_base.tsv
+bench-geometry() {
+  ./benchmark.py "$@"
+}
+
+# Check that polytope.py bounds and pbrt start fast, without matplotlib.
+bench-startup() {
+  ./benchmark.py --startup
+}
+
 
 "$@"
@@ -1,6 +1,5 @@
 #!/usr/bin/python3
 import sys
-from scipy.spatial import ConvexHull
 import numpy as np 
 
 # Helper function
@@ -18,13 +17,44 @@ def vertex_indices_to_subset(hull):
             dtype=np.int32)
     return simplex_array
 
+# Compute the 3-D convex hull of the input points.
+# Returns (vertex_indices, faces): the indices of the input points that are
+# hull vertices, and a triangle list that indexes into those.
+def hull_topology(points):
+    # scipy takes a while to import, and not every caller needs a hull.
+    from scipy.spatial import ConvexHull
+
+    hull = ConvexHull(np.asarray(points))
+
+    polygon_faces = hull.simplices # each face has a list of vertex indices
+    if len(hull.vertices) != hull.npoints:
+        polygon_faces = vertex_indices_to_subset(hull)
+
+    return hull.vertices, polygon_faces
+
+
+# Compute the 3-D convex hull of the input points.
+# Returns (vertices, faces): the hull vertices, and a triangle list that
+# indexes into them.  This is the mesh that generate_ply() writes.
+def hull_mesh(points):
+    points = np.asarray(points)
+    vertex_indices, polygon_faces = hull_topology(points)
+    return points[vertex_indices], polygon_faces
+
+
 # Generate a PLY file for the 3-D convex hull of the input points.
 def generate_ply(out, points, template_path=None):
+    vertices, polygon_faces = hull_mesh(points)
+    write_ply(out, vertices, polygon_faces, template_path=template_path)
+
+
+# Write a PLY file for a mesh.  Each face is a list of vertex indices, so
+# faces can be triangles or any other polygons.
+def write_ply(out, vertices, polygon_faces, template_path=None):
     template_path = template_path or 'ply-header.template'
 
-    hull = ConvexHull(points)
-    num_vertices = len(hull.vertices) 
-    num_faces = hull.nsimplex
+    num_vertices = len(vertices)
+    num_faces = len(polygon_faces)
     
     with open(template_path) as file:
         header = file.read()
@@ -33,21 +63,109 @@ def generate_ply(out, points, template_path=None):
         'num_faces'    : num_faces
     }
 
-    polygon_faces = hull.simplices # each face has a list of vertex indices
-    if num_vertices != hull.npoints:
-        polygon_faces = vertex_indices_to_subset(hull)
-
     # Strings for vertices, faces PLY-formatted
-    vertex_data = '\n'.join( [ ' '.join( map( "{:.4f}".format, points[i]))
-                    for i in hull.vertices  ] )
-    face_data = '\n'.join( [ '3 ' + ' '.join( map(str, polygon_faces[i]))
-                    for i in range(num_faces) ] )
+    vertex_data = '\n'.join( [ ' '.join( map( "{:.4f}".format, v))
+                    for v in vertices ] )
+    face_data = '\n'.join( [ str(len(face)) + ' ' + ' '.join( map(str, face))
+                    for face in polygon_faces ] )
 
     print(header % macro_replacements, file=out)
     print(vertex_data, file=out)
     print(face_data, file=out)
 
 
+# Binary PLY headers, one per (dtype, has_normals), built once.
+BINARY_PLY_TYPES = {'float32': 'float', 'float64': 'double'}
+_binary_headers = {}
+
+def binary_ply_header(dtype, has_normals):
+    key = (dtype, has_normals)
+    if key not in _binary_headers:
+        names = ['x', 'y', 'z']
+        if has_normals:
+            names += ['nx', 'ny', 'nz']
+        lines = ['ply', 'format binary_little_endian 1.0',
+                 'element vertex %(num_vertices)d']
+        lines += ['property %s %s' % (BINARY_PLY_TYPES[dtype], name)
+                  for name in names]
+        lines += ['element face %(num_faces)d',
+                  'property list uint8 int32 vertex_indices',
+                  'end_header', '']
+        _binary_headers[key] = '\n'.join(lines)
+    return _binary_headers[key]
+
+
+# Pack faces as PLY lists: a uint8 count, then int32 vertex indices.  Faces
+# can be an (m, k) array or a list of index lists of any lengths.
+def pack_faces(polygon_faces):
+    if isinstance(polygon_faces, np.ndarray) and polygon_faces.ndim == 2:
+        sizes = np.full(len(polygon_faces), polygon_faces.shape[1])
+    else:
+        sizes = np.array([len(face) for face in polygon_faces], dtype=np.intp)
+    if len(sizes) == 0:
+        return b''
+    flat = np.concatenate([np.asarray(face) for face in polygon_faces])
+
+    # Each face takes 1 + 4*size bytes.  Put the counts at the start of each
+    # face, and the index bytes everywhere else.
+    face_bytes = 1 + 4 * sizes
+    starts = np.cumsum(face_bytes) - face_bytes
+    buf = np.empty(face_bytes.sum(), dtype=np.uint8)
+    is_count = np.zeros(len(buf), dtype=bool)
+    is_count[starts] = True
+    buf[starts] = sizes
+    buf[~is_count] = flat.astype('<i4').view(np.uint8)
+    return buf.tobytes()
+
+
+# Area-weighted vertex normals of a convex polygon mesh.  Hull triangles
+# aren't consistently wound, so each face normal is flipped to point away from
+# the center.
+def vertex_normals(vertices, polygon_faces):
+    vertices = np.asarray(vertices, dtype=float)
+    normals = np.zeros_like(vertices)
+    sizes = np.array([len(face) for face in polygon_faces], dtype=np.intp)
+    if len(sizes) == 0:
+        return normals
+    flat = np.concatenate([np.asarray(face) for face in polygon_faces])
+
+    # Newell's method: the cross products of consecutive corners sum to twice
+    # the face's area times its normal.
+    starts = np.cumsum(sizes) - sizes
+    following = np.arange(1, len(flat) + 1)
+    following[starts + sizes - 1] = starts
+    corner = np.cross(vertices[flat], vertices[flat[following]])
+    face_normals = np.add.reduceat(corner, starts)
+    face_centers = (np.add.reduceat(vertices[flat], starts) /
+                    sizes[:, np.newaxis])
+    outward = np.sum(face_normals * (face_centers - vertices.mean(axis=0)),
+                     axis=1)
+    face_normals[outward < 0] *= -1
+
+    np.add.at(normals, flat, np.repeat(face_normals, sizes, axis=0))
+    length = np.linalg.norm(normals, axis=1)
+    length[length == 0] = 1
+    return normals / length[:, np.newaxis]
+
+
+# Write a binary little-endian PLY file for a mesh, straight from NumPy
+# arrays.  out must be opened in binary mode.  dtype is 'float32' or
+# 'float64'.
+def write_binary_ply(out, vertices, polygon_faces, normals=None,
+                     dtype='float32'):
+    vertices = np.asarray(vertices).reshape(-1, 3)
+    if normals is not None:
+        vertices = np.hstack([vertices, np.asarray(normals).reshape(-1, 3)])
+    header = binary_ply_header(dtype, normals is not None) % {
+        'num_vertices': len(vertices),
+        'num_faces': len(polygon_faces),
+    }
+    out.write(header.encode('ascii'))
+    little_endian = np.dtype(dtype).newbyteorder('<')
+    out.write(np.ascontiguousarray(vertices, dtype=little_endian).tobytes())
+    out.write(pack_faces(polygon_faces))
+
+
 def main(argv):
     if len(argv) < 2:
         raise Exception("Please specify a filename!")
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+# A small software rasterizer for previewing slice meshes without pbrt or
+# matplotlib.  Triangles are flat shaded (Lambert, with a light at the eye)
+# and resolved with a z-buffer.  Everything is vectorized over triangles and
+# pixels, so there are no per-pixel Python loops.
+
+BACKGROUND = np.array([40, 40, 48], dtype=np.uint8)
+BASE_COLOR = np.array([0.75, 0.78, 0.85])
+AMBIENT = 0.15
+
+# Triangles closer than this to the eye plane are dropped.
+NEAR = 1e-3
+
+
+# The camera-to-world basis for a pbrt-style LookAt.  pbrt's camera space is
+# left-handed: +z is the view direction, +y is up.
+def look_at_basis(eye, look_at, up):
+    eye = np.asarray(eye, dtype=float)
+    direction = np.asarray(look_at, dtype=float) - eye
+    direction /= np.linalg.norm(direction)
+    up = np.asarray(up, dtype=float)
+    right = np.cross(up / np.linalg.norm(up), direction)
+    right /= np.linalg.norm(right)
+    new_up = np.cross(direction, right)
+    return right, new_up, direction
+
+
+# Project world-space points to raster coordinates, like pbrt's perspective
+# camera.  fov applies to the shorter image axis.  mirror_x is for templates
+# that have "Scale -1 1 1" before LookAt.
+#
+# Returns (raster, depth): (n, 2) pixel coordinates and (n,) camera-space z.
+def project(points, eye, look_at, up, fov, width, height, mirror_x=False):
+    right, new_up, direction = look_at_basis(eye, look_at, up)
+    rel = np.asarray(points, dtype=float) - np.asarray(eye, dtype=float)
+    cam_x = rel @ right
+    cam_y = rel @ new_up
+    cam_z = rel @ direction
+    if mirror_x:
+        cam_x = -cam_x
+
+    tan_half = np.tan(np.radians(fov) / 2)
+    aspect = float(width) / height
+    if aspect > 1:
+        sx_extent, sy_extent = aspect, 1.0
+    else:
+        sx_extent, sy_extent = 1.0, 1.0 / aspect
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sx = cam_x / (cam_z * tan_half)
+        sy = cam_y / (cam_z * tan_half)
+
+    raster = np.empty((len(rel), 2))
+    raster[:, 0] = (sx + sx_extent) / (2 * sx_extent) * width
+    raster[:, 1] = (sy_extent - sy) / (2 * sy_extent) * height
+    return raster, cam_z
+
+
+# Rasterize a triangle mesh.
+#
+# vertices: (n, 3) world-space points.  faces: (m, 3) vertex indices.
+# Returns a (height, width, 3) uint8 RGB image.
+def rasterize(vertices, faces, eye, look_at, up, fov, width, height,
+              mirror_x=False):
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = BACKGROUND
+
+    vertices = np.asarray(vertices, dtype=float)
+    faces = np.asarray(faces, dtype=np.intp).reshape(-1, 3)
+    if len(faces) == 0:
+        return image
+
+    raster, depth = project(vertices, eye, look_at, up, fov, width, height,
+                            mirror_x=mirror_x)
+
+    # Flat Lambert shading with the light at the eye.  Hull triangles aren't
+    # consistently oriented, so use the absolute value.
+    tri = vertices[faces]
+    normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    norm = np.linalg.norm(normals, axis=1)
+    to_eye = np.asarray(eye, dtype=float) - tri.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lambert = np.abs(np.sum(normals * to_eye, axis=1)) / (
+            norm * np.linalg.norm(to_eye, axis=1))
+    lambert = np.nan_to_num(lambert)
+    shade = AMBIENT + (1 - AMBIENT) * lambert
+    colors = np.clip(shade[:, np.newaxis] * BASE_COLOR * 255, 0, 255)
+
+    p = raster[faces]  # (m, 3, 2)
+    z = depth[faces]  # (m, 3)
+
+    # Drop triangles behind the eye, degenerate ones, and ones off screen.
+    x0 = np.floor(p[:, :, 0].min(axis=1)).clip(0, width)
+    x1 = np.ceil(p[:, :, 0].max(axis=1)).clip(0, width)
+    y0 = np.floor(p[:, :, 1].min(axis=1)).clip(0, height)
+    y1 = np.ceil(p[:, :, 1].max(axis=1)).clip(0, height)
+    area = ((p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1]) -
+            (p[:, 2, 0] - p[:, 0, 0]) * (p[:, 1, 1] - p[:, 0, 1]))
+    ok = ((z.min(axis=1) > NEAR) & (area != 0) & np.isfinite(area) &
+          (x1 > x0) & (y1 > y0))
+    if not ok.any():
+        return image
+
+    p, z, area, colors = p[ok], z[ok], area[ok], colors[ok]
+    x0, x1 = x0[ok].astype(np.intp), x1[ok].astype(np.intp)
+    y0, y1 = y0[ok].astype(np.intp), y1[ok].astype(np.intp)
+
+    # Enumerate every (triangle, pixel) pair in each triangle's bounding box.
+    box_w = x1 - x0
+    counts = box_w * (y1 - y0)
+    tri_idx = np.repeat(np.arange(len(counts)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    local = np.arange(counts.sum()) - starts
+    px = x0[tri_idx] + local % box_w[tri_idx]
+    py = y0[tri_idx] + local // box_w[tri_idx]
+
+    # Barycentric coordinates at pixel centers
+    cx = px + 0.5
+    cy = py + 0.5
+    a = p[tri_idx]
+    w0 = ((a[:, 1, 0] - cx) * (a[:, 2, 1] - cy) -
+          (a[:, 2, 0] - cx) * (a[:, 1, 1] - cy))
+    w1 = ((a[:, 2, 0] - cx) * (a[:, 0, 1] - cy) -
+          (a[:, 0, 0] - cx) * (a[:, 2, 1] - cy))
+    w2 = area[tri_idx] - w0 - w1
+    sign = np.sign(area[tri_idx])
+    inside = (w0 * sign >= 0) & (w1 * sign >= 0) & (w2 * sign >= 0)
+
+    tri_idx, px, py = tri_idx[inside], px[inside], py[inside]
+    b = np.stack([w0[inside], w1[inside], w2[inside]], axis=1)
+    b /= area[tri_idx, np.newaxis]
+
+    # Perspective-correct depth: interpolate 1/z in screen space.
+    inv_z = np.sum(b / z[tri_idx], axis=1)
+
+    # z-buffer: the nearest fragment has the largest 1/z.
+    pixel = py * width + px
+    zbuf = np.full(width * height, -np.inf)
+    np.maximum.at(zbuf, pixel, inv_z)
+    front = inv_z == zbuf[pixel]
+
+    flat = image.reshape(-1, 3)
+    flat[pixel[front]] = colors[tri_idx[front]].astype(np.uint8)
+    return image
+
+
+def _png_chunk(tag, data):
+    chunk = tag + data
+    return (struct.pack('>I', len(data)) + chunk +
+            struct.pack('>I', zlib.crc32(chunk) & 0xffffffff))
+
+
+# Write an (height, width, 3) uint8 image as an 8-bit RGB PNG.
+def write_png(out, image, compress_level=1):
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+
+    # Each scanline starts with filter type 0 (None).
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, width * 3)
+
+    out.write(b'\x89PNG\r\n\x1a\n')
+    out.write(_png_chunk(b'IHDR',
+                         struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    out.write(_png_chunk(b'IDAT', zlib.compress(rows.tobytes(),
+                                                compress_level)))
+    out.write(_png_chunk(b'IEND', b''))
+
+
+def main(argv):
+    if len(argv) < 2:
+        raise Exception("Please specify a filename!")
+    fname = argv[1]
+
+    from generate_ply import hull_mesh
+    points = np.random.rand(100, 3)
+    vertices, faces = hull_mesh(points)
+    image = rasterize(vertices, faces, [3, 3, 2], [0.5, 0.5, 0.5], [0, 0, 1],
+                      45, 400, 400)
+    with open(fname, 'wb') as out:
+        write_png(out, image)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
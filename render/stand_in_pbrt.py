@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+import re
+import sys
+import time
+
+import numpy as np
+
+from raster import write_png
+
+# A stand-in for pbrt, for testing the render pipeline on machines without
+# it.  It finds the Film filename in a .pbrt file and writes a gray image of
+# the right size there.
+#
+# Usage:
+#   stand_in_pbrt.py [--sleep SECONDS] [--fail] [--nthreads N] FILE.pbrt
+#
+# e.g. ./polytope.py --render-cmd 'render/stand_in_pbrt.py --sleep 1' pbrt 5 3 3
+
+FILM_RE = re.compile(r'"string filename"\s*"([^"]+)"')
+SIZE_RE = re.compile(r'"integer (x|y)resolution"\s*\[?\s*(\d+)')
+
+
+def main(argv):
+    sleep = 0.0
+    fail = False
+    args = argv[1:]
+    while args and args[0].startswith('--'):
+        flag = args.pop(0)
+        if flag == '--sleep':
+            sleep = float(args.pop(0))
+        elif flag == '--fail':
+            fail = True
+        elif flag == '--nthreads':
+            args.pop(0)  # Like pbrt, but ignored
+        else:
+            raise Exception('Invalid flag %r' % flag)
+    if len(args) != 1:
+        raise Exception("Please specify a .pbrt file!")
+
+    with open(args[0]) as f:
+        scene = f.read()
+    m = FILM_RE.search(scene)
+    if not m:
+        raise Exception('No Film filename in %s' % args[0])
+    out_path = m.group(1)
+
+    size = dict((axis, int(n)) for axis, n in SIZE_RE.findall(scene))
+    width = size.get('x', 400)
+    height = size.get('y', 400)
+
+    time.sleep(sleep)
+    if fail:
+        return 1
+
+    image = np.full((height, width, 3), 128, dtype=np.uint8)
+    with open(out_path, 'wb') as f:
+        write_png(f, image)
+    print('stand_in_pbrt: wrote %s' % out_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
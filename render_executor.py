@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+render_executor.py
+
+Render a directory of frame .pbrt files with K concurrent render slots.
+
+Idle slots take the next frame from a shared queue, so a slow frame doesn't
+hold up the others.  Finished frames are appended to finished-frames.txt in
+the directory (the same state file as polytope.py --render-cmd), so after a
+crash or reboot, running it again resumes where it left off.
+
+If polytope.py wrote a manifest.json with the frame keys, images are also
+reused from, and saved to, the pipeline.ImageCache.  If it wrote a
+--geometry-archive, the .ply files of the frames to render are exported from
+it first.
+
+With --order bisect, frames are rendered coarse to fine: the first and last
+frame, then the middle one, then the quarter points, and so on.  With
+--preview-video, a video of the whole animation is written after each level,
+with each frame that isn't rendered yet shown as its nearest rendered
+neighbor.  Each frame is rendered the same way in either order, so the final
+images are the same.
+
+With --video, each frame is piped to ffmpeg as soon as it and the frames
+before it are finished (see video_assembler.py), so the video is done right
+after the last frame.
+
+Usage:
+  ./render_executor.py [options] DIR_OR_PBRT_FILE...
+
+Examples:
+  ./render_executor.py --slots 2 _out/4d/5-3-3
+  ./render_executor.py --render-cmd 'render/stand_in_pbrt.py --sleep 1' \\
+      _out/4d/bathroom
+  ./render_executor.py --order bisect --preview-video _out/preview.mp4 \\
+      _out/4d/bathroom
+  ./render_executor.py --video _out/4d/5-3-3.mp4 _out/4d/5-3-3
+"""
+
+import glob
+import json
+import multiprocessing
+import optparse
+import os
+import queue
+import re
+import shlex
+import shutil
+import sys
+import threading
+
+import geometry_archive
+import pipeline
+import scene_template
+import video_assembler
+
+
+FILM_RE = re.compile(r'"string filename"\s*"([^"]+)"')
+FRAME_NUMBER_RE = re.compile(r'(\d+)\D*$')
+
+
+def ImagePath(pbrt_path):
+  """The Film filename of a .pbrt file."""
+  with open(pbrt_path) as f:
+    m = FILM_RE.search(f.read())
+  if not m:
+    raise RuntimeError('No Film filename in %s' % pbrt_path)
+  return m.group(1)
+
+
+def FrameNumber(pbrt_path):
+  """e.g. 7 for 5-3-3_frame07.pbrt"""
+  name = os.path.splitext(os.path.basename(pbrt_path))[0]
+  m = FRAME_NUMBER_RE.search(name)
+  if not m:
+    raise RuntimeError('No frame number in %s' % pbrt_path)
+  return int(m.group(1))
+
+
+def ReadFinished(finished_path):
+  """Returns the set of image paths recorded in the state file."""
+  finished = set()
+  try:
+    f = open(finished_path)
+  except IOError:
+    return finished
+  with f:
+    for line in f:
+      parts = line.split(None, 1)
+      if len(parts) == 2:  # The last line may be cut off
+        finished.add(parts[1].rstrip('\n'))
+  return finished
+
+
+def IsDone(job, finished):
+  """Skip a frame if its image is complete, and was rendered from this .pbrt
+  file: either recorded in the state file, or newer than the .pbrt file."""
+  if not pipeline.IsComplete(job.image_path):
+    return False
+  if job.image_path in finished:
+    return True
+  return os.path.getmtime(job.image_path) >= os.path.getmtime(job.pbrt_path)
+
+
+def FindFrames(args):
+  """Expand directories into their frame .pbrt files, without the shared world
+  files.  Returns sorted FrameJobs."""
+  pbrt_paths = []
+  for arg in args:
+    if os.path.isdir(arg):
+      pbrt_paths.extend(
+          p for p in glob.glob(os.path.join(arg, '*.pbrt'))
+          if not scene_template.IsSharedFile(p))
+    else:
+      pbrt_paths.append(arg)
+
+  manifests = {}  # dir -> {pbrt path: frame}
+  jobs = []
+  for p in pbrt_paths:
+    d = os.path.dirname(p)
+    if d not in manifests:
+      manifests[d] = pipeline.ManifestFrames(pipeline.ReadManifest(d))
+    frame = manifests[d].get(os.path.basename(p))
+    if frame and os.path.getmtime(p) <= os.path.getmtime(
+        os.path.join(d, pipeline.MANIFEST)):
+      job = pipeline.FrameJob(frame['index'], p, frame['image'], frame['key'],
+                              frame['params'])
+    else:
+      job = pipeline.FrameJob(FrameNumber(p), p, ImagePath(p))
+    jobs.append(job)
+  jobs.sort(key=lambda job: (job.index, job.pbrt_path))
+  return jobs
+
+
+def ParseShard(s):
+  """'1/3' -> (1, 3)"""
+  try:
+    worker_id, num_workers = [int(part) for part in s.split('/')]
+  except ValueError:
+    raise RuntimeError('Invalid --shard %r, expected e.g. 1/3' % s)
+  if not 0 <= worker_id < num_workers:
+    raise RuntimeError('Invalid --shard %r' % s)
+  return worker_id, num_workers
+
+
+def ReadPlan(plan_path):
+  """Returns the .pbrt basenames that shard_planner.py gave a worker."""
+  try:
+    with open(plan_path) as f:
+      plan = json.load(f)
+  except (IOError, ValueError) as e:
+    raise RuntimeError("Can't read shard plan %s: %s" % (plan_path, e))
+  return set(plan['frames'])
+
+
+def RenderLevels(jobs, todo, order):
+  """Group the frames to render into levels, in the order to render them.
+
+  Bisection is over all the jobs, so the levels are spread evenly over the
+  animation even when some frames are already done.
+  """
+  if order == 'index':
+    return [todo] if todo else []
+  todo_paths = set(job.pbrt_path for job in todo)
+  levels = []
+  for positions in pipeline.BisectionLevels(len(jobs)):
+    level = [jobs[i] for i in positions if jobs[i].pbrt_path in todo_paths]
+    if level:
+      levels.append(level)
+  return levels
+
+
+class PreviewWriter(object):
+  """Writes the preview video each time a level of frames is finished.
+
+  Passed to RenderStage as on_done, so it's called from the worker threads.
+  Levels can finish out of order, and a preview is only written once all the
+  levels before it are finished too.  A thread runs ffmpeg, like in
+  video_assembler.VideoStream, so workers go on rendering meanwhile.  If
+  several levels finish during one encode, only the last one is written.
+  """
+
+  def __init__(self, levels, image_paths, out_path, fps):
+    self.image_paths = image_paths
+    self.out_path = out_path
+    self.fps = fps
+    self.level_of = {}  # .pbrt path -> level
+    for i, level in enumerate(levels):
+      for job in level:
+        self.level_of[job.pbrt_path] = i
+    self.remaining = [len(level) for level in levels]
+    self.next_level = 0
+    self.lock = threading.Lock()
+
+    self.queue = queue.Queue()  # finished levels, then None
+    self.thread = threading.Thread(target=self._Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def __call__(self, job, ok):
+    with self.lock:
+      self.remaining[self.level_of[job.pbrt_path]] -= 1
+      level = self.next_level
+      while (self.next_level < len(self.remaining) and
+             self.remaining[self.next_level] == 0):
+        self.next_level += 1
+      if self.next_level == level:
+        return
+      self.queue.put(self.next_level)
+
+  def Finish(self):
+    """Wait for the last preview to be written."""
+    self.queue.put(None)
+    self.thread.join()
+
+  def _Run(self):
+    done = False
+    while not done:
+      level = self.queue.get()
+      if level is None:
+        return
+      # Skip to the latest finished level
+      while not self.queue.empty():
+        item = self.queue.get()
+        if item is None:
+          done = True
+        else:
+          level = item
+
+      try:
+        num_rendered = pipeline.WritePreviewVideo(
+            self.image_paths, self.out_path, fps=self.fps)
+      except RuntimeError as e:
+        # A missing preview shouldn't stop the render.
+        print('Preview video failed: %s' % e)
+      else:
+        print('Level %d of %d done.  Wrote %s with %d of %d frames '
+              'rendered' % (level, len(self.remaining), self.out_path,
+                            num_rendered, len(self.image_paths)))
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage='%prog [options] DIR_OR_PBRT_FILE...',
+      description='Render frame .pbrt files, resuming where a previous run '
+                  'left off.')
+  parser.add_option(
+      '--render-cmd', type=str, default='pbrt',
+      help='Render command.  --nthreads N and the .pbrt path are appended.')
+  parser.add_option(
+      '--slots', type=int, default=1,
+      help='Number of frames to render at once')
+  parser.add_option(
+      '--threads', type=int,
+      help='Threads per render slot (default: all CPUs divided by --slots)')
+  parser.add_option(
+      '--shard', type=str,
+      help='Only render frames whose number is I mod N, given as I/N')
+  parser.add_option(
+      '--shard-plan', type=str, metavar='PATH',
+      help='Only render the frames listed in a plan file from '
+           'shard_planner.py, e.g. DIR/shard-0.json')
+  parser.add_option(
+      '--order', type='choice', choices=['index', 'bisect'], default='index',
+      help="Order to render frames in: 'index', or 'bisect' for coarse to "
+           "fine (default: index)")
+  parser.add_option(
+      '--preview-video', type=str, metavar='PATH',
+      help='Write an .mp4 of the finished frames after each level of '
+           '--order bisect (or at the end), filling in missing frames')
+  parser.add_option(
+      '--preview-fps', type=int, default=30,
+      help='Frame rate of the --preview-video')
+  parser.add_option(
+      '--video', type=str, metavar='PATH',
+      help='Encode the frames as a video while they are rendered')
+  video_assembler.AddVideoOptions(parser, prefix='video-')
+  parser.add_option(
+      '--force', action='store_true',
+      help='Render every frame, even ones that are done')
+  parser.add_option(
+      '--no-cache', action='store_true',
+      help="Don't reuse or save images in $FRAME_CACHE_DIR (default "
+           "~/.cache/pbrt-video/images)")
+
+  opts, args = parser.parse_args(argv[1:])
+  if not args:
+    raise RuntimeError('Directory or .pbrt files required')
+  if opts.preview_video and not shutil.which('ffmpeg'):
+    raise RuntimeError('--preview-video requires ffmpeg')
+  if opts.video and not shutil.which('ffmpeg'):
+    raise RuntimeError('--video requires ffmpeg')
+  if opts.video and (opts.shard or opts.shard_plan):
+    raise RuntimeError("--video needs every frame, so it can't be used with "
+                       "--shard or --shard-plan")
+
+  jobs = FindFrames(args)
+  if opts.shard:
+    worker_id, num_workers = ParseShard(opts.shard)
+    jobs = [job for job in jobs if job.index % num_workers == worker_id]
+  if opts.shard_plan:
+    planned = ReadPlan(opts.shard_plan)
+    jobs = [job for job in jobs
+            if os.path.basename(job.pbrt_path) in planned]
+
+  # One state file per directory, like polytope.py --render-cmd
+  dirs = set(os.path.dirname(job.pbrt_path) for job in jobs)
+  if len(dirs) > 1:
+    raise RuntimeError('Frames must be in one directory, got %s' %
+                       ' '.join(sorted(dirs)))
+  out_dir = dirs.pop() if dirs else '.'
+  finished_path = pipeline.FinishedPath(out_dir)
+
+  if opts.force:
+    todo = jobs
+  else:
+    finished = ReadFinished(finished_path)
+    todo = [job for job in jobs if not IsDone(job, finished)]
+  print('%d frames, %d already done' % (len(jobs), len(jobs) - len(todo)))
+  levels = RenderLevels(jobs, todo, opts.order)
+
+  # Only this shard's frames, right before rendering them.
+  num_exported = geometry_archive.ExportPlys(
+      out_dir, [job.index for job in todo])
+  if num_exported is not None:
+    print('Exported %d .ply files from the geometry archive' % num_exported)
+
+  threads = opts.threads or max(1, multiprocessing.cpu_count() // opts.slots)
+  render_argv = shlex.split(opts.render_cmd) + ['--nthreads', str(threads)]
+
+  # --nthreads doesn't change the image, so it's not part of the cache key.
+  if opts.no_cache:
+    image_cache = None
+  else:
+    image_cache = pipeline.ImageCache(shlex.split(opts.render_cmd))
+
+  callbacks = []
+  preview = None
+  if opts.preview_video:
+    preview = PreviewWriter(levels, [job.image_path for job in jobs],
+                            opts.preview_video, opts.preview_fps)
+    callbacks.append(preview)
+
+  video = None
+  if opts.video:
+    video = video_assembler.VideoStream(
+        opts.video, len(jobs), fps=opts.video_fps, codec=opts.video_codec,
+        crf=opts.video_crf)
+    position = dict((job.pbrt_path, i) for i, job in enumerate(jobs))
+    todo_paths = set(job.pbrt_path for job in todo)
+    for i, job in enumerate(jobs):
+      if job.pbrt_path not in todo_paths:
+        video.Add(i, job.image_path)
+
+    def AddToVideo(job, ok):
+      video.Add(position[job.pbrt_path], job.image_path if ok else None)
+    callbacks.append(AddToVideo)
+
+  def OnDone(job, ok):
+    for callback in callbacks:
+      callback(job, ok)
+
+  stage = pipeline.RenderStage(render_argv, num_workers=opts.slots,
+                               queue_size=len(todo) + opts.slots,
+                               finished_path=finished_path,
+                               image_cache=image_cache, on_done=OnDone)
+  try:
+    for level in levels:
+      for job in level:
+        stage.Put(job)
+    stage.Finish()
+    if preview:
+      preview.Finish()
+    if video:
+      video.Finish()
+  except KeyboardInterrupt:
+    stage.Abort()
+    if video:
+      video.Abort()
+    raise RuntimeError('Interrupted.  %s (recorded in %s)' % (
+                       stage.Summary(), finished_path))
+
+  print(stage.Summary())
+  if video:
+    print('Wrote %s: %s' % (opts.video, video.Summary()))
+  if stage.failed:
+    raise RuntimeError('%d frames failed to render' % len(stage.failed))
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)
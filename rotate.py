@@ -1,44 +1,254 @@
 #!/usr/bin/python3
-from math import sqrt, pi, sin, cos
+"""
+rotate.py
+
+Camera paths: where the camera eye, look-at point and up vector are in each
+frame.
+
+A path has a track for the eye, and optionally for look_at and up.  Without
+them, the frame template's LookAt decides.  Each track is evaluated for all
+frames at once, at times t from 0 to 1.  A track is one of:
+
+  [x, y, z]                  a fixed point
+  {"type": "arc", "center": [x, y, z], "radius": r, "plane": "xz",
+   "start": 0, "end": 90}    an arc in the xy, xz or yz plane, or in the plane
+                             of "axes": [u, v].  Angles are in degrees.
+  {"type": "spline", "points": [p0, p1, ...], "times": [0, ..., 1]}
+                             a Catmull-Rom spline through keyframe points,
+                             evenly spaced in time unless "times" is given
+  {"type": "dolly", "from": p, "to": q}
+                             a straight move
+
+Arcs, splines and dollies take an optional "ease": linear (the default), in,
+out or in-out.  A list of tracks plays them one after the other, each for its
+"duration" (default 1) out of the total.
+
+--camera is the name of a path in CAMERAS, or a JSON file with "eye",
+"look_at" and "up" tracks.
+"""
+
+from math import sqrt
+import json
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
-    
+
+
+PLANES = {
+    'xy': ([1, 0, 0], [0, 1, 0]),
+    'xz': ([1, 0, 0], [0, 0, 1]),
+    'yz': ([0, 1, 0], [0, 0, 1]),
+}
+
+EASES = {
+    'linear': lambda t: t,
+    'in': lambda t: t * t,
+    'out': lambda t: 1 - (1 - t) * (1 - t),
+    'in-out': lambda t: t * t * (3 - 2 * t),  # smoothstep
+}
+
 
 def distance(p1, p2):
-    return sqrt( pow(abs(p1[0] - p2[0]), 2) + 
-          pow(abs(p1[1] - p2[1]), 2) + 
+    return sqrt( pow(abs(p1[0] - p2[0]), 2) +
+          pow(abs(p1[1] - p2[1]), 2) +
           pow(abs(p1[2] - p2[2]), 2) )
 
 
-def circle(center, radius, npoints, max_angle=2*pi):
-    points = np.linspace(0, max_angle, npoints)
-    
-    # rotate in xy plane
-    vals = np.array([ [radius * cos(x), radius * sin(x), 0] for x in points])
-    vals += center
-    
-    return vals
+# The built-in --camera paths.
+
+# From the original convex-render.pbrt file
+CELL_EYE = [3, 3, 2]
+CELL_LOOK_AT = [0.5, 0.5, 0]
+
+# From 4d-contemporary-bathroom.template
+# LookAt -.5 1.1 -.5  # 0 1.25 -.5  # eye position
+# -.8 1.1 -.9 # -.5 1.25 -.9 is towards mirror (lookat point)
+BATHROOM_EYE = [-0.5, 1.1, -0.5]
+BATHROOM_LOOK_AT = [-0.8, 1.1, -0.9]
+
+# From killeroo-frame.template, for frames.py
+KILLEROO_EYE = [600, -20, 30]
+KILLEROO_MIDPOINT = [0, 200, -140]  # midpoint of 2 models
+
+CAMERAS = {
+    'fixed': {
+        'eye': BATHROOM_EYE,
+    },
+    # Rotate a quarter turn around the look-at point
+    '120cell': {
+        'eye': {
+            'type': 'arc', 'center': CELL_LOOK_AT,
+            'radius': distance(CELL_LOOK_AT, CELL_EYE), 'plane': 'xy',
+            'start': 0, 'end': 90,
+        },
+    },
+    # Rotate in XZ plane, since "up" vector is Y.
+    'bathroom': {
+        'eye': {
+            'type': 'arc', 'center': BATHROOM_LOOK_AT,
+            'radius': distance(BATHROOM_LOOK_AT, BATHROOM_EYE), 'plane': 'xz',
+            'start': 180 * 3/16, 'end': 180 * 6/16,
+        },
+    },
+    # A full turn around both models
+    'killeroo': {
+        'eye': {
+            'type': 'arc', 'center': KILLEROO_MIDPOINT,
+            'radius': distance(KILLEROO_MIDPOINT, KILLEROO_EYE),
+            'plane': 'xy', 'start': 0, 'end': 360,
+        },
+    },
+}
+
+
+def register_camera(name, path):
+    """Add a --camera path, e.g. from another script."""
+    CAMERAS[name] = path
+
 
+def load_camera(camera):
+    """The path of a --camera name or JSON file."""
+    if camera in CAMERAS:
+        return CAMERAS[camera]
+    if os.path.isfile(camera):
+        try:
+            with open(camera) as f:
+                path = json.load(f)
+        except ValueError as e:
+            raise RuntimeError('Invalid camera path %s: %s' % (camera, e))
+        if not isinstance(path, dict) or 'eye' not in path:
+            raise RuntimeError('Camera path %s has no eye track' % camera)
+        return path
+    raise RuntimeError('Invalid camera %r, expected one of %s or a JSON file' %
+                       (camera, ', '.join(sorted(CAMERAS))))
 
-# rotate in xz plane, for the bathroom video.
-def arc_xz(center, radius, npoints, min_angle, max_angle):
-    points = np.linspace(min_angle, max_angle, npoints)
-    
-    vals = np.array([ [radius * cos(x), 0, radius * sin(x)] for x in points])
 
-    if 1:
-      for v in vals:
-        print(v)
+def _point(p):
+    p = np.asarray(p, dtype=float)
+    if p.shape != (3,):
+        raise RuntimeError('Expected a point [x, y, z], got %r' % (p.tolist(),))
+    return p
 
-    vals += center
-    return vals
+
+def _ease(track, t):
+    name = track.get('ease', 'linear')
+    if name not in EASES:
+        raise RuntimeError('Invalid ease %r, expected one of %s' %
+                           (name, ', '.join(sorted(EASES))))
+    return EASES[name](t)
+
+
+def _arc(track, t):
+    center = _point(track['center'])
+    plane = track.get('plane', 'xy')
+    if 'axes' in track:
+        u, v = [_point(a) for a in track['axes']]
+    elif plane in PLANES:
+        u, v = [np.array(a, dtype=float) for a in PLANES[plane]]
+    else:
+        raise RuntimeError('Invalid plane %r, expected one of %s' %
+                           (plane, ', '.join(sorted(PLANES))))
+    start = np.radians(track.get('start', 0))
+    end = np.radians(track.get('end', 360))
+    angles = start + (end - start) * _ease(track, t)
+    radius = track['radius']
+    return (center + np.cos(angles)[:, None] * (radius * u)
+            + np.sin(angles)[:, None] * (radius * v))
+
+
+def _spline(track, t):
+    points = np.array([_point(p) for p in track['points']])
+    n = len(points)
+    if n < 2:
+        raise RuntimeError('A spline needs at least 2 points')
+    times = np.asarray(track.get('times', np.linspace(0, 1, n)), dtype=float)
+    if len(times) != n or (np.diff(times) <= 0).any():
+        raise RuntimeError('Spline times must increase, one per point')
+
+    # Segment i goes from points[i] to points[i + 1], as a cubic in u from 0
+    # to 1.  The ends are repeated, so the spline stops at them.
+    i = np.arange(n - 1)
+    p0 = points[np.maximum(i - 1, 0)]
+    p1 = points[i]
+    p2 = points[i + 1]
+    p3 = points[np.minimum(i + 2, n - 1)]
+    coefs = 0.5 * np.stack([2 * p1, p2 - p0, 2 * p0 - 5 * p1 + 4 * p2 - p3,
+                            3 * p1 - p0 - 3 * p2 + p3], axis=1)
+
+    s = times[0] + (times[-1] - times[0]) * _ease(track, t)
+    i = np.clip(np.searchsorted(times, s, side='right') - 1, 0, n - 2)
+    u = ((s - times[i]) / np.diff(times)[i])[:, None]
+    c = coefs[i]
+    return c[:, 0] + u * (c[:, 1] + u * (c[:, 2] + u * c[:, 3]))
+
+
+def _dolly(track, t):
+    start = _point(track['from'])
+    end = _point(track['to'])
+    return start + (end - start) * _ease(track, t)[:, None]
+
+
+TRACK_TYPES = {
+    'arc': _arc,
+    'spline': _spline,
+    'dolly': _dolly,
+    'fixed': lambda track, t: np.tile(_point(track['point']), (len(t), 1)),
+}
+
+
+def eval_track(track, t):
+    """Positions of a track at times t.  Returns an (len(t), 3) array."""
+    t = np.asarray(t, dtype=float)
+    if isinstance(track, list) and track and isinstance(track[0], dict):
+        # Segments one after the other
+        durations = np.array([seg.get('duration', 1.0) for seg in track],
+                             dtype=float)
+        ends = np.cumsum(durations) / durations.sum()
+        starts = np.concatenate([[0.0], ends[:-1]])
+        which = np.minimum(np.searchsorted(ends, t, side='left'),
+                           len(track) - 1)
+        out = np.empty((len(t), 3))
+        for k, seg in enumerate(track):
+            mask = which == k
+            if mask.any():
+                local = (t[mask] - starts[k]) / (ends[k] - starts[k])
+                out[mask] = eval_track(seg, np.clip(local, 0, 1))
+        return out
+    if not isinstance(track, dict):
+        return np.tile(_point(track), (len(t), 1))
+    kind = track.get('type')
+    if kind not in TRACK_TYPES:
+        raise RuntimeError('Invalid track type %r, expected one of %s' %
+                           (kind, ', '.join(sorted(TRACK_TYPES))))
+    try:
+        return TRACK_TYPES[kind](track, t)
+    except KeyError as e:
+        raise RuntimeError('%s track needs %s' % (kind, e))
+
+
+def camera_path(path, num_frames):
+    """Evaluate a camera path for every frame.
+
+    Returns:
+      dict with 'eye', and 'look_at' and 'up' if the path has them: each an
+      (num_frames, 3) array
+    """
+    t = np.linspace(0, 1, num_frames)
+    result = {'eye': eval_track(path['eye'], t)}
+    for name in ('look_at', 'up'):
+        if name in path:
+            result[name] = eval_track(path[name], t)
+    return result
 
 
 if __name__ == "__main__":
-    points = circle([1,0,0], 3, 100, pi/6)
+    import matplotlib.pyplot as plt
+
+    points = camera_path({
+        'eye': {'type': 'arc', 'center': [1, 0, 0], 'radius': 3,
+                'end': 30}}, 100)['eye']
     # slice points
     flatpoints = points[:, :2]
-    xlinspace = np.linspace(0, 2 * pi, 100)
 
     print(distance([0,0,0], [1,0,0]))
 
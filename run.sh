@@ -37,6 +37,7 @@
 #   - Set FRAMES_PER_MACHINE
 #
 #   ./run.sh gen-pbrt-bathroom to generates input files
+#   ./run.sh plan-shards-bathroom  # balance predicted render time
 #
 #   MAYBE: ./run.sh remove-remote  # if there is anythinng left over
 #   ./run.sh copy-pbrt-bathroom
@@ -77,15 +78,41 @@ deps() {
 readonly PBRT_REMOTE=/home/$USER/bin/pbrt 
 readonly ANDY_PBRT_BUILD=~andy/git/other/pbrt-v3-build/pbrt 
 
-pbrt() {
+pbrt-bin() {
   if [[ "$USER" == "caroline_lin" ]]; then
-    ~/pbrt-exec "$@"
+    echo ~/pbrt-exec
   elif [[ "$USER" == "andy" ]]; then
-    $ANDY_PBRT_BUILD "$@"
+    echo $ANDY_PBRT_BUILD
   else
-    echo "Caroline: please only run this on Heap!"
-    exit 1
+    echo "Caroline: please only run this on Heap!" >&2
+    return 1
+  fi
+}
+
+pbrt() {
+  local bin
+  bin=$(pbrt-bin)
+  $bin "$@"
+}
+
+# Render a directory of frame .pbrt files.  Frames that are already done are
+# skipped, so this resumes after a crash.  Set RENDER_CMD to test without
+# pbrt, e.g. RENDER_CMD='render/stand_in_pbrt.py --sleep 1'
+render-dir() {
+  local render_cmd=${RENDER_CMD:-}
+  if test -z "$render_cmd"; then
+    render_cmd=$(pbrt-bin)
   fi
+  ./render_executor.py --render-cmd "$render_cmd" "$@"
+}
+
+# Render coarse to fine, with a preview video of the whole animation after
+# each level.  e.g.
+#   ./run.sh render-dir-preview _out/4d/bathroom
+render-dir-preview() {
+  local dir=$1
+  shift
+  render-dir --order bisect --preview-video $dir/preview.mp4 "$@" $dir
 }
 
 copy-pbrt-bin() {
@@ -146,18 +173,20 @@ exr-to-jpg() {
   convert $exr _out/jpg/${name}.jpg
 }
 
-readonly NPROC=$(( $(nproc) - 1 ))
+# Leave a CPU free, but use the only one on a 1-CPU machine
+readonly NPROC=$(( $(nproc) > 1 ? $(nproc) - 1 : 1 ))
 
 k-jpg() {
   echo _out/exr/k-*.exr | xargs --verbose -n 1 -P $NPROC -- $0 exr-to-jpg
 }
 
 # NOTE: 'convert' on Ubuntu seems to produce videos that can't be opened with
-# the Apple ecosystem: Safari on OS X, QuickTime, iPad, iPhone.
+# the Apple ecosystem: Safari on OS X, QuickTime, iPad, iPhone.  (I think
+# ImageMagick delegates to ffmpeg anyway.)
 #
-# See join-ffmpeg below for a command line that works.
-#
-# I think ImageMagick delegates to ffmpeg anyway.
+# video_assembler.py pipes the frames to ffmpeg itself, with settings that
+# work there.  It reads one frame at a time, so it doesn't need the memory
+# for all of them.
 
 # https://superuser.com/questions/249101/how-can-i-combine-30-000-images-into-a-timelapse-movie
 
@@ -165,15 +194,10 @@ join-frames() {
   local out=$1
   shift
 
-  # 41.66 ms is 24 fps
-  # ticks are 10ms, so delay is 4.166
-  #local delay=4.1666
-  local delay=10
-
-  #local delay=50
+  # convert -delay 10 was 10 ticks of 10 ms, i.e. 10 fps
+  local fps=${FPS:-10}
 
-  time convert -delay $delay -quality 95 "$@" $out
-  echo "Wrote $out"
+  time ./video_assembler.py --fps $fps --out $out "$@"
 }
 
 k-video() {
@@ -199,13 +223,14 @@ gen-pbrt-4d() {
 
   local out_dir=_out/4d/$sch
   mkdir -p $out_dir
-  rm -v -f $out_dir/*
 
   # split 5 3 3 into 5 3 3
   local -a sch_array=( ${sch//-/ } )
   ./polytope.py \
     --num-frames $num_frames \
     --camera '120cell' \
+    --mesh lattice \
+    --jobs $NPROC \
     --out-dir $out_dir \
     --out-template ${sch}_frame%02d \
     pbrt "${sch_array[@]}"
@@ -214,8 +239,8 @@ gen-pbrt-4d() {
 }
 
 gen-all-4d() {
-  # This one gives a Convex Hull error
-  #gen-pbrt-4d 3-3-3
+  # This one gave a Convex Hull error before --mesh lattice
+  gen-pbrt-4d 3-3-3
   gen-pbrt-4d 4-3-3
   gen-pbrt-4d 3-4-3
   gen-pbrt-4d 3-3-4
@@ -223,10 +248,84 @@ gen-all-4d() {
   gen-pbrt-4d 3-3-5
 }
 
+# Like gen-pbrt-4d, but the meshes of all frames go in one file instead of a
+# .ply per frame.  render_executor.py exports the .ply files it renders, e.g.
+#   ./render_executor.py --shard 0/2 _out/4d-archive/5-3-3
+gen-pbrt-4d-archive() {
+  local sch=${1:-'5-3-3'}  # schlafli number
+  local num_frames=${2:-48}
+
+  local out_dir=_out/4d-archive/$sch
+  mkdir -p $out_dir
+
+  local -a sch_array=( ${sch//-/ } )
+  ./polytope.py \
+    --num-frames $num_frames \
+    --camera '120cell' \
+    --mesh lattice \
+    --jobs $NPROC \
+    --geometry-archive ${sch}.geom \
+    --out-dir $out_dir \
+    --out-template ${sch}_frame%02d \
+    pbrt "${sch_array[@]}"
+
+  ls -l $out_dir
+}
+
+# 5D and up: cut down to 4D through the center, then sliced like the others.
+# The cut has no face lattice, so the mesh is the convex hull.
+gen-pbrt-nd() {
+  local sch=${1:-'4-3-3-3'}  # schlafli number
+  local num_frames=${2:-48}
+
+  local out_dir=_out/nd/$sch
+  mkdir -p $out_dir
+
+  local -a sch_array=( ${sch//-/ } )
+  ./polytope.py \
+    --num-frames $num_frames \
+    --camera '120cell' \
+    --jobs $NPROC \
+    --out-dir $out_dir \
+    --out-template ${sch}_frame%02d \
+    pbrt "${sch_array[@]}"
+
+  ls -l $out_dir
+}
+
+gen-pbrt-rotating() {
+  local sch=${1:-'5-3-3'}  # schlafli number
+  local num_frames=${2:-240}
+  local rotation=${3:-'xw=360,yz=0:90'}
+
+  local out_dir=_out/rotating/$sch
+  mkdir -p $out_dir
+
+  local -a sch_array=( ${sch//-/ } )
+  ./polytope.py \
+    --num-frames $num_frames \
+    --camera '120cell' \
+    --rotate-4d "$rotation" \
+    --jobs $NPROC \
+    --out-dir $out_dir \
+    --out-template ${sch}_frame%03d \
+    pbrt "${sch_array[@]}"
+
+  ls -l $out_dir
+}
+
+gen-all-nd() {
+  gen-pbrt-nd 3-3-3-3  # 5-simplex
+  gen-pbrt-nd 4-3-3-3  # 5-cube
+  gen-pbrt-nd 3-3-3-4  # 5-orthoplex
+  gen-pbrt-nd 4-3-3-3-3
+  gen-pbrt-nd 4-3-3-3-3-3
+}
+
 render-4d() {
   # 3:38 for 5 low quality videos
-  time for input in _out/4d/*/*.pbrt; do
-    pbrt $input
+  time for dir in _out/4d/*/; do
+    render-dir $dir
   done
 }
 
@@ -250,10 +349,7 @@ gen-120-cell() {
 
 # 1:01 at low quality
 render-120-cell() {
-  rm -v -f _out/4d/5-3-3/*.png
-  time for input in _out/4d/5-3-3/*.pbrt; do
-    pbrt $input
-  done
+  time render-dir _out/4d/5-3-3
 }
 
 video-120-cell() {
@@ -311,8 +407,13 @@ readonly NUM_BATHROOM_FRAMES=$(( FRAMES_PER_MACHINE * NUM_MACHINES ))
 # 8 minutes * 30 frames = 240 minutes = 4 hours
 
 gen-pbrt-bathroom() {
+  # Frames that come out the same keep their files and images.  See
+  # manifest.json in $out_dir.  The lights and materials are written once, to
+  # 4d-contemporary-bathroom.world-*.pbrt, which each frame Includes.
   local out_dir=$BATHROOM_OUT
-  rm -v -f $out_dir/frame*.{ply,pbrt,png}
+
+  # Shard plans are for the old frames.  Rerun plan-shards-bathroom.
+  rm -f -v $out_dir/shard-*.json
 
   ./polytope.py \
     --num-frames $NUM_BATHROOM_FRAMES \
@@ -325,6 +426,9 @@ gen-pbrt-bathroom() {
     --out-template 'frame%03d' \
     --camera bathroom \
     --ply-rotation \
+    --ply-format binary \
+    --shared-world \
+    --jobs $NPROC \
     pbrt 5 3 3
 
   ls $out_dir
@@ -332,7 +436,6 @@ gen-pbrt-bathroom() {
 
 gen-pbrt-bathroom-quick() {
   local out_dir=$BATHROOM_OUT
-  rm -v -f $out_dir/frame*.{ply,pbrt,png}
 
   #local num_frames=10
   local num_frames=30  # To see rotation more clearly
@@ -348,12 +451,64 @@ gen-pbrt-bathroom-quick() {
     --out-template 'frame%03d' \
     --camera bathroom \
     --ply-rotation \
+    --ply-format binary \
+    --shared-world \
+    --jobs $NPROC \
     pbrt 5 3 3
     #--camera fixed \
 
   ls $out_dir
 }
 
+# Generate and render at the same time: frame 0 renders while later frames
+# are still being sliced.  Finished frames are appended to
+# $BATHROOM_OUT/finished-frames.txt.  Frames rendered before with the same
+# .ply, .pbrt and renderer are copied from $FRAME_CACHE_DIR instead.  To test
+# without pbrt:
+#
+#   RENDER_CMD='render/stand_in_pbrt.py --sleep 1' ./run.sh stream-bathroom-quick
+stream-bathroom-quick() {
+  local out_dir=$BATHROOM_OUT
+  local render_cmd=${RENDER_CMD:-$ANDY_PBRT_BUILD}
+
+  ./polytope.py \
+    --num-frames 30 \
+    --frame-template 4d-contemporary-bathroom.template \
+    --width 400 \
+    --height 400 \
+    --pixel-samples 16 \
+    --integrator-depth 3 \
+    --out-dir $out_dir  \
+    --out-template 'frame%03d' \
+    --camera bathroom \
+    --ply-rotation \
+    --ply-format binary \
+    --shared-world \
+    --render-cmd "$render_cmd" \
+    pbrt 5 3 3
+}
+
+# Check the motion and framing of a bathroom run in seconds, without pbrt.
+# Writes frame*.preview.png with a NumPy rasterizer.
+preview-bathroom() {
+  local out_dir=${1:-_out/4d/bathroom-preview}
+  mkdir -p $out_dir
+  rm -v -f $out_dir/frame*.preview.png
+
+  ./polytope.py \
+    --num-frames $NUM_BATHROOM_FRAMES \
+    --frame-template 4d-contemporary-bathroom.template \
+    --width 400 \
+    --height 400 \
+    --out-dir $out_dir  \
+    --out-template 'frame%03d' \
+    --camera bathroom \
+    --ply-rotation \
+    preview 5 3 3
+
+  ls $out_dir
+}
+
 gen-pbrt-bathroom-pngtest() {
   local out_dir=$BATHROOM_OUT
   rm -v -f $out_dir/frame*.{ply,pbrt,png}
@@ -417,8 +572,10 @@ copy-pbrt-bathroom() {
       $BATHROOM_OUT/ "$machine:/home/$USER/pbrt-video/$BATHROOM_OUT/"
 
     # So we can run ./run.sh dist-render-bathroom on each machine
-    rsync --archive --verbose \
-      $0 "$machine:/home/$USER/pbrt-video/"
+    rsync --archive --verbose --relative \
+      $0 render_executor.py pipeline.py geometry_archive.py video_assembler.py \
+      render/generate_ply.py render/ply-header.template \
+      "$machine:/home/$USER/pbrt-video/"
 
     echo $i > worker-id.txt
 
@@ -429,45 +586,32 @@ copy-pbrt-bathroom() {
   done
 }
 
-# Do mod-sharding on worker ID!
-should-render-frame() {
-  local path=$1
-  local worker_id=$2
-
-  python3 -c '
-import re
-import sys
-
-num_workers = int(sys.argv[1])
-path = sys.argv[2]
-worker_id = int(sys.argv[3])
-
-m = re.search("frame(\d+)", path)
-if not m:
-  print("INVALID PATH %s" % path)
-  sys.exit(2)
-
-frame_number = int(m.group(1))
-
-# mod sharding!
-should_render = (frame_number % num_workers == worker_id)
-sys.exit(0 if should_render else 1)
-
-  ' $NUM_MACHINES $path $worker_id
+# Write shard-*.json to $BATHROOM_OUT, which copy-pbrt-bathroom copies to the
+# workers.  Prints the predicted makespan for MACHINES and
+# FRAMES_PER_MACHINE.
+plan-shards-bathroom() {
+  ./shard_planner.py --workers $NUM_MACHINES "$@" $BATHROOM_OUT
 }
 
 dist-render-bathroom() {
   local worker_id=$(cat worker-id.txt)
-  local hostname=$(hostname)
-  time for input in ~/pbrt-video/$BATHROOM_OUT/frame*.pbrt; do
-    if should-render-frame $input $worker_id; then
-      echo
-      echo "=== $input on $hostname ==="
-      echo
-      # 22 hyperthreads out of 24, or 11 out of 12 cores.
-      $PBRT_REMOTE --nthreads 22 $input
-    fi
-  done
+  echo "=== $(hostname) is worker $worker_id of $NUM_MACHINES ==="
+
+  # The frames from plan-shards-bathroom, or every Nth frame.
+  local plan=~/pbrt-video/$BATHROOM_OUT/shard-$worker_id.json
+  local -a shard_flags
+  if test -f $plan; then
+    shard_flags=( --shard-plan $plan )
+  else
+    shard_flags=( --shard $worker_id/$NUM_MACHINES )
+  fi
+
+  # One render at a time, with all the hyperthreads.  Rerun after a crash to
+  # resume.
+  time ./render_executor.py \
+    --render-cmd $PBRT_REMOTE \
+    "${shard_flags[@]}" \
+    ~/pbrt-video/$BATHROOM_OUT
 
   # So we can inspect each machine
   date > finish-time.txt
@@ -478,16 +622,21 @@ dist-render-bathroom() {
 
 # 1:01 at low quality
 render-bathroom() {
-  rm -v -f $BATHROOM_OUT/*.png
-  time for input in $BATHROOM_OUT/frame*.pbrt; do
-    pbrt $input
-  done
+  time render-dir $BATHROOM_OUT
 }
 
 video-bathroom() {
   join-frames _out/4d/bathroom.mp4 $BATHROOM_OUT/*.png 
 }
 
+# Encode the bathroom frames while they're rendered or copied back, e.g. in
+# another shell during dist-render-bathroom.  Gives up on a missing frame
+# after 10 minutes with no new frames.
+stream-video-bathroom() {
+  ./video_assembler.py --fps ${FPS:-10} --idle-timeout 600 \
+    --out _out/4d/bathroom.mp4 $BATHROOM_OUT
+}
+
 video-remote-bathroom() {
   #join-frames _out/4d/remote-bathroom.mp4 $JOIN_DIR/*.png 
   join-frames _out/4d/remote-bathroom.mp4 $JOIN_DIR/*.800x800.png 
@@ -533,16 +682,27 @@ save-3d-anim() {
   ./polytope.py \
     --num-frames 60 \
     --fps 6 \
+    --jobs $NPROC \
     --mpl-mp4-out-template '_out/matplotlib-2d-%d-%d.mp4' \
     anim 5 3 
 
   ./polytope.py \
     --num-frames 60 \
     --fps 6 \
+    --jobs $NPROC \
     --mpl-mp4-out-template '_out/matplotlib-2d-%d-%d.mp4' \
     anim 4 3 
 }
 
+save-4d-anim() {
+  # 3D slices of the 600-cell, which has the most triangles
+  ./polytope.py \
+    --num-frames 90 \
+    --fps 15 \
+    --mpl-mp4-out-template '_out/matplotlib-3d-%d-%d-%d.mp4' \
+    anim 3 3 5
+}
+
 # ffmpeg -r 1/5 -i img%03d.png -c:v libx264 -vf fps=25 -pix_fmt yuv420p out.mp4
 
 # https://stackoverflow.com/questions/24961127/how-to-create-a-video-from-images-with-ffmpeg
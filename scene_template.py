@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+scene_template.py
+
+Compile a frame template like 4d-contemporary-bathroom.template once, and
+expand it for each frame.
+
+Most of a scene is the same in every frame: lights, materials and the
+Include of the bathroom geometry.  Only the camera, the film and the
+polytope's Shape change.  With shared_world=True, the world is split into
+top-level statements and AttributeBegin/AttributeEnd blocks, and each run of
+them that doesn't use a per-frame field is written once to a shared .pbrt
+file.  Each frame file then has its own camera, film and polytope lines, and
+Includes the shared files in their original places, so the scene is the same.
+A run of just Include statements stays in the frame file, since what it
+Includes is already shared.
+"""
+
+import hashlib
+import re
+
+
+# Fields that change from frame to frame.  The others (width, pixel_samples,
+# ...) are the same for every frame of a run.
+PER_FRAME_FIELDS = frozenset([
+    'out_filename', 'ply_filename', 'eye_x', 'eye_y', 'eye_z', 'ply_rotation',
+    'look_x', 'look_y', 'look_z', 'up_x', 'up_y', 'up_z',
+])
+
+FIELD_RE = re.compile(r'%\((\w+)\)')
+
+# Statements that open and close a nested block.
+BEGIN_RE = re.compile(r'\s*(AttributeBegin|TransformBegin|ObjectBegin)\b')
+END_RE = re.compile(r'\s*(AttributeEnd|TransformEnd|ObjectEnd)\b')
+
+# The shared files are written next to the frames, so frame globs like *.pbrt
+# have to skip them.
+SHARED_FILE_RE = re.compile(r'\.world-[0-9a-f]{10}\.pbrt$')
+
+# A statement starts with a directive like Shape or LookAt.  Other lines are
+# parameters continuing the statement above, or comments or blank lines.
+DIRECTIVE_RE = re.compile(r'\s*[A-Z][A-Za-z]*\b')
+
+
+def _IsPerFrame(text):
+  return any(name in PER_FRAME_FIELDS for name in FIELD_RE.findall(text))
+
+
+def _OnlyIncludes(text):
+  """Whether text is just Include statements, comments and blank lines.
+  Those are already shared, so they stay in the frame file."""
+  for line in text.splitlines():
+    line = line.strip()
+    if line and not line.startswith('#') and not line.startswith('Include'):
+      return False
+  return True
+
+
+def IsSharedFile(path):
+  """Whether path is a shared world file, rather than a frame."""
+  return bool(SHARED_FILE_RE.search(path))
+
+
+def _SplitWorld(lines):
+  """Split world lines into top-level units: a block, or a statement with its
+  continuation lines.  Comments and blank lines go with the unit below."""
+  units = []
+  pending = []  # comments and blank lines
+  depth = 0
+  for line in lines:
+    if depth == 0 and DIRECTIVE_RE.match(line):
+      units.append(pending + [line])
+      pending = []
+    elif depth == 0 and (not line.strip() or line.lstrip().startswith('#')):
+      pending.append(line)
+    else:
+      if not units:
+        units.append([])
+      units[-1].extend(pending + [line])
+      pending = []
+    if BEGIN_RE.match(line):
+      depth += 1
+    elif END_RE.match(line):
+      depth = max(0, depth - 1)
+  if pending:
+    if units:
+      units[-1].extend(pending)
+    else:
+      units.append(pending)
+  return [''.join(unit) for unit in units]
+
+
+class FrameTemplate(object):
+  """A frame template, with its per-frame parts found up front."""
+
+  def __init__(self, text, name='frame', run_fields=None, shared_world=False):
+    """
+    Args:
+      text: the template, with %(field)s substitutions
+      name: used to name the shared files, e.g. the template's basename
+      run_fields: dict of the fields that are the same for every frame.
+        They're substituted into the shared files.
+      shared_world: whether to split out the shared world
+    """
+    self.shared_files = []  # (filename, text)
+    self.field_names = frozenset(FIELD_RE.findall(text))
+
+    if not shared_world:
+      self.parts = [text]  # one template for the whole frame
+      return
+
+    lines = text.splitlines(True)
+    try:
+      begin = next(i for i, line in enumerate(lines)
+                   if line.strip() == 'WorldBegin')
+      end = next(i for i in range(len(lines) - 1, begin, -1)
+                 if lines[i].strip() == 'WorldEnd')
+    except StopIteration:
+      raise RuntimeError(
+          "Can't share the world of %s: no WorldBegin/WorldEnd" % name)
+
+    # Options before WorldBegin are per-frame: the camera and film.
+    self.parts = [''.join(lines[:begin + 1])]
+    static = []
+    for unit in _SplitWorld(lines[begin + 1:end]) + [None]:
+      if unit is not None and not _IsPerFrame(unit):
+        static.append(unit)
+        continue
+      if static and _OnlyIncludes(''.join(static)):
+        self.parts.extend(static)
+        static = []
+      if static:
+        shared_text = ''.join(static) % (run_fields or {})
+        h = hashlib.sha1(shared_text.encode('utf-8')).hexdigest()[:10]
+        filename = '%s.world-%s.pbrt' % (name, h)
+        self.shared_files.append((filename, shared_text))
+        self.parts.append('Include "%s"\n' % filename)
+        static = []
+      if unit is not None:
+        self.parts.append(unit)
+    self.parts.append(''.join(lines[end:]))
+
+  def Expand(self, fields):
+    """Returns the text of a frame.  fields has every field."""
+    return ''.join(part % fields for part in self.parts)
+
+  def ExpandAll(self, fields):
+    """The frame text with the shared files inlined.  Used for cache keys."""
+    shared = dict((('Include "%s"\n' % filename), text)
+                  for filename, text in self.shared_files)
+    return ''.join(shared.get(part) or part % fields for part in self.parts)
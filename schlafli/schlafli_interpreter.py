@@ -18,9 +18,12 @@
 #
 
 import argparse
+import struct
 import sys
 from math import *
 
+import numpy as np
+
 # vector minus vector.
 def vmv(a,b): return [x-y for x,y in zip(a,b)]
 # matrix minus matrix.
@@ -85,76 +88,164 @@ def calcSymmetryGenerators(schlafli):
   generators.append(makehomo(householderReflection(v)))
   return generators
 
+# Key for comparing coords with roundoff error: coordinates are quantized to
+# integers.  Vertices of an edge-length-1 polytope are much further apart than
+# 1/KEY_SCALE, so distinct vertices get distinct keys.  (Rounding also takes
+# care of "-0".)
+#
+# Roundoff error grows with the size of the polytope (it's around 1e-5 for
+# {10000}), and any grid has cell boundaries that equal vertices can straddle,
+# so a vertex whose key isn't found is also looked up in the neighboring cells
+# it's close to; see nearVertKeys().
+KEY_SCALE = 1e3
+
+def verts2keys(verts):
+  return np.rint(np.asarray(verts) * KEY_SCALE).astype(np.int64)
+
+
+# Keys of the cells next to vert's cell, in the directions where vert is
+# within a quarter cell of the boundary.  This runs for every new vertex, so
+# it's plain Python: NumPy calls on one short vector cost more than the math.
+def nearVertKeys(vert):
+  scaled = [x * KEY_SCALE for x in vert.tolist()]
+  key = [int(round(x)) for x in scaled]  # rounds half to even, like np.rint
+  near = [(axis, 1 if x > k else -1)
+          for axis, (x, k) in enumerate(zip(scaled, key)) if abs(x - k) > .25]
+  pack = struct.Struct('=%dq' % len(key)).pack  # like int64 tobytes()
+  for mask in range(1, 2**len(near)):
+    neighbor = list(key)
+    for bit, (axis, step) in enumerate(near):
+      if mask >> bit & 1:
+        neighbor[axis] += step
+    yield pack(*neighbor)
+
+
+# Grow a list of items (vertices, or vertex index lists of elements) until
+# it's closed under transform().  Items are processed a whole frontier at a
+# time: transform() maps an (n, k) array of items to an (n, numGens, k) array
+# of their images, and keyfunc() maps items to integer keys for deduplication.
+# If a key isn't found, the keys that nearKeys(item) yields are tried too.
 #
-# NOTE(andychu): Can we get rid of this ???  Seems ugly.
+# New items are appended in the same order as transforming one item with one
+# generator at a time would append them, so indices are the same.
 #
+# Returns (items, table), where table[i][g] is the index of the image of item i
+# under generator g, or -1 if it's not in the list.  Items with a negative
+# first key (i.e. that reference a vertex over the vertex limit) are skipped,
+# and so are new items beyond the limit.
+def closure(items, transform, keyfunc, nearKeys=None, limit=None,
+            skipNegative=False):
+  items = np.asarray(items)
+  keys = keyfunc(items)
+  rowBytes = keys.shape[1] * keys.itemsize
+  index = {}
+  for i, key in enumerate(_splitBytes(keys, rowBytes)):
+    index.setdefault(key, i)
+
+  chunks = [items]
+  numItems = len(items)
+  table = []  # flat, since a big {p} polygon has 1000s of 2-item frontiers
+  frontier = items
+  while len(frontier):
+    images = transform(frontier)  # (n, numGens, k)
+    numGens = images.shape[1]
+    images = images.reshape(-1, images.shape[2])
+    imageKeys = keyfunc(images)
+    if skipNegative:
+      valid = (imageKeys[:, 0] != -1).tolist()
+
+    newRows = []
+    for j, key in enumerate(_splitBytes(imageKeys, rowBytes)):
+      if skipNegative and not valid[j]:
+        table.append(-1)
+        continue
+      i = index.get(key)
+      if i is None and nearKeys is not None:
+        for near in nearKeys(images[j]):
+          i = index.get(near)
+          if i is not None:
+            index[key] = i
+            break
+      if i is None:
+        if limit is None or numItems < limit:
+          i = numItems
+          numItems += 1
+          newRows.append(j)
+        else:
+          i = -1
+        index[key] = i
+      table.append(i)
 
-# Key for comparing coords with roundoff error.  Makes sure the formatted
-# numbers are not very close to 0, to avoid them coming out as "-0" or "1e-16".
-# This isn't reliable in general, but it suffices for this application
-# (except for very large {p}, no doubt).
+    frontier = images[newRows]
+    chunks.append(frontier)
 
-def vert2key(vert):
-  return ' '.join('%.9g' % (x+.123) for x in vert)
+  return (np.concatenate(chunks),
+          np.array(table, dtype=np.intp).reshape(-1, numGens))
 
 
-# Returns a pair verts,edgesEtc where edgesEtc is [edges,faces,...]
-def regular_polytope(schlafli):
+def _splitBytes(keys, rowBytes):
+  b = np.ascontiguousarray(keys).tobytes()
+  return [b[i:i+rowBytes] for i in range(0, len(b), rowBytes)]
+
+
+# Returns a pair verts,edgesEtc where edgesEtc is [edges,faces,...], as NumPy
+# arrays: verts is (numVerts, dim) float, and each element array is
+# (numElts, numVertsPerElt) int.
+def regular_polytope_arrays(schlafli):
   dim = len(schlafli) + 1
   if dim == 1:
-    return [[0],[1]], []  # base case
+    return np.array([[0.],[1.]]), []  # base case
+
+  gens = np.array(calcSymmetryGenerators(schlafli), dtype=float)
+  rotations = gens[:, :, :-1]  # (numGens, dim, dim)
+  translations = gens[:, :, -1]  # (numGens, dim)
+  # Apply every generator to a batch of vertices with one matmul.
+  stacked = np.concatenate(list(rotations), axis=0).T  # (dim, numGens*dim)
 
-  gens = calcSymmetryGenerators(schlafli)
+  def transformVerts(verts):
+    images = np.dot(verts, stacked).reshape(len(verts), len(gens), dim)
+    return images + translations
 
-  facetVerts, facetEdgesEtc = regular_polytope(schlafli[:-1])
+  facetVerts, facetEdgesEtc = regular_polytope_arrays(schlafli[:-1])
 
   # First get all the verts, and make a multiplication table.
   # Start with the verts of the first facet (padded to full dimensionality),
   # so indices will match up.
-  verts = [facetVert+[0] for facetVert in facetVerts]
-  vert2index = dict([[vert2key(vert), i] for i, vert in enumerate(verts)])
-  multiplicationTable = []
-
-  iVert = 0
-  while iVert < len(verts):  # while verts is growing
-    multiplicationTable.append([None] * len(gens))
-    for iGen in range(len(gens)):
-      newVert = mxvhomo(gens[iGen], verts[iVert])
-      newVertKey = vert2key(newVert)
-      if newVertKey not in vert2index:
-        if len(verts) < vertexlimit:
-          vert2index[newVertKey] = len(verts)
-          verts.append(newVert)
-        else:
-          vert2index[newVertKey] = -1
-      multiplicationTable[iVert][iGen] = vert2index[newVertKey]
-    iVert += 1
+  verts = np.zeros((len(facetVerts), dim))
+  verts[:, :-1] = facetVerts
+  limit = None if vertexlimit >= 1e100 else int(vertexlimit)
+  verts, multiplicationTable = closure(verts, transformVerts, verts2keys,
+                                       nearKeys=nearVertKeys, limit=limit)
 
   # The higher-level elements of each dimension are found by transforming
   # the facet's elements of that dimension.  Start by augmenting facetEdgesEtc
   # by adding one more list representing the entire facet.
-  facetEdgesEtc.append([tuple(range(len(facetVerts)))])
+  facetEdgesEtc = facetEdgesEtc + [np.arange(len(facetVerts)).reshape(1, -1)]
+
+  def transformElts(elts):
+    # Canonical sorted form of each element's image under each generator
+    images = multiplicationTable[elts]  # (n, numVertsPerElt, numGens)
+    return np.sort(images.transpose(0, 2, 1), axis=2)
+
   edgesEtc = []
   for facetElementsOfSomeDimension in facetEdgesEtc:
-    elts = facetElementsOfSomeDimension[:]
-    elt2index = dict([[elt, i] for i, elt in enumerate(elts)])
-    iElt = 0
-    while iElt < len(elts):  # while elts is growing
-      for iGen in range(len(gens)):
-        # andychu: Hm this is just generating a canonical sorted form for every
-        # edge/face, and then we check it's already there?
-        newElt = tuple(sorted([multiplicationTable[iVert][iGen]
-                               for iVert in elts[iElt]]))
-        if newElt[0] != -1:
-          if newElt not in elt2index:  # deduplicate
-            elt2index[newElt] = len(elts)
-            elts.append(newElt)
-      iElt += 1
+    elts, _ = closure(facetElementsOfSomeDimension, transformElts,
+                      lambda elts: np.asarray(elts, dtype=np.int64),
+                      skipNegative=True)
     edgesEtc.append(elts)
 
   return verts, edgesEtc
 
 
+# Returns a pair verts,edgesEtc where edgesEtc is [edges,faces,...]
+# verts is a list of coordinate lists, and each element list is a list of
+# vertex index tuples.
+def regular_polytope(schlafli):
+  verts, edgesEtc = regular_polytope_arrays(schlafli)
+  return (verts.tolist(),
+          [[tuple(elt) for elt in elts.tolist()] for elts in edgesEtc])
+
+
 # So input numbers can be like any of "8", "2.5", "7/3"
 def parseNumberOrFraction(s):
   tokens = s.split('/')
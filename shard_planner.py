@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+shard_planner.py
+
+Split the frames of a directory between render machines by their predicted
+render time, instead of by frame number.
+
+A frame's render time is predicted from the resolution, pixel_samples and
+integrator_depth that polytope.py recorded in manifest.json, and from the
+number of faces in its .ply file (or geometry archive).  The model is a least
+squares fit to recorded timings, e.g. _quality/times_small.tsv from
+quality.sh.
+
+Each worker gets a plan file listing its frames, which
+render_executor.py --shard-plan reads.  The predicted time of each worker,
+and the makespan (the time until the last one finishes), are printed next to
+those of modulo sharding.
+
+Usage:
+  ./shard_planner.py [options] DIR
+
+Examples:
+  ./shard_planner.py --workers 3 _out/4d/bathroom
+  ./shard_planner.py --workers 3 --timings _quality/times_small.tsv \\
+      --dry-run _out/4d/bathroom
+"""
+
+import heapq
+import json
+import optparse
+import os
+import sys
+
+import numpy as np
+from scipy import optimize
+
+import geometry_archive
+import pipeline
+
+
+# The name of worker i's plan file in the directory.
+PLAN_TEMPLATE = 'shard-%d.json'
+
+# When the timings don't have a num_faces column, assume each doubling of
+# the faces makes tracing this fraction slower.  It's a guess, which timings
+# with num_faces replace.
+DEFAULT_FACE_COST = 0.02
+
+PLY_FACES_PREFIX = b'element face '
+
+
+def _Features(megasamples, depth, faces):
+  """The terms of the cost model.  Arguments can be arrays.
+
+  Startup (parsing the scene) is constant.  Tracing is proportional to the
+  number of samples, and paths get longer with integrator_depth.  A bigger
+  polytope slice has more faces, and covers more pixels with glass, so
+  tracing is also scaled by the log of the faces.
+  """
+  megasamples = np.asarray(megasamples, dtype=float)
+  depth = np.asarray(depth, dtype=float)
+  log_faces = np.log2(1 + np.asarray(faces, dtype=float))
+  return np.stack([
+      np.ones_like(megasamples),
+      megasamples,
+      megasamples * depth,
+      megasamples * log_faces,
+      megasamples * depth * log_faces,
+  ], axis=-1)
+
+
+def ReadTimings(path):
+  """Read a TSV like _quality/times_small.tsv.
+
+  It needs the columns status, elapsed_secs, pixel_samples, depth, and
+  either dim (a square image) or width and height.  num_faces is optional.
+
+  Returns:
+    features: (n, 5) array
+    elapsed: (n,) array of seconds
+    has_faces: whether the timings have num_faces
+  """
+  rows = []
+  with open(path) as f:
+    header = f.readline().split()
+    for line in f:
+      if line.strip():
+        rows.append(dict(zip(header, line.split())))
+  if 'width' not in header and 'dim' not in header:
+    raise RuntimeError('%s: expected a dim or width column' % path)
+  for name in ('status', 'elapsed_secs', 'pixel_samples', 'depth'):
+    if name not in header:
+      raise RuntimeError('%s: expected a %s column' % (path, name))
+
+  rows = [row for row in rows if row['status'] == '0']
+  if not rows:
+    raise RuntimeError('%s: no successful timings' % path)
+  width = np.array([float(row.get('width') or row['dim']) for row in rows])
+  height = np.array([float(row.get('height') or row.get('width') or
+                           row['dim']) for row in rows])
+  samples = np.array([float(row['pixel_samples']) for row in rows])
+  depth = np.array([float(row['depth']) for row in rows])
+  faces = np.array([float(row.get('num_faces', 0)) for row in rows])
+  elapsed = np.array([float(row['elapsed_secs']) for row in rows])
+
+  features = _Features(width * height * samples / 1e6, depth, faces)
+  return features, elapsed, 'num_faces' in header
+
+
+def FitCostModel(features, elapsed, has_faces):
+  """Fit the coefficients of _Features() to timings.  None are negative."""
+  if has_faces:
+    coefs, _ = optimize.nnls(features, elapsed)
+    return coefs
+  coefs, _ = optimize.nnls(features[:, :3], elapsed)
+  return np.append(coefs, DEFAULT_FACE_COST * coefs[1:3])
+
+
+def PlyFaces(ply_path):
+  """The number of faces in a .ply file, from its header."""
+  with open(ply_path, 'rb') as f:
+    for line in f:
+      if line.startswith(PLY_FACES_PREFIX):
+        return int(line[len(PLY_FACES_PREFIX):])
+      if line.startswith(b'end_header'):
+        break
+  raise RuntimeError('No face count in %s' % ply_path)
+
+
+def FrameFaces(out_dir, manifest):
+  """The number of faces of each frame in the manifest, in its order."""
+  archive_name = manifest['options'].get('geometry_archive')
+  if archive_name:
+    archive = geometry_archive.GeometryArchive(
+        os.path.join(out_dir, archive_name))
+    starts = archive.table[:, 1]  # the first face of each frame
+    return [int(starts[frame['index'] + 1] - starts[frame['index']])
+            for frame in manifest['frames']]
+
+  faces = []
+  for frame in manifest['frames']:
+    pbrt_name = os.path.basename(frame['pbrt'])
+    faces.append(PlyFaces(
+        os.path.join(out_dir, os.path.splitext(pbrt_name)[0] + '.ply')))
+  return faces
+
+
+def PredictCosts(coefs, options, faces):
+  """Predicted render seconds of each frame."""
+  megasamples = (options['width'] * options['height'] *
+                 options['pixel_samples'] / 1e6)
+  features = _Features(np.full(len(faces), megasamples),
+                       options['integrator_depth'], faces)
+  return features @ coefs
+
+
+def PlanShards(costs, num_workers):
+  """Assign frames to workers, most expensive first, each to the worker
+  that would finish first.
+
+  Returns:
+    shards: for each worker, a sorted list of positions in costs
+    loads: predicted seconds of each worker
+  """
+  heap = [(0.0, w) for w in range(num_workers)]
+  shards = [[] for _ in range(num_workers)]
+  for i in np.argsort(-np.asarray(costs), kind='stable'):
+    load, w = heapq.heappop(heap)
+    shards[w].append(int(i))
+    heapq.heappush(heap, (load + costs[i], w))
+  loads = [sum(costs[i] for i in shard) for shard in shards]
+  return [sorted(shard) for shard in shards], loads
+
+
+def ModuloLoads(costs, indices, num_workers):
+  """Predicted seconds of each worker with render_executor.py --shard."""
+  loads = [0.0] * num_workers
+  for cost, index in zip(costs, indices):
+    loads[index % num_workers] += cost
+  return loads
+
+
+def _FormatSecs(secs):
+  return '%d:%02d' % divmod(int(round(secs)), 60)
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage='%prog [options] DIR',
+      description='Plan which render machine renders which frames.')
+  parser.add_option(
+      '--workers', type=int, default=1,
+      help='Number of render machines, e.g. $NUM_MACHINES in run.sh')
+  parser.add_option(
+      '--timings', type=str, default='_quality/times_small.tsv',
+      help='TSV of recorded render times to fit the cost model to')
+  parser.add_option(
+      '--dry-run', action='store_true',
+      help="Print the predicted times, but don't write the plan files")
+
+  opts, args = parser.parse_args(argv[1:])
+  if len(args) != 1:
+    raise RuntimeError('Directory required')
+  out_dir = args[0]
+  if opts.workers < 1:
+    raise RuntimeError('--workers must be at least 1')
+
+  manifest = pipeline.ReadManifest(out_dir)
+  if manifest is None:
+    raise RuntimeError('No %s in %s' % (pipeline.MANIFEST, out_dir))
+  frames = manifest['frames']
+
+  coefs = FitCostModel(*ReadTimings(opts.timings))
+  costs = PredictCosts(coefs, manifest['options'],
+                       FrameFaces(out_dir, manifest))
+  shards, loads = PlanShards(costs, opts.workers)
+  modulo = ModuloLoads(costs, [frame['index'] for frame in frames],
+                       opts.workers)
+
+  print('%d frames on %d workers.  Predicted %s to %s per frame.' % (
+        len(frames), opts.workers, _FormatSecs(min(costs)),
+        _FormatSecs(max(costs))))
+  print('%-8s %8s %12s %12s' % ('worker', 'frames', 'planned', 'modulo'))
+  for w in range(opts.workers):
+    print('%-8d %8d %12s %12s' % (w, len(shards[w]), _FormatSecs(loads[w]),
+                                  _FormatSecs(modulo[w])))
+  print('Makespan: %s planned, %s with modulo sharding' % (
+        _FormatSecs(max(loads)), _FormatSecs(max(modulo))))
+
+  if opts.dry_run:
+    return
+  for w, shard in enumerate(shards):
+    plan = {
+        'worker': w,
+        'num_workers': opts.workers,
+        'predicted_secs': loads[w],
+        'frames': [os.path.basename(frames[i]['pbrt']) for i in shard],
+    }
+    path = os.path.join(out_dir, PLAN_TEMPLATE % w)
+    data = json.dumps(plan, indent=2, sort_keys=True) + '\n'
+    pipeline.WriteIfChanged(path, data.encode('utf-8'))
+    print('Wrote %s' % path)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,880 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+slicer.py
+
+Slice a polytope with a family of parallel hyperplanes.
+
+Instead of intersecting the edges with one plane at a time, we take the
+vertex array and the edge index array once, and compute the intersections for
+every frame in a single (frames x edges) pass.
+
+CrossSection() builds the polygon mesh of one slice from the polytope's face
+lattice, without a convex hull.
+
+SliceModel uses the fact that the slices only change combinatorially when the
+hyperplane passes a vertex.  Between two of those offsets, it reuses the cut
+edges, polygons and convex hull, so each frame costs O(cut edges).
+
+Section() cuts a 5D or higher polytope down to 4D with fixed hyperplanes, so
+it can be sliced like the others.
+
+RotatingModel slices a polytope that also rotates, with one rotation matrix
+per frame.
+
+MergedHullMesh() welds duplicate points before the convex hull, and merges
+its coplanar triangles into polygons, so pbrt gets fewer primitives.
+"""
+
+import numpy as np
+
+from render import generate_ply
+
+
+# Bound the size of the (frames x edges) temporaries.  A 120-cell has 1200
+# edges, so this is ~3 MB of float64 per chunk.
+CHUNK_CELLS = 1 << 18
+
+
+class Slices(object):
+  """The intersection points of every frame, stored in one flat array.
+
+  The points of frame i are points[offsets[i]:offsets[i+1]], in edge order.
+  edge_ids holds the index of the edge that each point came from.
+  """
+
+  def __init__(self, points, offsets, edge_ids):
+    self.points = points  # (total, dim) float array
+    self.offsets = offsets  # (num_frames + 1,) int array
+    self.edge_ids = edge_ids  # (total,) int array
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def Frame(self, i):
+    return self.points[self.offsets[i]:self.offsets[i+1]]
+
+  def FrameEdges(self, i):
+    return self.edge_ids[self.offsets[i]:self.offsets[i+1]]
+
+  def Counts(self):
+    return np.diff(self.offsets)
+
+
+def IntersectEdges(la, lb, plane_normal, p0):
+  """Intersect edges with a plane.
+
+  Args:
+    la, lb: (num_edges, dim) arrays of edge endpoints
+    plane_normal, p0: the normal vector and a point on the plane
+
+  Returns:
+    (num_intersections, dim) array, in edge order
+  """
+  la = np.asarray(la, dtype=float)
+  lb = np.asarray(lb, dtype=float)
+  plane_normal = np.asarray(plane_normal, dtype=float)
+
+  lab = lb - la
+  numerator = (la - p0) @ plane_normal
+  denominator = -lab @ plane_normal
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = numerator / denominator
+  # NaN never compares true, so a zero denominator drops out here too.
+  hit = (denominator != 0.0) & (t >= 0.0) & (t <= 1.0)
+
+  return la[hit] + lab[hit] * t[hit, np.newaxis]
+
+
+def SliceAll(vertices, edge_numbers, offsets, axis=-1, drop_axis=True):
+  """Slice a polytope with the hyperplanes x[axis] + offset = 0.
+
+  This is the same as translating the polytope by each offset along the axis,
+  and intersecting it with the hyperplane through the origin.
+
+  Args:
+    vertices: (num_vertices, dim) array
+    edge_numbers: (num_edges, 2) array of vertex indices
+    offsets: 1-D array, one per frame
+    axis: the coordinate that the hyperplane is normal to
+    drop_axis: remove that coordinate from the result, which is always
+      (nearly) zero.
+
+  Returns:
+    Slices instance
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  edge_numbers = np.asarray(edge_numbers, dtype=np.intp).reshape(-1, 2)
+  offsets = np.asarray(offsets, dtype=float).reshape(-1)
+
+  dim = vertices.shape[1]
+  axis = axis % dim
+  num_frames = len(offsets)
+  num_edges = len(edge_numbers)
+
+  if drop_axis:
+    keep = [d for d in range(dim) if d != axis]
+  else:
+    keep = list(range(dim))
+
+  la = vertices[edge_numbers[:, 0]]
+  lb = vertices[edge_numbers[:, 1]]
+  lab = (lb - la)[:, keep]
+  la_kept = la[:, keep]
+  a = la[:, axis]
+  b = lb[:, axis]
+
+  chunk = max(1, CHUNK_CELLS // max(1, num_edges))
+
+  all_points = []
+  all_frames = []
+  all_edges = []
+  for start in range(0, num_frames, chunk):
+    off = offsets[start:start+chunk, np.newaxis]
+    aw = a + off  # (frames, edges)
+    bw = b + off
+
+    # Same arithmetic as Intersect() on translated vertices, so the results
+    # match it exactly.
+    denominator = aw - bw
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = aw / denominator
+    hit = (denominator != 0.0) & (t >= 0.0) & (t <= 1.0)
+
+    frame_idx, edge_idx = np.nonzero(hit)
+    th = t[frame_idx, edge_idx]
+    points = la_kept[edge_idx] + lab[edge_idx] * th[:, np.newaxis]
+    if not drop_axis:
+      # Translated coordinate along the axis
+      col = keep.index(axis)
+      awh = aw[frame_idx, edge_idx]
+      points[:, col] = awh + (bw[frame_idx, edge_idx] - awh) * th
+
+    all_points.append(points)
+    all_frames.append(frame_idx + start)
+    all_edges.append(edge_idx)
+
+  return _JoinChunks(all_points, all_frames, all_edges, num_frames, len(keep))
+
+
+def _JoinChunks(all_points, all_frames, all_edges, num_frames, width):
+  """Make a Slices instance from the per-chunk results."""
+  if all_points:
+    points = np.concatenate(all_points)
+    frames = np.concatenate(all_frames)
+    edge_ids = np.concatenate(all_edges)
+  else:
+    points = np.zeros((0, width))
+    frames = np.zeros(0, dtype=np.intp)
+    edge_ids = np.zeros(0, dtype=np.intp)
+
+  counts = np.bincount(frames, minlength=num_frames)
+  frame_offsets = np.zeros(num_frames + 1, dtype=np.intp)
+  np.cumsum(counts, out=frame_offsets[1:])
+
+  return Slices(points, frame_offsets, edge_ids)
+
+
+def SliceRotating(vertices, edge_numbers, rotations, offsets, center,
+                  axis=-1):
+  """Like SliceAll(), but the polytope is also rotated in each frame.
+
+  Args:
+    vertices: (num_vertices, dim) array
+    edge_numbers: (num_edges, 2) array of vertex indices
+    rotations: (num_frames, dim, dim) array of rotation matrices
+    offsets: 1-D array, one per frame
+    center: the point to rotate about
+    axis: the coordinate that the hyperplane is normal to.  It's removed
+      from the result.
+
+  Returns:
+    Slices instance
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  edge_numbers = np.asarray(edge_numbers, dtype=np.intp).reshape(-1, 2)
+  offsets = np.asarray(offsets, dtype=float).reshape(-1)
+
+  num_vertices, dim = vertices.shape
+  axis = axis % dim
+  keep = [d for d in range(dim) if d != axis]
+  num_frames = len(offsets)
+  centered = vertices - center
+
+  # The rotated vertices and edges of a chunk of frames are temporaries too.
+  chunk = max(1, CHUNK_CELLS // max(1, len(edge_numbers), num_vertices))
+
+  all_points = []
+  all_frames = []
+  all_edges = []
+  for start in range(0, num_frames, chunk):
+    # Every frame of the chunk in one contraction: (frames, vertices, dim)
+    rotated = np.einsum('fij,vj->fvi', rotations[start:start+chunk],
+                        centered) + center
+    la = rotated[:, edge_numbers[:, 0]]  # (frames, edges, dim)
+    lb = rotated[:, edge_numbers[:, 1]]
+
+    off = offsets[start:start+chunk, np.newaxis]
+    aw = la[:, :, axis] + off
+    bw = lb[:, :, axis] + off
+
+    # Same arithmetic as SliceAll()
+    denominator = aw - bw
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = aw / denominator
+    hit = (denominator != 0.0) & (t >= 0.0) & (t <= 1.0)
+
+    frame_idx, edge_idx = np.nonzero(hit)
+    th = t[frame_idx, edge_idx]
+    la_hit = la[frame_idx, edge_idx][:, keep]
+    lab_hit = lb[frame_idx, edge_idx][:, keep] - la_hit
+    all_points.append(la_hit + lab_hit * th[:, np.newaxis])
+    all_frames.append(frame_idx + start)
+    all_edges.append(edge_idx)
+
+  return _JoinChunks(all_points, all_frames, all_edges, num_frames, len(keep))
+
+
+# Vertices closer than this to a hyperplane are considered on it.
+ON_PLANE_EPS = 1e-9
+
+
+class FaceLattice(object):
+  """The incidences between the edges, 2-faces and 3-cells of a 4D polytope.
+
+  schlafli_interpreter gives each element as a list of vertex indices.  This
+  finds the edges of each 2-face and the 2-faces of each 3-cell, once per
+  polytope, so CrossSection() doesn't need a convex hull.
+
+  edges_etc can also be just [edges], e.g. for a Section() of a
+  higher-dimensional polytope.  That's enough for SliceModel.Intersections()
+  and HullMesh(), but not CrossSection().
+  """
+
+  def __init__(self, edges_etc, num_vertices):
+    self.edges = np.asarray(edges_etc[0], dtype=np.intp).reshape(-1, 2)
+    if len(edges_etc) < 3:
+      self.faces = self.face_edges = self.cell_faces = None
+      return
+
+    self.faces = np.asarray(edges_etc[1], dtype=np.intp)  # (F, k)
+    cells = np.asarray(edges_etc[2], dtype=np.intp)  # (C, m)
+
+    num_faces = len(self.faces)
+    num_cells = len(cells)
+
+    # An edge is in a face if both of its vertices are.  The same goes for
+    # faces and cells, since the polytope is convex.
+    vertex_face = np.zeros((num_vertices, num_faces), dtype=bool)
+    vertex_face[self.faces, np.arange(num_faces)[:, np.newaxis]] = True
+    edge_in_face = (vertex_face[self.edges[:, 0]] &
+                    vertex_face[self.edges[:, 1]])  # (E, F)
+    face_ids, edge_ids = np.nonzero(edge_in_face.T)
+    self.face_edges = edge_ids.reshape(num_faces, -1)  # (F, k)
+
+    vertex_cell = np.zeros((num_vertices, num_cells), dtype=bool)
+    vertex_cell[cells, np.arange(num_cells)[:, np.newaxis]] = True
+    face_in_cell = vertex_cell[self.faces].all(axis=1)  # (F, C)
+    cell_ids, face_ids = np.nonzero(face_in_cell.T)
+    self.cell_faces = face_ids.reshape(num_cells, -1)  # (C, f)
+
+
+def CrossSection(lattice, vertices, offset, axis=-1):
+  """Slice a 4D polytope with the hyperplane x[axis] + offset = 0.
+
+  Uses the face lattice instead of a convex hull: edges that are cut give
+  points, 2-faces that are cut give segments, and 3-cells that are cut give
+  polygons.  Vertices on the hyperplane are points too, which handles slices
+  through vertices, edges, faces and whole cells.
+
+  Args:
+    lattice: FaceLattice instance
+    vertices: (num_vertices, 4) array
+    offset: where the hyperplane is, as in SliceAll()
+    axis: the coordinate that the hyperplane is normal to.  It's removed from
+      the result.
+
+  Returns:
+    points: (num_points, 3) array
+    polygons: list of vertex index arrays, wound counterclockwise when seen
+      from outside.  Empty if the slice is a point or a segment.
+  """
+  points, polygons, _ = _CrossSection(lattice, vertices, offset, axis)
+  return points, polygons
+
+
+def _CrossSection(lattice, vertices, offset, axis):
+  """CrossSection(), and the edge each point came from (-1 for a vertex)."""
+  if lattice.faces is None:
+    raise ValueError('Need the edges, faces and cells of a 4D polytope')
+  vertices = np.asarray(vertices, dtype=float)
+  num_vertices, dim = vertices.shape
+  axis = axis % dim
+  keep = [d for d in range(dim) if d != axis]
+
+  dist = vertices[:, axis] + offset
+  on_plane = np.abs(dist) <= ON_PLANE_EPS
+  side = np.where(on_plane, 0.0, np.sign(dist))
+
+  # Number the points: vertices on the plane first, then cut edges.
+  a = lattice.edges[:, 0]
+  b = lattice.edges[:, 1]
+  cut = side[a] * side[b] < 0
+
+  plane_vertices = np.flatnonzero(on_plane)
+  cut_edges = np.flatnonzero(cut)
+  num_plane = len(plane_vertices)
+
+  vertex_point = np.full(num_vertices, -1, dtype=np.intp)
+  vertex_point[plane_vertices] = np.arange(num_plane)
+  edge_point = np.full(len(lattice.edges), -1, dtype=np.intp)
+  edge_point[cut_edges] = num_plane + np.arange(len(cut_edges))
+
+  # Same arithmetic as SliceAll().
+  la = vertices[a[cut_edges]]
+  lb = vertices[b[cut_edges]]
+  aw = dist[a[cut_edges]]
+  t = aw / (aw - dist[b[cut_edges]])
+  points = np.concatenate([
+      vertices[plane_vertices][:, keep],
+      la[:, keep] + (lb - la)[:, keep] * t[:, np.newaxis],
+  ])
+
+  # A face with exactly 2 points gives a segment.  (A face with more lies in
+  # the plane, and comes out as the polygon of a neighboring cell.)
+  face_ids = np.concatenate([vertex_point[lattice.faces],
+                             edge_point[lattice.face_edges]], axis=1)
+  face_ids.sort(axis=1)
+  is_segment = (face_ids >= 0).sum(axis=1) == 2
+  face_segment = np.full((len(face_ids), 2), -1, dtype=np.intp)
+  face_segment[is_segment] = face_ids[is_segment, -2:]
+
+  # The segments of a cell are the sides of its polygon.  Number the distinct
+  # (cell, point) and (cell, segment) pairs.
+  num_points = len(points)
+  cells, slots = np.nonzero(face_segment[lattice.cell_faces][:, :, 0] >= 0)
+  segments = face_segment[lattice.cell_faces[cells, slots]]  # (S, 2)
+  seg_keys = np.unique((cells * num_points + segments[:, 0]) * num_points +
+                       segments[:, 1])
+  seg_cells = seg_keys // (num_points * num_points)
+  first_p = seg_keys // num_points % num_points
+  first_q = seg_keys % num_points
+
+  # A cell with at least 3 distinct segments gives a polygon.  (A cell that
+  # touches the plane along an edge gives the same segment twice.)
+  num_cells = len(lattice.cell_faces)
+  is_polygon = np.bincount(seg_cells, minlength=num_cells) >= 3
+  corner_keys = np.unique(np.concatenate([
+      seg_cells * num_points + first_p, seg_cells * num_points + first_q]))
+  corner_cells = corner_keys // num_points
+  corner_keys = corner_keys[is_polygon[corner_cells]]
+  if len(corner_keys) == 0:
+    return np.zeros((0, len(keep))), [], np.zeros(0, dtype=np.intp)
+  corner_cells = corner_keys // num_points
+  corners = corner_keys % num_points
+
+  # Order each polygon's corners by angle in its plane.  The polygons are
+  # convex, so this is the same cycle as chaining the segments.
+  polygon_cells, first, sizes = np.unique(corner_cells, return_index=True,
+                                          return_counts=True)
+  polygon_index = np.repeat(np.arange(len(polygon_cells)), sizes)
+  corner_points = points[corners]
+  centroids = np.add.reduceat(corner_points, first) / sizes[:, np.newaxis]
+  rel = corner_points - centroids[polygon_index]
+
+  # Basis vectors from one side of each polygon, which never passes through
+  # its centroid.
+  _, seg_first = np.unique(seg_cells, return_index=True)
+  side_cells = seg_cells[seg_first]
+  side = seg_first[np.searchsorted(side_cells, polygon_cells)]
+  u = points[first_p[side]] - centroids
+  normals = np.cross(u, points[first_q[side]] - centroids)
+  v = np.cross(normals, u)
+
+  # Wind counterclockwise as seen from outside the convex slice.
+  center = corner_points.mean(axis=0)
+  outward = np.where(np.sum(normals * (centroids - center), axis=1) < 0,
+                     -1.0, 1.0)
+  angles = np.arctan2(np.sum(rel * v[polygon_index], axis=1),
+                      np.sum(rel * u[polygon_index], axis=1))
+  order = np.lexsort((angles * outward[polygon_index], polygon_index))
+
+  # Drop points that aren't on any polygon, e.g. from a cell that touches the
+  # plane at one vertex.
+  used = np.unique(corners)
+  new_index = np.full(num_points, -1, dtype=np.intp)
+  new_index[used] = np.arange(len(used))
+  polygons = np.split(new_index[corners[order]], first[1:])
+
+  if num_plane >= 3:
+    # Two cells that share a face on the plane give the same polygon.
+    seen = set()
+    unique_polygons = []
+    for polygon in polygons:
+      key = tuple(sorted(polygon))
+      if key not in seen:
+        seen.add(key)
+        unique_polygons.append(polygon)
+    polygons = unique_polygons
+
+  point_edges = np.concatenate([np.full(num_plane, -1, dtype=np.intp),
+                                cut_edges])
+  return points[used], polygons, point_edges[used]
+
+
+def Section(vertices, edges_etc, axes, offsets):
+  """Slice a polytope with several hyperplanes x[axis] + offset = 0.
+
+  Each hyperplane takes away a dimension: the edges it cuts give the points
+  of the section, and the j-faces it cuts give the (j-1)-faces.  A 2-face is
+  a convex polygon, so it's cut at 2 edges, which become an edge of the
+  section.  Vertices on a hyperplane count as on its positive side, as if it
+  were moved a tiny bit, so no cut goes through a vertex.
+
+  Args:
+    vertices: (num_vertices, dim) array
+    edges_etc: [edges, faces, ...] from schlafli_interpreter.  Elements up to
+      dimension len(axes) + 1 are used.
+    axes: the coordinates that the hyperplanes are normal to.  They're removed
+      from the result.
+    offsets: where each hyperplane is
+
+  Returns:
+    points: (num_points, dim - len(axes)) array
+    edges: (num_edges, 2) array of point indices
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  num_vertices, dim = vertices.shape
+  if len(edges_etc) < len(axes) + 1:
+    raise ValueError('Need elements up to dimension %d' % (len(axes) + 1))
+
+  edges = np.asarray(edges_etc[0], dtype=np.intp).reshape(-1, 2)
+  # (num_vertices, num_elements) for the 2-faces, 3-cells, ...
+  incidence = []
+  for elements in edges_etc[1:len(axes) + 1]:
+    elements = np.asarray(elements, dtype=np.intp)
+    vertex_element = np.zeros((num_vertices, len(elements)), dtype=bool)
+    vertex_element[elements, np.arange(len(elements))[:, np.newaxis]] = True
+    incidence.append(vertex_element)
+
+  # Highest axis first, so removing it doesn't renumber the others.
+  points = vertices
+  for axis, offset in sorted(zip([axis % dim for axis in axes], offsets),
+                             reverse=True):
+    dist = points[:, axis] + offset
+    positive = dist >= 0
+    cut = np.flatnonzero(positive[edges[:, 0]] != positive[edges[:, 1]])
+    a = edges[cut, 0]
+    b = edges[cut, 1]
+
+    # Same arithmetic as SliceAll().
+    keep = [d for d in range(points.shape[1]) if d != axis]
+    la = points[a][:, keep]
+    lab = points[b][:, keep] - la
+    t = dist[a] / (dist[a] - dist[b])
+    points = la + lab * t[:, np.newaxis]
+
+    # An element has a cut edge if it has both of its vertices.
+    incidence = [vertex_element[a] & vertex_element[b]
+                 for vertex_element in incidence]
+    face_points = incidence.pop(0)
+    is_edge = face_points.sum(axis=0) == 2
+    _, point_ids = np.nonzero(face_points[:, is_edge].T)
+    edges = point_ids.reshape(-1, 2)
+
+  return points, edges
+
+
+class _Interval(object):
+  """What stays the same between two critical offsets of a SliceModel."""
+
+  def __init__(self, edge_ids, vertices, edges, axis, keep):
+    self.edge_ids = edge_ids  # cut edges, in edge order like SliceAll()
+    la = vertices[edges[edge_ids, 0]]
+    lb = vertices[edges[edge_ids, 1]]
+    # Each point is la + lab * t, and t is linear in the offset.
+    self.la = la[:, keep]
+    self.lab = (lb - la)[:, keep]
+    self.a = la[:, axis]
+    self.b = lb[:, axis]
+
+    self.polygons = None  # indices into edge_ids, computed when needed
+    self.hull = None  # (vertex indices into edge_ids, triangles)
+    self.merged_hull = None  # (vertex indices into edge_ids, polygons)
+
+  def Points(self, offset):
+    # Same arithmetic as SliceAll(), so the points match it exactly.
+    aw = self.a + offset
+    bw = self.b + offset
+    t = aw / (aw - bw)
+    return self.la + self.lab * t[:, np.newaxis]
+
+
+class SliceModel(object):
+  """The slices of a 4D polytope at every offset, as a piecewise-linear model.
+
+  The critical offsets are where the hyperplane passes a vertex.  Between two
+  of them, the same edges are cut, each intersection point moves linearly,
+  and the cross-section has the same polygons and convex hull triangles.
+  Those are computed once per interval, the first time it's used, so a frame
+  costs O(cut edges) no matter how many frames there are.
+
+  Offsets within ON_PLANE_EPS of a critical offset are computed from scratch.
+  """
+
+  def __init__(self, lattice, vertices, axis=-1):
+    """
+    Args:
+      lattice: FaceLattice instance
+      vertices: (num_vertices, 4) array
+      axis: the coordinate that the hyperplane is normal to, as in SliceAll()
+    """
+    self.lattice = lattice
+    self.vertices = np.asarray(vertices, dtype=float)
+    dim = self.vertices.shape[1]
+    self.axis = axis % dim
+    self.keep = [d for d in range(dim) if d != self.axis]
+
+    # x[axis] + offset = 0 passes through a vertex at offset = -x[axis].
+    critical = np.unique(-self.vertices[:, self.axis])
+    distinct = np.concatenate([[True], np.diff(critical) > ON_PLANE_EPS])
+    self.critical = critical[distinct]
+
+    self.intervals = [None] * max(0, len(self.critical) - 1)
+
+  def IntervalIndex(self, offset):
+    """The interval that offset is strictly inside, or -1."""
+    k = np.searchsorted(self.critical, offset)
+    if k == 0 or k == len(self.critical):
+      return -1  # The hyperplane misses the polytope
+    if (offset - self.critical[k-1] <= ON_PLANE_EPS or
+        self.critical[k] - offset <= ON_PLANE_EPS):
+      return -1
+    return k - 1
+
+  def _Interval(self, k):
+    interval = self.intervals[k]
+    if interval is None:
+      mid = (self.critical[k] + self.critical[k+1]) / 2
+      dist = self.vertices[:, self.axis] + mid
+      edges = self.lattice.edges
+      edge_ids = np.flatnonzero(
+          np.sign(dist[edges[:, 0]]) != np.sign(dist[edges[:, 1]]))
+      interval = _Interval(edge_ids, self.vertices, edges, self.axis,
+                           self.keep)
+      self.intervals[k] = interval
+    return interval
+
+  def Intersections(self, offset):
+    """The points of SliceAll() for one offset."""
+    k = self.IntervalIndex(offset)
+    if k == -1:
+      return SliceAll(self.vertices, self.lattice.edges, [offset],
+                      axis=self.axis).Frame(0)
+    return self._Interval(k).Points(offset)
+
+  def CrossSection(self, offset):
+    """Like CrossSection(), with the polygons reused within an interval."""
+    k = self.IntervalIndex(offset)
+    if k == -1:
+      return CrossSection(self.lattice, self.vertices, offset, self.axis)
+
+    interval = self._Interval(k)
+    if interval.polygons is None:
+      # Topology at the midpoint, so it doesn't depend on the frames used.
+      mid = (self.critical[k] + self.critical[k+1]) / 2
+      _, polygons, point_edges = _CrossSection(
+          self.lattice, self.vertices, mid, self.axis)
+      point_index = np.searchsorted(interval.edge_ids, point_edges)
+      interval.polygons = [point_index[polygon] for polygon in polygons]
+    return interval.Points(offset), interval.polygons
+
+  def HullMesh(self, offset):
+    """Like generate_ply.hull_mesh() on Intersections(offset).
+
+    Within an interval, the convex hull is the same up to moving its
+    vertices, so the triangles are reused.
+    """
+    k = self.IntervalIndex(offset)
+    if k == -1:
+      return generate_ply.hull_mesh(self.Intersections(offset))
+
+    interval = self._Interval(k)
+    if interval.hull is None:
+      mid = (self.critical[k] + self.critical[k+1]) / 2
+      interval.hull = generate_ply.hull_topology(interval.Points(mid))
+    vertex_indices, triangles = interval.hull
+    return interval.Points(offset)[vertex_indices], triangles
+
+  def MergedHullMesh(self, offset):
+    """Like MergedHullMesh() on Intersections(offset).
+
+    Each face of the hull is the cut of a 3-cell, so triangles that are
+    coplanar at the midpoint of an interval stay coplanar in all of it, and
+    the polygons are reused.
+    """
+    k = self.IntervalIndex(offset)
+    if k == -1:
+      return MergedHullMesh(self.Intersections(offset))
+
+    interval = self._Interval(k)
+    if interval.merged_hull is None:
+      mid = (self.critical[k] + self.critical[k+1]) / 2
+      points = interval.Points(mid)
+      vertex_indices, triangles = generate_ply.hull_topology(points)
+      kept, polygons = MergeCoplanar(points[vertex_indices], triangles)
+      interval.merged_hull = vertex_indices[kept], polygons
+    vertex_indices, polygons = interval.merged_hull
+    return interval.Points(offset)[vertex_indices], polygons
+
+
+class RotatingModel(object):
+  """The slices of a 4D polytope that rotates as well as moving through the
+  hyperplane.
+
+  Unlike SliceModel, every frame has different vertices, so there's nothing
+  to reuse between frames.  The intersections of all frames are computed up
+  front by SliceRotating().  The methods take a frame index.
+  """
+
+  def __init__(self, lattice, vertices, rotations, offsets, axis=-1):
+    """
+    Args:
+      lattice: FaceLattice instance
+      vertices: (num_vertices, 4) array
+      rotations: (num_frames, 4, 4) array.  The polytope is rotated about its
+        center.
+      offsets: where the hyperplane is in each frame, as in SliceAll()
+      axis: the coordinate that the hyperplane is normal to
+    """
+    self.lattice = lattice
+    self.vertices = np.asarray(vertices, dtype=float)
+    self.rotations = rotations
+    self.offsets = offsets
+    self.axis = axis
+    self.center = self.vertices.mean(axis=0)
+    self.slices = SliceRotating(self.vertices, lattice.edges, rotations,
+                                offsets, self.center, axis=axis)
+
+  def Vertices(self, i):
+    """The rotated vertices of frame i."""
+    return (self.vertices - self.center) @ self.rotations[i].T + self.center
+
+  def Intersections(self, i):
+    return self.slices.Frame(i)
+
+  def CrossSection(self, i):
+    return CrossSection(self.lattice, self.Vertices(i), self.offsets[i],
+                        self.axis)
+
+  def HullMesh(self, i):
+    return SafeHullMesh(self.Intersections(i))
+
+  def MergedHullMesh(self, i):
+    return MergedHullMesh(self.Intersections(i))
+
+
+# Slices thinner than this fraction of their size are flat.
+FLAT_EPS = 1e-9
+
+
+def SafeHullMesh(points):
+  """Like generate_ply.hull_mesh(), for slices that may be degenerate.
+
+  In some orientations, the hyperplane only touches a vertex, an edge or a
+  2-face of the polytope, and QHull raises an error.  Instead, a flat slice
+  gives a polygon, and a point or segment gives an empty mesh.
+  """
+  points = np.asarray(points, dtype=float).reshape(-1, 3)
+  empty = np.zeros((0, 3)), np.zeros((0, 3), dtype=np.intp)
+  if len(points) < 3:
+    return empty
+
+  # The spread of the points along their principal axes
+  center = points.mean(axis=0)
+  _, spread, axes = np.linalg.svd(points - center)
+  if spread[1] <= FLAT_EPS * spread[0]:
+    return empty  # A segment or a point
+
+  if len(points) >= 4 and spread[2] > FLAT_EPS * spread[0]:
+    try:
+      return generate_ply.hull_mesh(points)
+    except (RuntimeError, ValueError):
+      pass  # Nearly flat.  QhullError is a RuntimeError.
+
+  # A convex polygon in the plane of the first two axes, as a fan of triangles
+  from scipy import spatial  # imported when first needed, like generate_ply
+  try:
+    hull = spatial.ConvexHull((points - center) @ axes[:2].T)
+  except (RuntimeError, ValueError):
+    return empty  # Nearly a segment
+  corners = hull.vertices  # counterclockwise
+  fan = np.arange(1, len(corners) - 1)
+  triangles = np.stack([np.zeros_like(fan), fan, fan + 1], axis=1)
+  return points[corners], triangles
+
+
+# Points closer than this fraction of the slice's size are the same point.
+WELD_EPS = 1e-7
+
+# Hull triangles whose unit normals and offsets (as a fraction of the slice's
+# size) differ by less than this are on the same face.
+COPLANAR_EPS = 1e-6
+
+
+def _Components(num_nodes, pairs):
+  """Label the connected components of a graph given as (n, 2) node pairs."""
+  from scipy import sparse
+  from scipy.sparse import csgraph
+
+  graph = sparse.coo_matrix(
+      (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+      shape=(num_nodes, num_nodes))
+  _, labels = csgraph.connected_components(graph, directed=False)
+  return labels
+
+
+def WeldPoints(points, eps=WELD_EPS):
+  """Merge points that are within eps of each other, relative to their size.
+
+  When the hyperplane passes through a vertex, every edge at the vertex is
+  cut at the same point, give or take rounding.
+
+  Returns:
+    points: the first point of each cluster, as a (n, 3) array
+    index: the index of each input point in points
+  """
+  points = np.asarray(points, dtype=float).reshape(-1, 3)
+  if len(points) < 2:
+    return points, np.arange(len(points))
+  from scipy import spatial
+
+  size = np.ptp(points, axis=0).max()
+  pairs = spatial.cKDTree(points).query_pairs(eps * size,
+                                              output_type='ndarray')
+  if len(pairs) == 0:
+    return points, np.arange(len(points))
+  labels = _Components(len(points), pairs)
+  _, first, index = np.unique(labels, return_index=True, return_inverse=True)
+  return points[first], index
+
+
+def MergeCoplanar(vertices, triangles, eps=COPLANAR_EPS):
+  """Merge the coplanar triangles of a convex mesh into polygons.
+
+  qhull triangulates every face of the hull, so a pentagon is 3 triangles.
+  This finds the triangles on each face, and orders the corners of the face
+  around it.  The diagonals are dropped, and so are corners in the middle of
+  a side.
+
+  Args:
+    vertices: (num_vertices, 3) array
+    triangles: (m, 3) int array
+
+  Returns:
+    kept: the indices of the vertices used by the polygons
+    polygons: list of index arrays into vertices[kept], wound
+      counterclockwise when seen from outside
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  triangles = np.asarray(triangles, dtype=np.intp).reshape(-1, 3)
+  tri = vertices[triangles]
+  normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+  norms = np.linalg.norm(normals, axis=1)
+  size = np.ptp(vertices, axis=0).max() if len(vertices) else 0.0
+
+  # Slivers have no plane of their own.  Their corners are on the
+  # neighboring faces anyway.
+  solid = norms > eps * size * size
+  triangles = triangles[solid]
+  tri = tri[solid]
+  normals = normals[solid] / norms[solid, np.newaxis]
+  if len(triangles) == 0:
+    return np.zeros(0, dtype=np.intp), []
+
+  # Point the normals outward, since the hull's triangles aren't wound
+  # consistently.
+  center = vertices[np.unique(triangles)].mean(axis=0)
+  outward = np.sum(normals * (tri.mean(axis=1) - center), axis=1) >= 0
+  normals = np.where(outward[:, np.newaxis], normals, -normals)
+  planes = np.hstack([
+      normals, np.sum(normals * tri[:, 0], axis=1)[:, np.newaxis] / size])
+  from scipy import spatial
+  pairs = spatial.cKDTree(planes).query_pairs(eps, output_type='ndarray')
+  face_of = _Components(len(triangles), pairs)  # face label of each triangle
+
+  # The distinct corners of each face
+  num_vertices = len(vertices)
+  keys = np.unique(np.repeat(face_of, 3) * num_vertices + triangles.ravel())
+  corner_face = keys // num_vertices
+  corners = keys % num_vertices
+  faces, first, counts = np.unique(corner_face, return_index=True,
+                                   return_counts=True)
+
+  # Order the corners by angle around the face's center, in a basis where
+  # the outward normal points at the viewer.
+  face_normal = np.zeros((len(faces), 3))
+  face_normal[face_of] = normals
+  face_center = np.zeros((len(faces), 3))
+  np.add.at(face_center, corner_face, vertices[corners])
+  face_center /= counts[:, np.newaxis]
+  rel = vertices[corners] - face_center[corner_face]
+  u = rel[first] / np.linalg.norm(rel[first], axis=1)[:, np.newaxis]
+  v = np.cross(face_normal, u)
+  angle = np.arctan2(np.sum(rel * v[corner_face], axis=1),
+                     np.sum(rel * u[corner_face], axis=1))
+  order = np.lexsort((angle, corner_face))
+  corners = corners[order]
+
+  # Drop corners on a straight side, which only add degenerate triangles.
+  local = np.arange(len(corners)) - first[corner_face]
+  prev = first[corner_face] + (local - 1) % counts[corner_face]
+  next_ = first[corner_face] + (local + 1) % counts[corner_face]
+  p = vertices[corners]
+  turn = np.linalg.norm(np.cross(p[prev] - p, p[next_] - p), axis=1)
+  straight = turn <= eps * size * size
+  corners = corners[~straight]
+  counts = counts - np.bincount(corner_face[straight], minlength=len(faces))
+
+  kept, corners = np.unique(corners, return_inverse=True)
+  polygons = np.split(corners, np.cumsum(counts)[:-1])
+  return kept, [polygon for polygon in polygons if len(polygon) >= 3]
+
+
+def MergedHullMesh(points):
+  """The convex hull of a slice, with duplicate points welded and coplanar
+  triangles merged into polygons.
+
+  Returns (vertices, polygons).  Like SafeHullMesh(), a degenerate slice
+  gives a polygon or an empty mesh, not a QHull error.
+  """
+  points, _ = WeldPoints(points)
+  hull_points, triangles = SafeHullMesh(points)
+  kept, polygons = MergeCoplanar(hull_points, triangles)
+  return hull_points[kept], polygons
+
+
+def Triangulate(polygons):
+  """Fan-triangulate convex polygons.  Returns an (m, 3) int array."""
+  triangles = [(polygon[0], polygon[i], polygon[i+1])
+               for polygon in polygons for i in range(1, len(polygon) - 1)]
+  return np.array(triangles, dtype=np.intp).reshape(-1, 3)
+
+
+def SplitPolygons(polygons, max_sides=4):
+  """Fan-split convex polygons into ones with at most max_sides corners.
+
+  pbrt's plymesh ignores faces that aren't triangles or quads, so a pentagon
+  becomes a quad and a triangle, and a hexagon becomes two quads.
+  """
+  step = max_sides - 2
+  result = []
+  for polygon in polygons:
+    polygon = list(polygon)
+    if len(polygon) <= max_sides:
+      result.append(polygon)
+      continue
+    for i in range(1, len(polygon) - 1, step):
+      result.append([polygon[0]] + polygon[i:i+step+1])
+  return result
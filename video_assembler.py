@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+from __future__ import print_function
+"""
+video_assembler.py
+
+Encode rendered frames as a video while they're still being rendered.
+
+A VideoStream starts ffmpeg, and pipes each frame's image file to its stdin in
+frame order, as soon as the frame and all the ones before it are finished.
+ffmpeg decodes the images itself, so only one image file is read at a time,
+even for 4800x4800 frames.  Frames that finish early wait for the ones before
+them, so the video is ready seconds after the last frame is finished.  A frame
+that failed to render is filled in with the frame before it.
+
+render_executor.py --video uses a VideoStream directly, and tells it about
+every frame, including failures.  Run on its own, this watches the image
+files of a directory (or a list of image files) and encodes them as they
+appear on disk, e.g. while machines in run.sh copy them back.  A frame may
+never appear there, so when more than --window later frames are waiting for
+it, it's given up on and filled in.
+
+Usage:
+  ./video_assembler.py [options] DIR_OR_IMAGE_FILE...
+
+Examples:
+  ./video_assembler.py --out _out/4d/5-3-3.mp4 _out/4d/5-3-3
+  ./video_assembler.py --idle-timeout 600 --out _out/4d/bathroom.mp4 \\
+      _out/4d/bathroom
+  ./video_assembler.py --fps 10 --out _out/k.mp4 _out/jpg/k-*.jpg
+"""
+
+import optparse
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pipeline
+
+
+# How ffmpeg should decode each kind of image piped to it.
+INPUT_CODECS = {
+    '.png': 'png',
+    '.jpg': 'mjpeg',
+    '.jpeg': 'mjpeg',
+    '.exr': 'exr',
+}
+
+
+def EncoderArgv(out_path, fps, codec, crf, input_codec):
+  """The ffmpeg command line for images piped to stdin.
+
+  yuv420p and +faststart make an .mp4 that Safari and QuickTime can play,
+  unlike the ones ImageMagick's convert made.
+  """
+  argv = [
+      'ffmpeg', '-y', '-loglevel', 'error',
+      '-f', 'image2pipe', '-framerate', str(fps), '-c:v', input_codec,
+      '-i', '-',
+      '-c:v', codec, '-pix_fmt', 'yuv420p', '-movflags', '+faststart',
+  ]
+  if crf is not None:
+    argv.extend(['-crf', str(crf)])
+  argv.append(out_path)
+  return argv
+
+
+class VideoStream(object):
+  """Encodes frames in frame order, while they're added in any order.
+
+  Add() doesn't block.  A thread writes the images to ffmpeg, so a slow
+  encoder doesn't hold up the caller, e.g. a RenderStage worker.
+  """
+
+  def __init__(self, out_path, num_frames, fps=30, codec='libx264', crf=None,
+               window=None):
+    """
+    Args:
+      out_path: the video to write.  Its extension picks the container.
+      num_frames: the number of frames in the video
+      fps: frames per second
+      codec: ffmpeg video codec, e.g. libx264 or libx265
+      crf: constant rate factor, or None for the codec's default
+      window: how many later frames can wait for a missing one, or None to
+        wait until it's added or Finish() is called
+    """
+    self.out_path = out_path
+    root, ext = os.path.splitext(out_path)
+    self.tmp_path = root + '.tmp' + ext  # ffmpeg needs the extension
+    self.num_frames = num_frames
+    self.fps = fps
+    self.codec = codec
+    self.crf = crf
+    self.window = window
+
+    self.queue = queue.Queue()
+    self.proc = None  # started with the first frame, which has the format
+    self.next_frame = 0
+    self.last_path = None
+    self.num_encoded = 0
+    self.num_filled = 0  # missing frames shown as the one before
+    self.num_skipped = 0  # missing frames at the start, with none before
+    self.error = None
+
+    self.thread = threading.Thread(target=self._Run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Add(self, position, image_path):
+    """Frame number position is finished.  image_path is None if it failed."""
+    self.queue.put((position, image_path))
+
+  def Finish(self):
+    """Encode the rest, filling in missing frames, and finish the file."""
+    self.queue.put(None)
+    self.thread.join()
+    if self.error:
+      self.Abort()
+      raise RuntimeError('Encoding %s failed: %s' % (self.out_path,
+                                                       self.error))
+    if self.proc is None:
+      raise RuntimeError('No frames to encode in %s' % self.out_path)
+    self.proc.stdin.close()
+    status = self.proc.wait()
+    if status != 0:
+      raise RuntimeError('ffmpeg failed with status %d' % status)
+    os.rename(self.tmp_path, self.out_path)  # Players never see a partial one
+
+  def Abort(self):
+    if self.proc is None:
+      return
+    self.proc.kill()
+    self.proc.wait()
+    if os.path.exists(self.tmp_path):
+      os.remove(self.tmp_path)
+
+  def Summary(self):
+    s = '%d frames encoded' % self.num_encoded
+    if self.num_filled:
+      s += ', %d missing ones filled with the frame before' % self.num_filled
+    if self.num_skipped:
+      s += ', %d missing ones at the start skipped' % self.num_skipped
+    return s
+
+  def _Run(self):
+    waiting = {}  # position -> image path, for frames after next_frame
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      position, image_path = item
+      if position >= self.next_frame:
+        waiting[position] = image_path
+      self._Drain(waiting, False)
+    self._Drain(waiting, True)
+
+  def _Drain(self, waiting, finishing):
+    """Encode the frames that are ready.  When finishing, don't wait."""
+    while self.next_frame < self.num_frames and not self.error:
+      if self.next_frame in waiting:
+        image_path = waiting.pop(self.next_frame)
+      elif finishing or (self.window is not None and
+                         len(waiting) > self.window):
+        image_path = None  # given up on
+      else:
+        return
+      self._Write(image_path)
+      self.next_frame += 1
+
+  def _Write(self, image_path):
+    if image_path is None:
+      if self.last_path is None:
+        self.num_skipped += 1
+        return
+      image_path = self.last_path
+      self.num_filled += 1
+    else:
+      self.num_encoded += 1
+
+    try:
+      if self.proc is None:
+        self._Start(image_path)
+      with open(image_path, 'rb') as f:
+        shutil.copyfileobj(f, self.proc.stdin)
+    except (IOError, OSError, RuntimeError) as e:
+      self.error = e
+      return
+    self.last_path = image_path
+
+  def _Start(self, image_path):
+    ext = os.path.splitext(image_path)[1].lower()
+    if ext not in INPUT_CODECS:
+      raise RuntimeError("Can't encode %s images" % ext)
+    argv = EncoderArgv(self.tmp_path, self.fps, self.codec, self.crf,
+                       INPUT_CODECS[ext])
+    try:
+      self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE)
+    except OSError as e:
+      raise RuntimeError("Couldn't run ffmpeg: %s" % e)
+
+
+def ImagePaths(args):
+  """The image of every frame, in frame order.
+
+  Directories are expanded into the images of their .pbrt files.  Returns
+  the paths, and a function that says whether a frame is done.
+  """
+  if not any(os.path.isdir(arg) for arg in args):
+    return list(args), pipeline.IsComplete
+
+  # Only images rendered from the current .pbrt files, like render_executor.
+  import render_executor  # which imports this module
+  jobs = render_executor.FindFrames(args)
+  finished = {}  # dir -> image paths in its state file
+  for job in jobs:
+    d = os.path.dirname(job.pbrt_path)
+    if d not in finished:
+      finished[d] = render_executor.ReadFinished(pipeline.FinishedPath(d))
+  done = dict((job.image_path, job) for job in jobs)
+
+  def IsDone(image_path):
+    job = done[image_path]
+    return render_executor.IsDone(
+        job, finished[os.path.dirname(job.pbrt_path)])
+  return [job.image_path for job in jobs], IsDone
+
+
+def AddVideoOptions(parser, prefix=''):
+  """Options shared with render_executor.py, which prefixes them with
+  --video-."""
+  parser.add_option(
+      '--%sfps' % prefix, type=int, default=30,
+      help='Frames per second of the video (default: 30)')
+  parser.add_option(
+      '--%scodec' % prefix, type=str, default='libx264',
+      help='ffmpeg video codec (default: libx264)')
+  parser.add_option(
+      '--%scrf' % prefix, type=int,
+      help="Constant rate factor.  Lower is better quality (default: the "
+           "codec's)")
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage='%prog [options] DIR_OR_IMAGE_FILE...',
+      description='Encode frames as a video as they appear on disk.')
+  parser.add_option(
+      '--out', type=str,
+      help='Video file to write, e.g. _out/4d/5-3-3.mp4')
+  AddVideoOptions(parser)
+  parser.add_option(
+      '--window', type=int, default=64,
+      help='How many finished frames can wait for a missing one before '
+           'it is filled in (default: 64)')
+  parser.add_option(
+      '--poll', type=float, default=2.0,
+      help='Seconds between looking for new frames')
+  parser.add_option(
+      '--idle-timeout', type=float, default=0,
+      help='Keep waiting for missing frames until none has appeared for '
+           'this many seconds.  The default, 0, encodes what is there.')
+
+  opts, args = parser.parse_args(argv[1:])
+  if not args:
+    raise RuntimeError('Directory or image files required')
+  if not opts.out:
+    raise RuntimeError('--out required')
+
+  image_paths, is_done = ImagePaths(args)
+  if not image_paths:
+    raise RuntimeError('No frames in %s' % ' '.join(args))
+
+  stream = VideoStream(opts.out, len(image_paths), fps=opts.fps,
+                       codec=opts.codec, crf=opts.crf, window=opts.window)
+  pending = list(range(len(image_paths)))
+  last_time = time.time()
+  try:
+    while pending:
+      new = [i for i in pending if is_done(image_paths[i])]
+      for i in new:
+        stream.Add(i, image_paths[i])
+      if new:
+        new_set = set(new)
+        pending = [i for i in pending if i not in new_set]
+        last_time = time.time()
+        print('%d of %d frames done' % (len(image_paths) - len(pending),
+                                        len(image_paths)))
+      elif time.time() - last_time >= opts.idle_timeout:
+        break
+      if pending and opts.idle_timeout:
+        time.sleep(opts.poll)
+    stream.Finish()
+  except KeyboardInterrupt:
+    stream.Abort()
+    raise RuntimeError('Interrupted')
+
+  print('Wrote %s: %s' % (opts.out, stream.Summary()))
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError as e:
+    print('FATAL: %s' % e, file=sys.stderr)
+    sys.exit(1)